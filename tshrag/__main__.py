@@ -6,8 +6,10 @@ from typing import Union, Optional, Generic, TypeVar
 from typing import Callable, Generator, Iterable, Iterator, AsyncIterator
 from typing import Tuple, List, Set, Dict, Any
 
+import os
 import time
 import shlex
+import socket
 from threading import Thread
 
 from pathlib import Path
@@ -40,6 +42,8 @@ from .util.consts import SERVICE_HOST
 from .util.consts import SERVICE_PORT
 
 from .util.consts import PATH_DOT_TSHRAG
+from .util.consts import PATH_SOCKET
+from .util.consts import ENV_SOCKET
 
 from .util.config import CONFIG
 
@@ -48,6 +52,7 @@ from .util.config import CONFIG
 root = Path(PATH_DOT_TSHRAG)
 tshrag = Tshrag(root, test_main=test_main, config=CONFIG)
 daemon_lock = Lock(root / "daemon.lock", timeout=TIMEOUT)
+sock = root / PATH_SOCKET
 
 test_api = TestAPI(tshrag)
 metric_api = MetricAPI(tshrag)
@@ -75,23 +80,37 @@ def _main():
         app.include_router(metric_api, prefix="/api/v1")
         app.include_router(metric_wsapi, prefix="/wsapi/v1")
         app.include_router(report_api, prefix="/api/v1")
-        app = Thread(
-            target=uvicorn.run,
-            args=(app,),
-            kwargs={
-                "host": SERVICE_HOST,
-                "port": SERVICE_PORT
-            },
+        # Local clients prefer the Unix socket: no TCP stack per request and
+        # no port to contend for. Jobs find it through TSHRAG_SOCKET. Both
+        # sockets are served by one server, so the app lifespan runs once.
+        sockets = [socket.create_server((SERVICE_HOST, SERVICE_PORT))]
+        # asyncio skips TCP_NODELAY for sockets made with protocol 0,
+        # accepted connections inherit it from the listener instead.
+        sockets[0].setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if hasattr(socket, "AF_UNIX"):
+            sock.unlink(missing_ok=True)
+            _unix = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            _unix.bind(sock.as_posix())
+            _unix.listen()
+            os.chmod(sock, 0o666)
+            sockets.append(_unix)
+            os.environ[ENV_SOCKET] = sock.resolve().as_posix()
+        server = uvicorn.Server(uvicorn.Config(app))
+        thread = Thread(
+            target=server.run,
+            args=(sockets,),
             name="API Thread",
             daemon=True,
         )
-        app.start()
-        while app.is_alive():
+        thread.start()
+        while thread.is_alive():
             tshrag.refresh()
             time.sleep(TIMEOUT)
     except KeyboardInterrupt:
         return
     finally:
+        tshrag.close()
+        sock.unlink(missing_ok=True)
         daemon_lock.release()
 
 
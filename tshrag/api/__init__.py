@@ -4,6 +4,7 @@
 from .test import TestAPI
 
 from .metric import UpdateMetricEntry
+from .metric import UpdateMetricFrame
 from .metric import MetricAPI
 from .metric import MetricWsAPI
 
@@ -13,6 +14,7 @@ from .report import ReportAPI
 __all__ = [
     "TestAPI",
     "UpdateMetricEntry",
+    "UpdateMetricFrame",
     "MetricAPI",
     "MetricWsAPI",
     "ReportAPI",
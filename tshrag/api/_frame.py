@@ -0,0 +1,131 @@
+# -*- coding: UTF-8 -*-
+
+
+from typing import Any, Iterable, List, Optional, Tuple
+import json
+import struct
+
+
+
+# Binary metric frame, all integers little-endian:
+#   frame   := seq:u64 nupdate:u16 update*
+#   update  := key:str16 ndut:u16 dut:str16* nentry:u32 entry*
+#   entry   := time:i64 duration:i64 vtype:u8 value
+# Times and durations are integer microseconds, values are encoded by the
+# vtype tags below, str16 is a u16 length followed by UTF-8 bytes.
+
+VTYPE_NONE = 0
+VTYPE_BOOL = 1
+VTYPE_INT = 2
+VTYPE_FLOAT = 3
+VTYPE_STR = 4
+VTYPE_BYTES = 5
+VTYPE_JSON = 6
+
+_FRAME = struct.Struct("<QH")
+_U16 = struct.Struct("<H")
+_U32 = struct.Struct("<I")
+_SPAN = struct.Struct("<qq")
+_ENTRY = struct.Struct("<qqB")
+_BOOL = struct.Struct("<?")
+_INT = struct.Struct("<q")
+_FLOAT = struct.Struct("<d")
+
+_INT_MIN = -2 ** 63
+_INT_MAX = 2 ** 63 - 1
+
+
+def _pack_str16(value: str) -> bytes:
+    _raw = str(value).encode()
+    return _U16.pack(len(_raw)) + _raw
+
+
+def _pack_value(value: Any) -> bytes:
+    if value is None:
+        return bytes([VTYPE_NONE])
+    if isinstance(value, bool):
+        return bytes([VTYPE_BOOL]) + _BOOL.pack(value)
+    if isinstance(value, int) and _INT_MIN <= value <= _INT_MAX:
+        return bytes([VTYPE_INT]) + _INT.pack(value)
+    if isinstance(value, float):
+        return bytes([VTYPE_FLOAT]) + _FLOAT.pack(value)
+    if isinstance(value, str):
+        _raw = value.encode()
+        return bytes([VTYPE_STR]) + _U32.pack(len(_raw)) + _raw
+    if isinstance(value, (bytes, bytearray)):
+        return bytes([VTYPE_BYTES]) + _U32.pack(len(value)) + bytes(value)
+    _raw = json.dumps(value, default=str).encode()
+    return bytes([VTYPE_JSON]) + _U32.pack(len(_raw)) + _raw
+
+
+def encode_frame(
+    seq             : int,
+    updates         : Iterable[Tuple[str, Iterable[str], Iterable[Tuple[int, int, Any]]]],
+) -> bytes:
+    _updates = list(updates)
+    _parts = [_FRAME.pack(seq, len(_updates))]
+    for _key, _dut, _entries in _updates:
+        _dut = list(_dut)
+        _entries = list(_entries)
+        _parts.append(_pack_str16(_key))
+        _parts.append(_U16.pack(len(_dut)))
+        _parts.extend(_pack_str16(_d) for _d in _dut)
+        _parts.append(_U32.pack(len(_entries)))
+        for _time, _duration, _value in _entries:
+            _parts.append(_SPAN.pack(_time, _duration))
+            _parts.append(_pack_value(_value))
+    return b"".join(_parts)
+
+
+def peek_seq(data: bytes) -> Optional[int]:
+    if len(data) < _FRAME.size:
+        return None
+    return _FRAME.unpack_from(data)[0]
+
+
+def decode_frame(data: bytes) -> Tuple[int, List[Tuple[str, List[str], List[Tuple[int, int, Any]]]]]:
+    _view = memoryview(data)
+    _offset = 0
+
+    def _take(size: int) -> memoryview:
+        nonlocal _offset
+        if _offset + size > len(_view):
+            raise ValueError("Truncated metric frame")
+        _offset += size
+        return _view[_offset - size:_offset]
+
+    def _unpack(fmt: struct.Struct) -> tuple:
+        return fmt.unpack(_take(fmt.size))
+
+    def _str16() -> str:
+        return str(_take(_unpack(_U16)[0]), "utf-8")
+
+    seq, _nupdate = _unpack(_FRAME)
+    updates = []
+    for _ in range(_nupdate):
+        _key = _str16()
+        _dut = [_str16() for _ in range(_unpack(_U16)[0])]
+        _entries = []
+        for _ in range(_unpack(_U32)[0]):
+            _time, _duration, _vtype = _unpack(_ENTRY)
+            if _vtype == VTYPE_NONE:
+                _value = None
+            elif _vtype == VTYPE_BOOL:
+                _value = _unpack(_BOOL)[0]
+            elif _vtype == VTYPE_INT:
+                _value = _unpack(_INT)[0]
+            elif _vtype == VTYPE_FLOAT:
+                _value = _unpack(_FLOAT)[0]
+            elif _vtype == VTYPE_STR:
+                _value = str(_take(_unpack(_U32)[0]), "utf-8")
+            elif _vtype == VTYPE_BYTES:
+                _value = bytes(_take(_unpack(_U32)[0]))
+            elif _vtype == VTYPE_JSON:
+                _value = json.loads(str(_take(_unpack(_U32)[0]), "utf-8"))
+            else:
+                raise ValueError(f"Unknown value type: {_vtype}")
+            _entries.append((_time, _duration, _value))
+        updates.append((_key, _dut, _entries))
+    if _offset != len(_view):
+        raise ValueError("Trailing bytes in metric frame")
+    return seq, updates
@@ -1,12 +1,19 @@
 # -*- coding: UTF-8 -*-
 
 
+from typing import Union, Optional, Callable
 from typing import AsyncIterable, Iterable
 from typing import Tuple, List, Set, Dict, Any
 
+import os
 import json
+import time
+import socket
+import sqlite3
 import asyncio
+from collections import deque
 from dataclasses import asdict
+from threading import Lock
 
 import httpx
 import websockets
@@ -15,8 +22,34 @@ from ..core import Time
 from ..core import Identifier, TestId, JobId, DutId
 from ..core import MetricKey, MetricInfo, MetricEntry
 from ..core import MetricDB
+from ..core import parse_duration
+
+from ..util.config import Config
+from ..util.config import CONFIG
+
+from ..util.consts import TIMEOUT
+from ..util.consts import CONCURRENCY
+from ..util.consts import SERVICE_PORT
+from ..util.consts import ROOT_CWD
+from ..util.consts import PATH_DOT_TSHRAG
+from ..util.consts import PATH_SOCKET
+from ..util.consts import ENV_HOST
+from ..util.consts import ENV_SOCKET
+from ..util.consts import ENV_TEST_ID
+from ..util.consts import ENV_TEST_MDB
 
 from .metric import UpdateMetricEntry
+from .metric import UpdateMetricFrame
+from .metric import WS_FORMATS
+from .metric import WS_ACKS
+from ._frame import encode_frame
+
+
+
+WS_FRAME = 1000
+WS_CREDIT = 10_000
+WS_POLICIES = {"block", "drop"}
+TRANSPORTS = {"auto", "network"}
 
 
 
@@ -25,20 +58,797 @@ async def _aiterable(iterable: Iterable) -> AsyncIterable:
         yield item
 
 
+def _dumps(obj: Any) -> bytes:
+    return json.dumps(obj, default=str).encode()
+
+
+def _chunks(items: List[Any], size: int) -> Iterable[List[Any]]:
+    for _i in range(0, len(items), size):
+        yield items[_i:_i + size]
+
+
+def _is_local_host(host: str) -> bool:
+    _name = host.rsplit(":", 1)[0]
+    return _name in {"localhost", "127.0.0.1", "::1", "[::1]", socket.gethostname()}
+
+
+# The daemon's Unix socket: the configured one, then TSHRAG_SOCKET of a job
+# environment, then the one under .tshrag of the working directory.
+def _find_socket(uds: Optional[str]) -> Optional[str]:
+    if not hasattr(socket, "AF_UNIX"):
+        return None
+    _paths = [uds, os.environ.get(ENV_SOCKET)]
+    if not ROOT_CWD is None:
+        _paths.append(os.path.join(ROOT_CWD, PATH_DOT_TSHRAG, PATH_SOCKET))
+    for _path in _paths:
+        if _path and os.path.exists(_path):
+            return _path
+    return None
+
+
+
+# A version 2 metric WebSocket that survives disconnects: with acks, every
+# frame is kept until the server acknowledges it and is sent again after a
+# reconnect, so entries are delivered at least once.
+class _MetricStream:
+
+    def __init__(
+        self,
+        url         : str,
+        format      : str,
+        ack         : str,
+        credit      : int,
+        policy      : str,
+        retries     : int,
+        retry_delay : float,
+        uds         : Optional[str]         = None,
+        on_host     : Callable[[], None]    = None,
+    ):
+        self._url = f"{url}?version=2&format={format}&ack={ack}"
+        if credit:
+            self._url += f"&credit={credit}"
+        self._binary = format == "binary"
+        self._ack = ack != "none"
+        self._credit = credit
+        self._policy = policy
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._uds = uds
+        self._on_host = on_host
+        self._conn = None
+        self._reader = None
+        self._changed = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._seq = 0
+        self._unacked = deque()
+        self._granted = None
+        self._full = False
+        self._sent = 0
+        self._counts: Dict[int, int] = {}
+        self._error = None
+        self._failures = 0
+        self.stats = {
+            "frames"            : 0,
+            "entries"           : 0,
+            "dropped"           : 0,
+            "throttled"         : 0,
+            "throttled_seconds" : 0.0,
+            "reconnects"        : 0,
+        }
+
+
+    async def _read(self, conn):
+        try:
+            async for _message in conn:
+                _message = json.loads(_message)
+                if "error" in _message:
+                    self._error = ValueError(f"Frame {_message['seq']} rejected: {_message['error']}")
+                    self._unacked = deque(_f for _f in self._unacked if _f[0] != _message["seq"])
+                    # A rejected frame used no credits on the server.
+                    self._sent -= self._counts.pop(_message["seq"], 0)
+                if "credit" in _message:
+                    self._granted = _message["credit"]
+                    self._full = _message.get("full", False)
+                if "ack" in _message:
+                    while self._unacked and self._unacked[0][0] <= _message["ack"]:
+                        self._unacked.popleft()
+                    for _seq in [_s for _s in self._counts if _s <= _message["ack"]]:
+                        del self._counts[_seq]
+                self._changed.set()
+        finally:
+            self._changed.set()
+
+
+    async def _wait(self, ready: Callable[[], bool]):
+        while True:
+            if not self._error is None:
+                _error, self._error = self._error, None
+                raise _error
+            if ready():
+                return
+            if self._reader.done():
+                raise ConnectionError("Metric stream closed")
+            self._changed.clear()
+            await self._changed.wait()
+
+
+    async def _connect(self):
+        if not self._conn is None:
+            return
+        if self._uds:
+            try:
+                self._conn = await websockets.unix_connect(self._uds, self._url)
+            except (ConnectionRefusedError, FileNotFoundError) as e:
+                # A stale socket of a crashed daemon: the host is tried
+                # instead and used from then on.
+                self._uds = None
+                if not self._on_host is None:
+                    self._on_host()
+        if self._conn is None:
+            self._conn = await websockets.connect(self._url)
+        self._granted = None
+        self._full = False
+        self._sent = 0
+        self._counts = {}
+        self._reader = asyncio.create_task(self._read(self._conn))
+        for _seq, _count, _data in list(self._unacked):
+            await self._transmit(_seq, _count, _data)
+
+
+    async def _disconnect(self):
+        _conn, self._conn = self._conn, None
+        if not self._reader is None:
+            self._reader.cancel()
+        if not _conn is None:
+            try:
+                await _conn.close()
+            except Exception as e:
+                pass
+
+
+    async def _recover(self, error: Exception):
+        await self._disconnect()
+        self._failures += 1
+        if self._failures > self._retries:
+            raise ConnectionError(f"Metric stream failed after {self._retries} retries") from error
+        self.stats["reconnects"] += 1
+        await asyncio.sleep(self._retry_delay * 2 ** (self._failures - 1))
+
+
+    async def _retry(self, func: Callable):
+        while True:
+            try:
+                await self._connect()
+                _result = await func()
+                self._failures = 0
+                return _result
+            except (OSError, ConnectionError, websockets.ConnectionClosed, websockets.InvalidHandshake) as e:
+                await self._recover(e)
+
+
+    async def _transmit(self, seq: int, count: int, data: Union[str, bytes]):
+        if self._credit:
+            await self._wait(lambda: not self._granted is None and self._granted - self._sent >= count)
+            self._counts[seq] = count
+            # Without acks only errors settle a frame, recent ones will do.
+            if not self._ack and len(self._counts) > self._credit:
+                del self._counts[next(iter(self._counts))]
+        self._sent += count
+        await self._conn.send(data)
+
+
+    def _encode(self, seq: int, key: MetricKey, dut: List[str], entries: List[MetricEntry]) -> Union[str, bytes]:
+        if self._binary:
+            return encode_frame(seq, [(
+                key,
+                dut,
+                [(int(_entry.time), _entry.duration, _entry.value) for _entry in entries],
+            )])
+        return json.dumps(asdict(UpdateMetricFrame(seq, [UpdateMetricEntry(key, dut, entries)])), default=str)
+
+
+    async def _send(self, key: MetricKey, dut: List[str], entries: List[MetricEntry]):
+        while entries:
+            _allowed = len(entries)
+            if self._credit:
+                await self._wait(lambda: not self._granted is None)
+                _allowed = self._granted - self._sent
+            if _allowed <= 0:
+                # Out of credits: wait for the next top-up, or with the drop
+                # policy drop once the server reports its ingest queue full.
+                if self._policy == "drop" and self._full:
+                    self.stats["throttled"] += 1
+                    self.stats["dropped"] += len(entries)
+                    entries.clear()
+                    return
+                _t0 = time.monotonic()
+                await self._wait(lambda: self._granted > self._sent or (self._policy == "drop" and self._full))
+                if self._granted <= self._sent:
+                    continue
+                self.stats["throttled"] += 1
+                self.stats["throttled_seconds"] += time.monotonic() - _t0
+                continue
+            _part = entries[:_allowed]
+            del entries[:_allowed]
+            self._seq += 1
+            _data = self._encode(self._seq, key, dut, _part)
+            if self._ack:
+                self._unacked.append((self._seq, len(_part), _data))
+            self.stats["frames"] += 1
+            self.stats["entries"] += len(_part)
+            await self._transmit(self._seq, len(_part), _data)
+
+
+    async def send(
+        self,
+        key         : MetricKey,
+        dut         : List[str],
+        entries     : Iterable[MetricEntry],
+    ) -> None:
+        _entries = list(entries)
+        async with self._lock:
+            await self._retry(lambda: self._send(key, dut, _entries))
+
+
+    async def drain(self) -> None:
+        if not self._ack:
+            return
+        async with self._lock:
+            await self._retry(lambda: self._wait(lambda: not self._unacked))
+
+
+    async def close(self) -> None:
+        async with self._lock:
+            await self._disconnect()
+
+
+
+class _TshragClient:
+
+    def __init__(
+        self,
+        host        : str                   = None,
+        timeout     : float                 = TIMEOUT,
+        connections : int                   = CONCURRENCY,
+        frame       : int                   = WS_FRAME,
+        format      : str                   = "json",
+        ack         : str                   = "window",
+        credit      : int                   = WS_CREDIT,
+        policy      : str                   = "block",
+        retries     : int                   = 3,
+        retry_delay : str                   = "500ms",
+        transport   : str                   = "auto",
+        uds         : str                   = None,
+        config      : Config                = CONFIG,
+    ):
+        self._host = ""
+        self._uds = ""
+        self._timeout = float(timeout)
+        self._connections = connections
+        self._frame = frame
+        self._format = format
+        self._ack = ack
+        self._credit = credit
+        self._policy = policy
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._transport = transport
+        self._local: Dict[TestId, Optional[MetricDB]] = {}
+
+        if not config is None:
+            config.pick_to(TshragClient.__name__, self)
+        # An explicit host wins, then the daemon's TSHRAG_HOST of a job
+        # environment, then the configured host.
+        self._host = host or os.environ.get(ENV_HOST) or self._host or f"localhost:{SERVICE_PORT}"
+        # A daemon on this host is reached through its Unix socket when it
+        # has one, the host only names it in URLs then.
+        self._uds = _find_socket(uds or self._uds) if _is_local_host(self._host) else None
+        if not self._format in WS_FORMATS:
+            raise ValueError(f"Unknown frame format: {self._format}")
+        if not self._ack in WS_ACKS:
+            raise ValueError(f"Unknown ack mode: {self._ack}")
+        if not self._policy in WS_POLICIES:
+            raise ValueError(f"Unknown flow control policy: {self._policy}")
+        if not self._transport in TRANSPORTS:
+            raise ValueError(f"Unknown transport: {self._transport}")
+
+
+    @property
+    def host(self) -> str:
+        return self._host
+
+
+    @property
+    def uds(self) -> Optional[str]:
+        return self._uds
+
+
+    # A socket path can outlive a crashed daemon and refuse connections,
+    # the first failure to connect through it switches over to the host.
+    def _use_host(self) -> None:
+        self._uds = None
+
+
+    # A job on the daemon's host writes straight into its test's metric
+    # database, advertised by TSHRAG_TEST_MDB, as an attached MetricDB.
+    # Anything else, or any failure to open or write it, uses the network.
+    def _local_mdb(self, test_id: TestId) -> Optional[MetricDB]:
+        if self._transport == "network":
+            return None
+        if not test_id in self._local:
+            _path = os.environ.get(ENV_TEST_MDB)
+            _mdb = None
+            if (
+                os.environ.get(ENV_TEST_ID) == test_id
+                and _path
+                and _is_local_host(self._host)
+                and os.access(_path, os.R_OK | os.W_OK)
+                and os.access(os.path.dirname(_path), os.W_OK)
+            ):
+                try:
+                    _mdb = MetricDB(_path, attach=True)
+                except (OSError, RuntimeError, sqlite3.Error) as e:
+                    _mdb = None
+            self._local[test_id] = _mdb
+        return self._local[test_id]
+
+
+    def _write_local(
+        self,
+        test_id     : TestId,
+        key         : MetricKey,
+        entries     : List[MetricEntry],
+        dut         : Set[str],
+    ) -> bool:
+        _test_id = TestId(test_id)
+        _mdb = self._local_mdb(_test_id)
+        if _mdb is None:
+            return False
+        _key = MetricKey(key)
+        _dut = set(dut) if dut else set()
+        try:
+            _mdb.add_metric_entries((_key, _entry, _test_id, _dut) for _entry in entries)
+        except (OSError, sqlite3.Error) as e:
+            # A failed write has committed nothing, it is retried over the
+            # network and so is everything after it.
+            self._local[_test_id] = None
+            _mdb.close()
+            return False
+        return True
+
+
+    def _close_local(self):
+        _local, self._local = self._local, {}
+        for _mdb in _local.values():
+            if not _mdb is None:
+                _mdb.close()
+
+
+    def _http_kwargs(self, transport: type) -> Dict[str, Any]:
+        return {
+            "base_url"  : f"http://{self._host}/api/v1",
+            "timeout"   : self._timeout,
+            "transport" : transport(
+                uds = self._uds,
+                limits = httpx.Limits(
+                    max_connections = self._connections,
+                    max_keepalive_connections = self._connections,
+                ),
+            ),
+        }
+
+
+    def _info_request(self, test_id: TestId, info: MetricInfo) -> Dict[str, Any]:
+        return {
+            "url"       : f"/metric/{TestId(test_id)}/info/{MetricKey(info.key)}",
+            "content"   : _dumps({"name": info.name, "description": info.description}),
+            "headers"   : {"Content-Type": "application/json"},
+        }
+
+
+    def _entry_requests(
+        self,
+        test_id     : TestId,
+        key         : MetricKey,
+        entries     : List[MetricEntry],
+        dut         : Set[str],
+    ) -> Iterable[Dict[str, Any]]:
+        for _chunk in _chunks(entries, self._frame):
+            yield {
+                "url"       : f"/metric/{TestId(test_id)}/entry/{MetricKey(key)}",
+                "params"    : {"dut": list(dut) if dut else []},
+                "content"   : _dumps([asdict(_entry) for _entry in _chunk]),
+                "headers"   : {"Content-Type": "application/json"},
+            }
+
+
+    def _query_params(
+        self,
+        dut         : Set[str],
+        start_time  : Time,
+        end_time    : Time,
+    ) -> Dict[str, Any]:
+        _params = {"dut": list(dut) if dut else []}
+        if not start_time is None:
+            _params["start_time"] = str(Time(start_time))
+        if not end_time is None:
+            _params["end_time"] = str(Time(end_time))
+        return _params
+
+
+    def _stream(self, test_id: TestId) -> _MetricStream:
+        return _MetricStream(
+            f"ws://{self._host}/wsapi/v1/metric/{TestId(test_id)}/entry",
+            self._format,
+            self._ack,
+            self._credit,
+            self._policy,
+            self._retries,
+            parse_duration(self._retry_delay) / Time.UNIT_RATE,
+            self._uds,
+            self._use_host,
+        )
+
+
+
+class TshragClient(_TshragClient):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._http = httpx.Client(**self._http_kwargs(httpx.HTTPTransport))
+        self._http_lock = Lock()
+        # Streams run on a loop of this client's own, its async client keeps
+        # the WebSocket of each test open between calls.
+        self._loop = None
+        self._client = None
+        self._stream_lock = Lock()
+
+
+    def __enter__(self) -> "TshragClient":
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def close(self):
+        with self._stream_lock:
+            _loop, self._loop = self._loop, None
+            _client, self._client = self._client, None
+            if not _loop is None:
+                try:
+                    _loop.run_until_complete(_client.aclose())
+                finally:
+                    _loop.close()
+        self._close_local()
+        self._http.close()
+
+
+    def _use_host(self) -> None:
+        with self._http_lock:
+            if not self._uds:
+                return
+            super()._use_host()
+            _http, self._http = self._http, httpx.Client(**self._http_kwargs(httpx.HTTPTransport))
+        _http.close()
+
+
+    def _request(self, method: str, **kwargs) -> Dict[str, Any]:
+        _http = self._http
+        try:
+            _resp = _http.request(method, **kwargs)
+        except httpx.ConnectError as e:
+            if not self._uds and _http is self._http:
+                raise
+            self._use_host()
+            _resp = self._http.request(method, **kwargs)
+        _resp.raise_for_status()
+        return _resp.json()
+
+
+    def update_metric_info(
+        self,
+        test_id     : TestId,
+        info        : MetricInfo,
+    ) -> None:
+        self._request("POST", **self._info_request(test_id, info))
+
+
+    def query_metric_info(
+        self,
+        test_id     : TestId,
+        key         : MetricKey,
+    ) -> MetricInfo:
+        _resp = self._request("GET", url=f"/metric/{TestId(test_id)}/info/{MetricKey(key)}")
+        return MetricInfo(**_resp["info"])
+
+
+    def add_metric_entry(
+        self,
+        test_id     : TestId,
+        key         : MetricKey,
+        entry       : MetricEntry,
+        dut         : Set[str]              = None,
+    ) -> None:
+        self.batch_add_metric_entry(test_id, key, [entry], dut)
+
+
+    def batch_add_metric_entry(
+        self,
+        test_id     : TestId,
+        key         : MetricKey,
+        entries     : Iterable[MetricEntry],
+        dut         : Set[str]              = None,
+    ) -> None:
+        _entries = list(entries)
+        if self._write_local(test_id, key, _entries, dut):
+            return
+        for _request in self._entry_requests(test_id, key, _entries, dut):
+            self._request("POST", **_request)
+
+
+    def query_metric_entry(
+        self,
+        test_id     : TestId,
+        key         : MetricKey,
+        dut         : Set[str]              = None,
+        start_time  : Time                  = None,
+        end_time    : Time                  = None,
+    ) -> List[MetricEntry]:
+        _resp = self._request(
+            "GET",
+            url=f"/metric/{TestId(test_id)}/entry/{MetricKey(key)}",
+            params=self._query_params(dut, start_time, end_time),
+        )
+        return [MetricEntry(**_entry) for _entry in _resp["entries"]]
+
+
+    def query_metric_statistic(
+        self,
+        test_id     : TestId,
+        statistic   : str,
+        key         : MetricKey,
+        dut         : Set[str]              = None,
+        start_time  : Time                  = None,
+        end_time    : Time                  = None,
+    ) -> Any:
+        _resp = self._request(
+            "GET",
+            url=f"/metric/{TestId(test_id)}/{statistic}/{MetricKey(key)}",
+            params=self._query_params(dut, start_time, end_time),
+        )
+        return _resp["statistic"]
+
+
+    def stream_metric_entry(
+        self,
+        test_id     : TestId,
+        key         : MetricKey,
+        entries     : Iterable[MetricEntry],
+        dut         : Set[str]              = None,
+    ) -> Dict[str, Any]:
+        _entries = list(entries)
+        if self._write_local(test_id, key, _entries, dut):
+            return {"frames": 0, "entries": len(_entries), "local": True}
+        with self._stream_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._client = AsyncTshragClient(self._host, config=None, **self._stream_kwargs())
+            try:
+                return self._loop.run_until_complete(
+                    self._client.stream_metric_entry(test_id, key, _entries, dut)
+                )
+            finally:
+                if self._uds and not self._client.uds:
+                    self._use_host()
+
+
+    def _stream_kwargs(self) -> Dict[str, Any]:
+        return {
+            "frame"         : self._frame,
+            "format"        : self._format,
+            "ack"           : self._ack,
+            "credit"        : self._credit,
+            "policy"        : self._policy,
+            "retries"       : self._retries,
+            "retry_delay"   : self._retry_delay,
+            "transport"     : "network",
+            "uds"           : self._uds,
+        }
+
+
+
+class AsyncTshragClient(_TshragClient):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._http = httpx.AsyncClient(**self._http_kwargs(httpx.AsyncHTTPTransport))
+        self._retired: List[httpx.AsyncClient] = []
+        self._streams: Dict[TestId, _MetricStream] = {}
+
+
+    async def __aenter__(self) -> "AsyncTshragClient":
+        return self
+
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+
+    async def aclose(self):
+        _streams, self._streams = self._streams, {}
+        try:
+            for _stream in _streams.values():
+                await _stream.drain()
+        finally:
+            for _stream in _streams.values():
+                await _stream.close()
+            self._close_local()
+            _retired, self._retired = self._retired, []
+            for _http in _retired + [self._http]:
+                await _http.aclose()
+
+
+    # Requests in flight may still hold the socket's client, it is closed
+    # along with the client.
+    def _use_host(self) -> None:
+        if not self._uds:
+            return
+        super()._use_host()
+        self._retired.append(self._http)
+        self._http = httpx.AsyncClient(**self._http_kwargs(httpx.AsyncHTTPTransport))
+
+
+    async def _request(self, method: str, **kwargs) -> Dict[str, Any]:
+        _http = self._http
+        try:
+            _resp = await _http.request(method, **kwargs)
+        except httpx.ConnectError as e:
+            if not self._uds and _http is self._http:
+                raise
+            self._use_host()
+            _resp = await self._http.request(method, **kwargs)
+        _resp.raise_for_status()
+        return _resp.json()
+
+
+    async def update_metric_info(
+        self,
+        test_id     : TestId,
+        info        : MetricInfo,
+    ) -> None:
+        await self._request("POST", **self._info_request(test_id, info))
+
+
+    async def query_metric_info(
+        self,
+        test_id     : TestId,
+        key         : MetricKey,
+    ) -> MetricInfo:
+        _resp = await self._request("GET", url=f"/metric/{TestId(test_id)}/info/{MetricKey(key)}")
+        return MetricInfo(**_resp["info"])
+
+
+    async def add_metric_entry(
+        self,
+        test_id     : TestId,
+        key         : MetricKey,
+        entry       : MetricEntry,
+        dut         : Set[str]              = None,
+    ) -> None:
+        await self.batch_add_metric_entry(test_id, key, [entry], dut)
+
+
+    async def batch_add_metric_entry(
+        self,
+        test_id     : TestId,
+        key         : MetricKey,
+        entries     : Iterable[MetricEntry],
+        dut         : Set[str]              = None,
+    ) -> None:
+        _entries = list(entries)
+        if await asyncio.to_thread(self._write_local, test_id, key, _entries, dut):
+            return
+        for _request in self._entry_requests(test_id, key, _entries, dut):
+            await self._request("POST", **_request)
+
+
+    async def query_metric_entry(
+        self,
+        test_id     : TestId,
+        key         : MetricKey,
+        dut         : Set[str]              = None,
+        start_time  : Time                  = None,
+        end_time    : Time                  = None,
+    ) -> List[MetricEntry]:
+        _resp = await self._request(
+            "GET",
+            url=f"/metric/{TestId(test_id)}/entry/{MetricKey(key)}",
+            params=self._query_params(dut, start_time, end_time),
+        )
+        return [MetricEntry(**_entry) for _entry in _resp["entries"]]
+
+
+    async def query_metric_statistic(
+        self,
+        test_id     : TestId,
+        statistic   : str,
+        key         : MetricKey,
+        dut         : Set[str]              = None,
+        start_time  : Time                  = None,
+        end_time    : Time                  = None,
+    ) -> Any:
+        _resp = await self._request(
+            "GET",
+            url=f"/metric/{TestId(test_id)}/{statistic}/{MetricKey(key)}",
+            params=self._query_params(dut, start_time, end_time),
+        )
+        return _resp["statistic"]
+
+
+    # Entries are streamed over one WebSocket per test, kept open across
+    # calls; the call returns once every frame is acknowledged. Local
+    # writes commit each frame to the test's database instead.
+    async def stream_metric_entry(
+        self,
+        test_id     : TestId,
+        key         : MetricKey,
+        entries     : Union[Iterable[MetricEntry], AsyncIterable[MetricEntry]],
+        dut         : Set[str]              = None,
+    ) -> Dict[str, Any]:
+        _test_id = TestId(test_id)
+        _key = MetricKey(key)
+        _dut = list(dut) if dut else []
+        _stream = None
+        _local = 0
+
+        async def _send(buffer: List[MetricEntry]):
+            nonlocal _stream, _local
+            if _stream is None:
+                if await asyncio.to_thread(self._write_local, _test_id, _key, buffer, _dut):
+                    _local += len(buffer)
+                    return
+                if not _test_id in self._streams:
+                    self._streams[_test_id] = self._stream(_test_id)
+                _stream = self._streams[_test_id]
+            await _stream.send(_key, _dut, buffer)
+
+        if not hasattr(entries, "__aiter__"):
+            entries = _aiterable(entries)
+        _buffer = []
+        async for entry in entries:
+            _buffer.append(entry)
+            if len(_buffer) >= self._frame:
+                await _send(_buffer)
+                _buffer = []
+        if _buffer:
+            await _send(_buffer)
+        if _stream is None:
+            return {"frames": 0, "entries": _local, "local": True}
+        await _stream.drain()
+        return dict(_stream.stats)
+
+
+
+_client = None
+_client_lock = Lock()
+
+def _get_client() -> TshragClient:
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = TshragClient()
+        return _client
+
+
 
 def update_metric_info(
     test_id         : TestId,
     info            : MetricInfo
 ):
-    # TODO: Fix URL
-    _http = httpx.Client(...)
-    _test_id = TestId(test_id)
-    _resp = _http.post(
-        f"/metric/{_test_id}/info",
-        json=asdict(info),
-    )
-    _resp.raise_for_status()
-    return MetricInfo(**_resp.json())
+    _get_client().update_metric_info(test_id, info)
+    return info
 
 
 def add_metric_entry(
@@ -47,21 +857,8 @@ def add_metric_entry(
     entry           : MetricEntry,
     dut             : Set[str]              = None,
 ):
-    # TODO: Fix URL
-    _http = httpx.Client(...)
-    _test_id = TestId(test_id)
-    _key = MetricKey(key)
-    _dut = list(dut) if dut else []
-    _resp = _http.post(
-        f"/metric/{_test_id}/entry",
-        params={
-            "key": _key,
-            "dut": _dut,
-        },
-        json=asdict(entry),
-    )
-    _resp.raise_for_status()
-    return MetricEntry(**_resp.json())
+    _get_client().add_metric_entry(test_id, key, entry, dut)
+    return entry
 
 
 async def abatch_add_metric_entry(
@@ -69,19 +866,20 @@ async def abatch_add_metric_entry(
     key             : MetricKey,
     entries         : AsyncIterable[MetricEntry],
     dut             : Set[str]              = None,
-):
-    _test_id = TestId(test_id)
-    _key = MetricKey(key)
-    _dut = list(dut) if dut else []
-    # TODO: Fix URL
-    async with websockets.connect(...) as conn:
-        async for entry in entries:
-            request = UpdateMetricEntry(
-                _key,
-                _dut,
-                [entry]
-            )
-            await conn.send(json.dumps(asdict(request), default=str))
+    frame           : int                   = WS_FRAME,
+    ack             : bool                  = True,
+    binary          : bool                  = False,
+    credit          : int                   = WS_CREDIT,
+    policy          : str                   = "block",
+) -> Dict[str, Any]:
+    async with AsyncTshragClient(
+        frame = frame,
+        format = "binary" if binary else "json",
+        ack = "window" if ack else "none",
+        credit = credit,
+        policy = policy,
+    ) as client:
+        return await client.stream_metric_entry(test_id, key, entries, dut)
 
 
 def batch_add_metric_entry(
@@ -93,5 +891,3 @@ def batch_add_metric_entry(
     return asyncio.run(
         abatch_add_metric_entry(test_id, key, _aiterable(entries), dut)
     )
-
-
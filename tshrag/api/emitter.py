@@ -0,0 +1,420 @@
+# -*- coding: UTF-8 -*-
+
+
+from typing import Union, Optional
+from typing import Tuple, List, Set, Dict, Any
+
+import os
+import atexit
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock, Event
+from time import monotonic, sleep, time_ns
+
+import httpx
+import websockets
+from portalocker import AlreadyLocked
+
+from ..core import Time
+from ..core import TestId
+from ..core import MetricKey, MetricEntry
+from ..core import parse_duration
+from ..core.metric._ingest import IngestQueue
+from ..core.metric._ring import MetricRing
+from ..core.metric._ring import KEY_SIZE
+from ..core.metric._ring import fits_record
+
+from ..util.config import Config
+from ..util.config import CONFIG
+
+from ..util.consts import SYM_TSHRAG
+from ..util.consts import TIMEOUT
+from ..util.consts import ENV_TEST_ID
+from ..util.consts import ENV_JOB_RING
+
+from .metric import UpdateMetricEntry
+from .client import AsyncTshragClient
+from .client import WS_FRAME
+
+
+
+# Runs executor jobs of the emitter's loop, DNS lookups and local writes,
+# right on its writer thread: no thread can be started any more when the
+# last entries are flushed at exit.
+class _InlineExecutor(ThreadPoolExecutor):
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        _future = Future()
+        try:
+            _future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            _future.set_exception(e)
+        return _future
+
+
+
+# Entries are buffered in memory and streamed to the daemon from a
+# background thread, so emitting never waits on the network unless the
+# buffer is full and the policy is block. While the daemon is unreachable
+# the writer retries its batch with backoff and the buffer keeps taking
+# entries under its policy; neither emitting nor closing raises for it.
+class MetricEmitter:
+
+    BATCH = WS_FRAME
+    DELAY = "100ms"
+    CAPACITY = 100_000
+    RETRY_DELAY = "500ms"
+    RETRY_MAX = "30s"
+    ERRORS = (OSError, httpx.TransportError, websockets.WebSocketException)
+
+    def __init__(
+        self,
+        test_id     : TestId                = None,
+        host        : str                   = None,
+        policy      : str                   = "drop_oldest",
+        config      : Config                = CONFIG,
+    ):
+        if test_id is None:
+            test_id = os.environ.get(ENV_TEST_ID)
+        if not test_id:
+            raise ValueError(f"No test id given and {ENV_TEST_ID} is not set")
+        self._test_id = TestId(test_id)
+        self._host = host
+        self._config = config
+        self._batch = MetricEmitter.BATCH
+        self._delay = MetricEmitter.DELAY
+        self._capacity = MetricEmitter.CAPACITY
+        self._retry_delay = MetricEmitter.RETRY_DELAY
+        self._retry_max = MetricEmitter.RETRY_MAX
+        self._policy = policy
+
+        if not config is None:
+            config.pick_to(MetricEmitter.__name__, self)
+        self._queue = IngestQueue(
+            self._write,
+            self._batch,
+            parse_duration(self._delay) / Time.UNIT_RATE,
+            self._capacity,
+            name = f"{SYM_TSHRAG}_emitter_{self._test_id}",
+            policy = self._policy,
+            split = False,
+        )
+        self._keys: Dict[str, MetricKey] = {}
+        self._loop = None
+        self._client = None
+        self._closed = False
+        self._abandon = Event()
+        self._errors = 0
+        self._lost = 0
+        self._last_error = None
+        self._lock = Lock()
+        atexit.register(self.close)
+
+
+    def __enter__(self) -> "MetricEmitter":
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    @property
+    def test_id(self) -> TestId:
+        return self._test_id
+
+
+    # Runs on the queue's writer thread, which owns the event loop and the
+    # client with its WebSocket across batches. The client does not retry
+    # on its own, a failed update is sent again by a fresh client. Updates
+    # are sent one by one, so the error of each row is returned instead of
+    # raised: a rejected update must not send the others again.
+    def _write(self, rows: List[Tuple[MetricKey, Tuple[str, ...], MetricEntry]]) -> List[Optional[Exception]]:
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            self._loop.set_default_executor(_InlineExecutor())
+        _updates: Dict[Tuple[MetricKey, Tuple[str, ...]], Tuple[UpdateMetricEntry, List[int]]] = {}
+        for _i, (_key, _dut, _entry) in enumerate(rows):
+            if not (_key, _dut) in _updates:
+                _updates[(_key, _dut)] = (UpdateMetricEntry(_key, list(_dut)), [])
+            _updates[(_key, _dut)][0].entries.append(_entry)
+            _updates[(_key, _dut)][1].append(_i)
+        _updates = list(_updates.values())
+        _errors: List[Optional[Exception]] = [None] * len(rows)
+        _failures = 0
+        while _updates:
+            _update, _rows = _updates[0]
+            if self._abandon.is_set():
+                _error = ConnectionError(f"Metric emitter closed with the daemon unreachable: {self._last_error}")
+                for _update, _rows in _updates:
+                    for _i in _rows:
+                        _errors[_i] = _error
+                break
+            try:
+                if self._client is None:
+                    self._client = AsyncTshragClient(self._host, retries=0, config=self._config)
+                self._loop.run_until_complete(self._client.stream_metric_entry(
+                    self._test_id,
+                    _update.key,
+                    _update.entries,
+                    _update.dut,
+                ))
+                _updates.pop(0)
+                _failures = 0
+            except MetricEmitter.ERRORS as e:
+                with self._lock:
+                    self._errors += 1
+                    self._last_error = repr(e)
+                self._reset_client()
+                _delay = parse_duration(self._retry_delay) * 2 ** _failures
+                _delay = min(_delay, parse_duration(self._retry_max))
+                self._abandon.wait(_delay / Time.UNIT_RATE)
+                _failures += 1
+            except Exception as e:
+                # Rejected by the daemon: sending it again would not help.
+                with self._lock:
+                    self._last_error = repr(e)
+                for _i in _rows:
+                    _errors[_i] = e
+                _updates.pop(0)
+        return _errors
+
+
+    def _reset_client(self):
+        _client, self._client = self._client, None
+        if _client is None:
+            return
+        try:
+            self._loop.run_until_complete(_client.aclose())
+        except Exception as e:
+            pass
+
+
+    def add_metric_entry(
+        self,
+        key         : MetricKey,
+        entry       : MetricEntry,
+        dut         : Set[str]              = None,
+    ) -> None:
+        # Keys are validated once, emitting is on the workload's hot path.
+        if not key in self._keys:
+            self._keys[key] = MetricKey(key)
+        _dut = tuple(sorted(dut)) if dut else ()
+        try:
+            self._queue.put([(self._keys[key], _dut, entry)])
+        except RuntimeError as e:
+            # Closed: nothing will send the entry any more.
+            with self._lock:
+                self._lost += 1
+
+
+    def emit(
+        self,
+        key         : MetricKey,
+        value       : Any                   = None,
+        time        : Time                  = None,
+        duration    : int                   = 0,
+        dut         : Set[str]              = None,
+    ) -> None:
+        _entry = MetricEntry(Time() if time is None else time, duration, value)
+        self.add_metric_entry(key, _entry, dut)
+
+
+    def flush(
+        self,
+        timeout     : Optional[float]       = None,
+    ) -> bool:
+        return self._queue.flush(timeout)
+
+
+    def close(
+        self,
+        timeout     : Optional[float]       = TIMEOUT,
+    ) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        atexit.unregister(self.close)
+        _done = self._queue.close(timeout)
+        if not _done:
+            # Out of time with the daemon unreachable: the writer gives up
+            # retrying, the rest of the buffer is counted as failed.
+            self._abandon.set()
+            _done = self._queue.close(timeout)
+        # The loop belongs to the writer thread until it has finished.
+        if _done and not self._loop is None:
+            self._reset_client()
+            self._loop.close()
+
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self._queue.stats(),
+                "errors"    : self._errors,
+                "lost"      : self._lost,
+                "last_error": self._last_error,
+            }
+
+
+
+# Entries of a job go into the metric ring the daemon created for it, as
+# advertised by TSHRAG_JOB_RING: a record is a memory write, and a full
+# ring drops it, so emitting never waits. Entries that do not fit a ring
+# record, with DUTs, long keys or non-numeric values, go through a
+# MetricEmitter instead.
+class RingEmitter:
+
+    def __init__(
+        self,
+        ring        : str                   = None,
+        test_id     : TestId                = None,
+        host        : str                   = None,
+        config      : Config                = CONFIG,
+    ):
+        if ring is None:
+            ring = os.environ.get(ENV_JOB_RING)
+        if not ring:
+            raise ValueError(f"No ring given and {ENV_JOB_RING} is not set")
+        self._ring = MetricRing(ring)
+        try:
+            self._ring.claim()
+        except:
+            self._ring.close()
+            raise
+        self._test_id = test_id
+        self._host = host
+        self._config = config
+        self._keys: Dict[str, Optional[bytes]] = {}
+        self._fallback = None
+        self._submitted = 0
+        self._lost = 0
+        self._closed = False
+        self._lock = Lock()
+        atexit.register(self.close)
+
+
+    def __enter__(self) -> "RingEmitter":
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def _get_fallback(self) -> MetricEmitter:
+        with self._lock:
+            if self._fallback is None:
+                self._fallback = MetricEmitter(self._test_id, self._host, config=self._config)
+            return self._fallback
+
+
+    def add_metric_entry(
+        self,
+        key         : MetricKey,
+        entry       : MetricEntry,
+        dut         : Set[str]              = None,
+    ) -> None:
+        self.emit(key, entry.value, entry.time, entry.duration, dut)
+
+
+    def emit(
+        self,
+        key         : MetricKey,
+        value       : Any                   = None,
+        time        : Time                  = None,
+        duration    : int                   = 0,
+        dut         : Set[str]              = None,
+    ) -> None:
+        if not key in self._keys:
+            _raw = MetricKey(key).encode()
+            self._keys[key] = _raw if len(_raw) <= KEY_SIZE else None
+        if duration < 0:
+            raise ValueError(f"Negative duration: {duration}")
+        _key = self._keys[key]
+        _time = time_ns() // 1_000 if time is None else int(time)
+        _fallback = _key is None or dut or not fits_record(value)
+        with self._lock:
+            if self._closed:
+                # Closed: nothing will drain the entry any more.
+                self._lost += 1
+                return
+            if not _fallback:
+                self._submitted += 1
+                self._ring.put(_key, _time, int(duration), value)
+                return
+        self._get_fallback().emit(key, value, Time(_time), duration, dut)
+
+
+    # The ring is drained by the daemon, even after this process has exited;
+    # flushing waits for it to catch up.
+    def flush(
+        self,
+        timeout     : Optional[float]       = None,
+    ) -> bool:
+        _deadline = None if timeout is None else monotonic() + timeout
+        if not self._fallback is None and not self._fallback.flush(timeout):
+            return False
+        while self._ring.depth() > 0:
+            if not _deadline is None and monotonic() >= _deadline:
+                return False
+            sleep(parse_duration(MetricRing.DELAY) / Time.UNIT_RATE / 10)
+        return True
+
+
+    def close(
+        self,
+        timeout     : Optional[float]       = TIMEOUT,
+    ) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._ring.close()
+        atexit.unregister(self.close)
+        if not self._fallback is None:
+            self._fallback.close(timeout)
+
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            _stats = {
+                "submitted" : self._submitted,
+                "dropped"   : self._ring.dropped if not self._closed else None,
+                "depth"     : self._ring.depth() if not self._closed else None,
+                "capacity"  : self._ring.capacity,
+                "lost"      : self._lost,
+            }
+        if not self._fallback is None:
+            _stats["fallback"] = self._fallback.stats()
+        return _stats
+
+
+
+_emitter = None
+_emitter_lock = Lock()
+
+# Jobs started by the daemon emit into their metric ring when they can
+# claim it, anything else streams to the daemon.
+def get_emitter() -> Union[MetricEmitter, RingEmitter]:
+    global _emitter
+    with _emitter_lock:
+        if _emitter is None and os.environ.get(ENV_JOB_RING):
+            try:
+                _emitter = RingEmitter()
+            except (OSError, RuntimeError, AlreadyLocked) as e:
+                _emitter = None
+        if _emitter is None:
+            _emitter = MetricEmitter()
+        return _emitter
+
+
+def emit(
+    key             : MetricKey,
+    value           : Any                   = None,
+    time            : Time                  = None,
+    duration        : int                   = 0,
+    dut             : Set[str]              = None,
+) -> None:
+    get_emitter().emit(key, value, time, duration, dut)
@@ -5,13 +5,20 @@ from typing import Union, Optional, Generic, TypeVar
 from typing import Callable, Generator, Iterable, Iterator, AsyncIterator
 from typing import Tuple, List, Set, Dict, Any
 
+import json
+import base64
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
 from dataclasses import dataclass
 from dataclasses import field, asdict
-from functools import lru_cache
+from itertools import batched
 
-from fastapi import APIRouter
-from fastapi import Query
+from fastapi import APIRouter, HTTPException
+from fastapi import Depends, Query, Header
 from fastapi import WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 from ..core import Time
@@ -19,9 +26,13 @@ from ..core import Identifier, TestId, JobId, DutId
 from ..core import MetricKey, MetricInfo, MetricEntry
 from ..core import MetricDB
 from ..core import Schema
+from ..core import parse_duration
+from ..core.metric._ingest import DroppedError
 
 from ..tshrag import Tshrag
 
+from ._frame import decode_frame, peek_seq
+
 from ..util.consts import SYM_TSHRAG
 from ..util.consts import PATH_LOCK
 from ..util.consts import TIMEOUT
@@ -30,25 +41,22 @@ from ..util.consts import CONCURRENCY
 
 
 
-@lru_cache(maxsize=CONCURRENCY**2)
 def _get_mdb(tshrag: Tshrag, test_id: TestId) -> MetricDB:
-    return tshrag.query_test(test_id).get_mdb()
+    return tshrag.query_mdb(test_id)
 
 
-def _get_entries(
-    tshrag          : Tshrag,
+def _get_query(
     test_id         : str,
     key             : str,
     dut             : List[str],
     start_time      : str,
     end_time        : str,
-):
+) -> Dict[str, Any]:
     _test_id = TestId(test_id)
-    _mdb = _get_mdb(tshrag, _test_id)
     _dut = set(dut)
     _start_time = start_time and Time(start_time)
     _end_time = end_time and Time(end_time)
-    return _mdb.query_metric_entry(
+    return dict(
         key         = key,
         test        = _test_id,
         dut         = _dut,
@@ -57,6 +65,45 @@ def _get_entries(
     )
 
 
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+NDJSON_BATCH = 1000
+NDJSON_AFTER_HEADER = "X-Metric-After"
+
+
+# Bytes values leave the API as {"$bytes": base64} in every format, JSON
+# has no bytes and their str() is neither portable nor always UTF-8.
+BYTES_TAG = "$bytes"
+
+
+def _json_value(value: Any) -> Any:
+    if isinstance(value, (bytes, bytearray)):
+        return {BYTES_TAG: base64.b64encode(value).decode("ascii")}
+    return value
+
+
+def _json_entry(entry: MetricEntry) -> MetricEntry:
+    if isinstance(entry.value, (bytes, bytearray)):
+        return MetricEntry(entry.time, entry.duration, _json_value(entry.value))
+    return entry
+
+
+def _is_ndjson(format: Optional[str], accept: Optional[str]) -> bool:
+    if format is not None:
+        return format.lower() == "ndjson"
+    return accept is not None and NDJSON_MEDIA_TYPE in accept
+
+
+def _iter_ndjson(entries: Iterable[MetricEntry]) -> Generator[str, None, None]:
+    for _batch in batched(entries, NDJSON_BATCH):
+        yield "".join(
+            json.dumps(
+                {"time": str(_entry.time), "duration": _entry.duration, "value": _json_value(_entry.value)},
+                default=str,
+            ) + "\n"
+            for _entry in _batch
+        )
+
+
 def _get_nums(entries: List[MetricEntry]) -> List[float]:
     _nums = []
     for _entry in entries:
@@ -67,50 +114,32 @@ def _get_nums(entries: List[MetricEntry]) -> List[float]:
             pass
     return _nums
 
-def _get_numsum(entries: List[MetricEntry]) -> float:
-    _nums = _get_nums(entries)
-    return sum(_nums) if _nums else None
-
-def _get_numavg(entries: List[MetricEntry]) -> float:
-    _nums = _get_nums(entries)
-    return sum(_nums) / len(_nums) if _nums else None
-
-def _get_nummin(entries: List[MetricEntry]) -> float:
-    _nums = _get_nums(entries)
-    return min(_nums) if _nums else None
 
-def _get_nummax(entries: List[MetricEntry]) -> float:
-    _nums = _get_nums(entries)
-    return max(_nums) if _nums else None
+def _by_entries(func: Callable[[List[MetricEntry]], Any]):
+    def _statistic(mdb: MetricDB, **query) -> Any:
+        return func(mdb.query_metric_entry(**query))
+    return _statistic
 
-def _get_numhist(entries: List[MetricEntry]) -> Dict[float, int]:
-    _nums = _get_nums(entries)
-    _bin = {}
-    for _num in _nums:
-        if _num not in _bin:
-            _bin[_num] = 0
-        _bin[_num] += 1
-    return _bin
-
-def _get_hist(entries: List[MetricEntry]) -> Dict[str, int]:
-    _bin = {}
-    for entry in entries:
-        if entry.value not in _bin:
-            _bin[entry.value] = 0
-        _bin[entry.value] += 1
-    return _bin
+def _by_aggregate(aggregate: str):
+    def _statistic(mdb: MetricDB, **query) -> Any:
+        return mdb.query_metric_aggregate(aggregate, **query)
+    return _statistic
 
 
 STATISTIC_MAP = {
-    "num"   : _get_nums,
-    "sum"   : _get_numsum,
-    "avg"   : _get_numavg,
-    "min"   : _get_nummin,
-    "max"   : _get_nummax,
-    "hist"  : _get_hist,
+    "num"   : _by_entries(_get_nums),
+    "sum"   : _by_aggregate("sum"),
+    "avg"   : _by_aggregate("avg"),
+    "min"   : _by_aggregate("min"),
+    "max"   : _by_aggregate("max"),
+    "count" : _by_aggregate("count"),
 }
 
 
+HIST_BINS = 10
+HIST_MAX_BINS = 10_000
+
+
 
 _MetricInfo = Schema(MetricInfo)
 _MetricEntry = Schema(MetricEntry)
@@ -123,6 +152,7 @@ class RespMetricInfo(BaseModel):
 
 class RespMetricEntries(BaseModel):
     entries: List[_MetricEntry]
+    after: Optional[str] = None
 
 class RespMetricStatistic(BaseModel):
     statistic: Any
@@ -146,10 +176,90 @@ class UpdateMetricEntry:
             for entry in self.entries
         ]
 
+@dataclass
+class UpdateMetricFrame:
+    seq             : int
+    updates         : List[UpdateMetricEntry] = field(default_factory=list)
+
+    def __post_init__(self):
+        self.seq = int(self.seq)
+        self.updates = [
+            UpdateMetricEntry(**update)
+            if isinstance(update, dict)
+            else update
+            for update in self.updates
+        ]
+
+
+
+WS_VERSIONS = {1, 2}
+WS_FORMATS = {"json", "binary"}
+WS_ACKS = {"window", "none"}
+WS_ACK_EVERY = 1000
+WS_ACK_DELAY = "50ms"
+WS_CREDIT = 10_000
+
+
+
+def _check_credit(count: int, credit: Optional[int]):
+    if not credit is None and count > credit:
+        raise ValueError(f"Credit exceeded: {count} entries with {credit} credits")
+
+
+def _ingest_json(mdb: MetricDB, test_id: TestId, data: str, credit: Optional[int]) -> Tuple[int, int, Future]:
+    _frame = UpdateMetricFrame(**json.loads(data))
+    _entries = [
+        (_update.key, _entry, test_id, _update.dut)
+        for _update in _frame.updates
+        for _entry in _update.entries
+    ]
+    _check_credit(len(_entries), credit)
+    return _frame.seq, len(_entries), mdb.enqueue_metric_entries(_entries)
+
+
+def _ingest_binary(mdb: MetricDB, test_id: TestId, data: bytes, credit: Optional[int]) -> Tuple[int, int, Future]:
+    _seq, _updates = decode_frame(data)
+    _values = [
+        (_key, _time, _duration, _value, test_id, _dut)
+        for _key, _dut, _entries in (
+            (MetricKey(_key), {DutId(_d) for _d in _dut}, _entries)
+            for _key, _dut, _entries in _updates
+        )
+        for _time, _duration, _value in _entries
+    ]
+    _check_credit(len(_values), credit)
+    return _seq, len(_values), mdb.enqueue_metric_values(_values)
+
+
+# Text or binary, whichever the client sent: the typed receive_* of the
+# WebSocket fail on the other kind without a close code or a reply.
+async def _receive_frame(websocket: WebSocket) -> Union[str, bytes]:
+    _message = await websocket.receive()
+    if _message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(_message.get("code", 1000), _message.get("reason"))
+    if not _message.get("bytes") is None:
+        return _message["bytes"]
+    return _message.get("text") or ""
+
+
+def _peek_seq(data: Union[str, bytes]) -> Optional[int]:
+    if isinstance(data, bytes):
+        return peek_seq(data)
+    try:
+        return json.loads(data).get("seq")
+    except Exception as e:
+        return None
+
 
 
 def MetricAPI(tshrag: Tshrag):
-    router = APIRouter()
+    # Every route pins its test's metric database until the response, a
+    # streamed one included, has been sent, so it is not closed under it.
+    def _pin_mdb(test_id: str) -> Generator[None, None, None]:
+        with tshrag.use_mdb(TestId(test_id)):
+            yield
+
+    router = APIRouter(dependencies=[Depends(_pin_mdb)])
 
 
     @router.get("/metric/{test_id}/infos", response_model=RespMetricInfoList)
@@ -202,19 +312,101 @@ def MetricAPI(tshrag: Tshrag):
         dut         : List[str]             = Query([]),
         start_time  : str                   = Query(None),
         end_time    : str                   = Query(None),
+        limit       : Optional[int]         = Query(None, gt=0),
+        after       : Optional[str]         = Query(None),
+        format      : str                   = Query(None),
+        accept      : str                   = Header(None),
     ):
+        _test_id = TestId(test_id)
+        _mdb = _get_mdb(tshrag, _test_id)
+        _query = _get_query(test_id, key, dut, start_time, end_time)
+        try:
+            if limit is None:
+                _entries = _mdb.iter_metric_entry(**_query, after=after)
+                _after = None
+            else:
+                _entries, _after = _mdb.query_metric_page(**_query, limit=limit, after=after)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if _is_ndjson(format, accept):
+            return StreamingResponse(
+                _iter_ndjson(_entries),
+                media_type=NDJSON_MEDIA_TYPE,
+                headers={} if _after is None else {NDJSON_AFTER_HEADER: _after},
+            )
         _entries = [
-            _MetricEntry.fromcore(_entry)
-            for _entry in _get_entries(
-                tshrag,
-                test_id,
-                key,
-                dut,
-                start_time,
-                end_time,
+            _MetricEntry.fromcore(_json_entry(_entry))
+            for _entry in _entries
+        ]
+        return RespMetricEntries(entries=_entries, after=_after)
+
+
+    @router.get("/metric/{test_id}/bucket", response_model=RespMetricEntries)
+    @router.get("/metric/{test_id}/bucket/{key}", response_model=RespMetricEntries)
+    def query_metric_bucket(
+        test_id     : str,
+        key         : str,
+        interval    : str,
+        stat        : str                   = Query("avg"),
+        dut         : List[str]             = Query([]),
+        start_time  : str                   = Query(None),
+        end_time    : str                   = Query(None),
+    ):
+        _test_id = TestId(test_id)
+        _mdb = _get_mdb(tshrag, _test_id)
+        try:
+            _buckets = _mdb.query_metric_bucket(
+                stat,
+                parse_duration(interval),
+                **_get_query(test_id, key, dut, start_time, end_time)
             )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        _buckets = [
+            _MetricEntry.fromcore(_bucket)
+            for _bucket in _buckets
         ]
-        return RespMetricEntries(entries=_entries)
+        return RespMetricEntries(entries=_buckets)
+
+
+    @router.get("/metric/{test_id}/ingest", response_model=RespMetricStatistic)
+    def query_metric_ingest(
+        test_id     : str,
+    ):
+        _test_id = TestId(test_id)
+        _mdb = _get_mdb(tshrag, _test_id)
+        return RespMetricStatistic(statistic=_mdb.query_ingest_stats())
+
+
+    @router.get("/metric/{test_id}/hist", response_model=RespMetricStatistic)
+    @router.get("/metric/{test_id}/hist/{key}", response_model=RespMetricStatistic)
+    def query_metric_histogram(
+        test_id     : str,
+        key         : str,
+        mode        : str                   = Query("topk"),
+        bins        : int                   = Query(HIST_BINS, gt=0, le=HIST_MAX_BINS),
+        lo          : Optional[float]       = Query(None),
+        hi          : Optional[float]       = Query(None),
+        dut         : List[str]             = Query([]),
+        start_time  : str                   = Query(None),
+        end_time    : str                   = Query(None),
+    ):
+        _test_id = TestId(test_id)
+        _mdb = _get_mdb(tshrag, _test_id)
+        try:
+            _hist = _mdb.query_metric_histogram(
+                mode,
+                bins,
+                **_get_query(test_id, key, dut, start_time, end_time),
+                lo = lo,
+                hi = hi,
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        for _bin in _hist["bins"]:
+            if "value" in _bin:
+                _bin["value"] = _json_value(_bin["value"])
+        return RespMetricStatistic(statistic=_hist)
 
 
     @router.get("/metric/{test_id}/{statistic}", response_model=RespMetricStatistic)
@@ -227,15 +419,18 @@ def MetricAPI(tshrag: Tshrag):
         start_time  : str                   = Query(None),
         end_time    : str                   = Query(None),
     ):
-        _entries = _get_entries(
-            tshrag,
-            test_id,
-            key,
-            dut,
-            start_time,
-            end_time,
-        )
-        _statistic = STATISTIC_MAP[statistic](_entries)
+        _test_id = TestId(test_id)
+        _mdb = _get_mdb(tshrag, _test_id)
+        # Statistics not in STATISTIC_MAP, like p{N} quantiles, are left
+        # to the aggregates of MetricDB.
+        _get_statistic = STATISTIC_MAP.get(statistic, _by_aggregate(statistic))
+        try:
+            _statistic = _get_statistic(
+                _mdb,
+                **_get_query(test_id, key, dut, start_time, end_time)
+            )
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         return RespMetricStatistic(statistic=_statistic)
 
 
@@ -244,21 +439,31 @@ def MetricAPI(tshrag: Tshrag):
     def add_metric_entry(
         test_id     : str,
         key         : str,
-        entry       : Dict,
+        entry       : Union[Dict, List[Dict]],
         dut         : List[str]             = Query([]),
     ):
         _test_id = TestId(test_id)
         _key = MetricKey(key)
         _mdb = _get_mdb(tshrag, _test_id)
         _dut = set(dut)
-        _entry = MetricEntry(**entry)
-        _mdb.add_metric_entry(
-            key     = _key,
-            entry   = _entry,
-            test    = _test_id,
-            dut     = _dut,
-        )
-        return RespMessage(message=f"Metric {_key} entry added.")
+        # A queue that stays full answers 503, the client may retry later.
+        try:
+            if isinstance(entry, dict):
+                _entries = [MetricEntry(**entry)]
+            else:
+                _entries = [MetricEntry(**_entry) for _entry in entry]
+            _done = _mdb.enqueue_metric_entries([
+                (_key, _entry, _test_id, _dut)
+                for _entry in _entries
+            ], timeout=TIMEOUT)
+            _done.result()
+        except (TimeoutError, DroppedError) as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if isinstance(entry, dict):
+            return RespMessage(message=f"Metric {_key} entry added.")
+        return RespMessage(message=f"Metric {_key} {len(_entries)} entries added.")
 
 
     return router
@@ -266,31 +471,206 @@ def MetricAPI(tshrag: Tshrag):
 
 
 def MetricWsAPI(tshrag: Tshrag):
-    router = APIRouter()
+    # Storage calls may block on SQLite or on ingest backpressure; they run
+    # on the router's own bounded pool so the event loop and the threadpool
+    # of the HTTP routes stay free. The pool goes with the app.
+    _executor = ThreadPoolExecutor(
+        max_workers = CONCURRENCY,
+        thread_name_prefix = f"{SYM_TSHRAG}_ws",
+    )
+
+    @asynccontextmanager
+    async def _lifespan(app) -> AsyncIterator[None]:
+        try:
+            yield
+        finally:
+            _executor.shutdown(wait=False, cancel_futures=True)
+
+    router = APIRouter(lifespan=_lifespan)
+
+    async def _run(func: Callable, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
+
+
+    async def _serve_v1(
+        websocket   : WebSocket,
+        mdb         : MetricDB,
+        test_id     : TestId,
+    ):
+        while True:
+            _update = UpdateMetricEntry(**await websocket.receive_json())
+            # Each entry is answered once the update has committed, with the
+            # error instead if it has not.
+            try:
+                _done = await _run(mdb.enqueue_metric_entries, [
+                    (_update.key, _entry, test_id, _update.dut)
+                    for _entry in _update.entries
+                ])
+                await _run(_done.result)
+                _message = f"Metric {_update.key} entry added."
+            except Exception as e:
+                _message = f"Metric {_update.key} entry failed: {e}"
+            for _entry in _update.entries:
+                await websocket.send_text(_message)
+
+
+    # Version 2 frames carry a client sequence number and any number of
+    # updates, as UpdateMetricFrame JSON text or, with format=binary, as
+    # the binary frames of _frame. Acks are cumulative and only sent for
+    # committed frames: {"ack": seq, "entries": n} confirms every frame up
+    # to seq, once ack_every entries or ack_delay have passed since the
+    # last one. A frame that is rejected or fails to commit is answered
+    # with {"error": e, "seq": seq} before any ack covering it.
+    # With a credit window, {"credit": n, "full": f} allows the client to
+    # send n entries in total, f tells whether the ingest queue had no room
+    # for a full window. Credits are topped up once half of the window is
+    # used and only as far as the ingest queue has room, else retried
+    # every ack_delay; frames beyond the credit are rejected, and entries
+    # of failed frames are credited back. Credits reserve room in the
+    # ingest queue until their entries arrive or the connection closes.
+    async def _serve_v2(
+        websocket   : WebSocket,
+        mdb         : MetricDB,
+        test_id     : TestId,
+        format      : str,
+        ack         : str,
+        ack_every   : int,
+        ack_delay   : float,
+        credit      : int,
+    ):
+        _loop = asyncio.get_running_loop()
+        if format == "binary":
+            _type, _ingest = bytes, _ingest_binary
+        else:
+            _type, _ingest = str, _ingest_json
+        _inflight = deque()
+        _wake = asyncio.Event()
+        _recv = None
+        _waker = None
+        _acked = None
+        _seq = None
+        _entries = 0
+        _committed = 0
+        _pending = 0
+        _deadline = None
+        _granted = None
+        _full = False
+        _retry = None
+        if credit:
+            _granted = mdb.grant_ingest_credit(credit)
+            _full = _granted < credit
+            await websocket.send_json({"credit": _granted, "full": _full})
+        try:
+            while True:
+                while _inflight and _inflight[0][2].done():
+                    _fseq, _count, _future = _inflight.popleft()
+                    if not _future.exception() is None:
+                        _entries -= _count
+                        if not _granted is None:
+                            mdb.grant_ingest_credit(_count, force=True)
+                        await websocket.send_json({"error": str(_future.exception()), "seq": _fseq})
+                        continue
+                    _seq = _fseq
+                    _committed += _count
+                    _pending += _count
+                    if _deadline is None:
+                        _deadline = _loop.time() + ack_delay
+                if ack == "none" or _seq == _acked:
+                    _deadline = None
+                elif _pending >= ack_every or (not _deadline is None and _loop.time() >= _deadline):
+                    await websocket.send_json({"ack": _seq, "entries": _committed})
+                    _acked = _seq
+                    _pending = 0
+                    _deadline = None
+                if not _granted is None and _granted - _entries <= credit // 2:
+                    if _retry is None or _loop.time() >= _retry:
+                        _want = credit - (_granted - _entries)
+                        _grant = mdb.grant_ingest_credit(_want)
+                        if _grant or (_grant < _want) != _full:
+                            _granted += _grant
+                            _full = _grant < _want
+                            await websocket.send_json({"credit": _granted, "full": _full})
+                        _retry = None if _granted - _entries > credit // 2 else _loop.time() + ack_delay
+                if _recv is None:
+                    _recv = asyncio.ensure_future(_receive_frame(websocket))
+                if _waker is None:
+                    _wake.clear()
+                    _waker = asyncio.ensure_future(_wake.wait())
+                _wakes = [_t for _t in (_deadline, _retry) if not _t is None]
+                _timeout = max(0, min(_wakes) - _loop.time()) if _wakes else None
+                await asyncio.wait({_recv, _waker}, timeout=_timeout, return_when=asyncio.FIRST_COMPLETED)
+                if _waker.done():
+                    _waker = None
+                if not _recv.done():
+                    continue
+                _data, _recv = _recv.result(), None
+                if not isinstance(_data, _type):
+                    await websocket.send_json({
+                        "error": f"Expected {'binary' if _type is bytes else 'text'} frames with format={format}",
+                        "seq": _peek_seq(_data),
+                    })
+                    continue
+                try:
+                    _credit = None if _granted is None else _granted - _entries
+                    _fseq, _count, _future = await _run(_ingest, mdb, test_id, _data, _credit)
+                except Exception as e:
+                    await websocket.send_json({"error": str(e), "seq": _peek_seq(_data)})
+                    continue
+                _entries += _count
+                if not _granted is None:
+                    mdb.release_ingest_credit(_count)
+                _inflight.append((_fseq, _count, _future))
+                _future.add_done_callback(lambda _: _loop.is_closed() or _loop.call_soon_threadsafe(_wake.set))
+        finally:
+            for _task in (_recv, _waker):
+                if not _task is None:
+                    _task.cancel()
+            if not _granted is None:
+                mdb.release_ingest_credit(_granted - _entries)
 
 
     @router.websocket("/metric/{test_id}/entry")
     async def add_metric_entry(
         websocket   : WebSocket,
         test_id     : str,
+        version     : int                   = Query(1),
+        format      : str                   = Query("json"),
+        ack         : str                   = Query("window"),
+        ack_every   : int                   = Query(WS_ACK_EVERY),
+        ack_delay   : str                   = Query(WS_ACK_DELAY),
+        credit      : int                   = Query(0),
     ):
         _test_id = TestId(test_id)
-        _mdb = _get_mdb(tshrag, _test_id)
-        await websocket.accept()
         try:
-            while True:
-                _update = UpdateMetricEntry(**await websocket.receive_json())
-                for _entry in _update.entries:
-                    _mdb.add_metric_entry(
-                        key     = _update.key,
-                        entry   = _entry,
-                        test    = _test_id,
-                        dut     = _update.dut,
-                    )
-                    await websocket.send_text(f"Metric {_update.key} entry added.")
+            _ack_delay = parse_duration(ack_delay) / Time.UNIT_RATE
+        except ValueError:
+            _ack_delay = None
+        if (
+            not version in WS_VERSIONS
+            or not format in WS_FORMATS
+            or (format == "binary" and version < 2)
+            or not ack in WS_ACKS
+            or _ack_delay is None
+            or ack_every <= 0
+            or credit < 0
+            or (credit and version < 2)
+        ):
+            await websocket.close(code=1008)
+            return
+        # The connection pins its test's metric database while it is open.
+        _mdb = await _run(tshrag.acquire_mdb, _test_id)
+        try:
+            await websocket.accept()
+            if version == 1:
+                await _serve_v1(websocket, _mdb, _test_id)
+            else:
+                await _serve_v2(websocket, _mdb, _test_id, format, ack, ack_every, _ack_delay, credit)
         except WebSocketDisconnect:
             # TODO: Handle disconnection
             pass
+        finally:
+            if not _mdb is None:
+                await _run(tshrag.release_mdb, _test_id)
 
 
     return router
@@ -26,8 +26,68 @@ from ..util.consts import ENCODING
 
 
 
+def _format_entry_line(entry: MetricEntry, header: bool = False) -> str:
+    if header:
+        return f"{"Time":<32} | {"Duration":<12} | {"Value"}"
+    else:
+        return f"{str(entry.time):<32} | {entry.duration:<12} | {entry.value}"
+
+
+
 def MetricCLI(tshrag: Tshrag) -> click.Group:
     cli = click.Group()
-    
+
+
+    @cli.group()
+    @click.argument("test-id", type=TestId)
+    @click.pass_context
+    def metric(
+        ctx         : Context,
+        test_id     : TestId,
+    ):
+        ctx.ensure_object(dict)
+        ctx.obj["test-id"] = test_id
+
+
+    @metric.command()
+    @click.argument("key",                  type=str)
+    @click.option("--dut", "-d",            type=str, multiple=True)
+    @click.option("--start-time", "-t0",    type=Time, default=None)
+    @click.option("--end-time", "-t1",      type=Time, default=None)
+    @click.pass_context
+    def entry(
+        ctx         : Context,
+        key         : str,
+        dut         : List[str],
+        start_time  : Optional[Time],
+        end_time    : Optional[Time],
+    ):
+        test_id = ctx.obj["test-id"]
+        mdb = tshrag.query_mdb(test_id)
+        _header = _format_entry_line(None, header=True)
+        click.echo(_header)
+        click.echo("-" * len(_header))
+        for _entry in mdb.iter_metric_entry(
+            key         = key,
+            test        = test_id,
+            dut         = set(dut),
+            start_time  = start_time,
+            end_time    = end_time,
+        ):
+            click.echo(_format_entry_line(_entry))
+
+
+    @metric.command()
+    @click.pass_context
+    def rollup(
+        ctx         : Context,
+    ):
+        """Rebuild the rollup tables from raw entries."""
+        test_id = ctx.obj["test-id"]
+        mdb = tshrag.query_mdb(test_id)
+        mdb.rebuild_metric_rollup()
+        click.echo(f"Test {test_id} metric rollup rebuilt.")
+
+
     return cli
 
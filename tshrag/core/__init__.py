@@ -9,6 +9,7 @@ from .metric import MetricDB
 from .profile import Profile
 from .test import RunStatus, Run, Job, Test
 
+from .time import parse_duration
 from .identifier import split_identifier, is_identifier
 from .schema import Schema
 
@@ -28,6 +29,7 @@ __all__ = [
     "Run",
     "Job",
     "Test",
+    "parse_duration",
     "split_identifier",
     "is_identifier",
     "Schema",
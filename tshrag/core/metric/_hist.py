@@ -0,0 +1,122 @@
+# -*- coding: UTF-8 -*-
+
+
+from typing import Any, Dict, Hashable, List
+import heapq
+import json
+import math
+
+
+
+class FixedHistogram:
+
+    def __init__(self, lo: float, hi: float, bins: int):
+        self.lo = lo
+        self.hi = hi
+        self.counts = [0] * bins
+        self.under = 0
+        self.over = 0
+
+
+    def _edge(self, index: int) -> float:
+        return self.lo + (self.hi - self.lo) * index / len(self.counts)
+
+
+    def _index(self, value: float) -> int:
+        if self.hi == self.lo:
+            return 0
+        return int((value - self.lo) / (self.hi - self.lo) * len(self.counts))
+
+
+    # NaN has no place on the axis and is skipped, infinities land in the
+    # under/over counts like any other out-of-range value.
+    def add(self, value: float) -> None:
+        if math.isnan(value):
+            return
+        if value < self.lo:
+            self.under += 1
+        elif value > self.hi:
+            self.over += 1
+        else:
+            self.counts[min(self._index(value), len(self.counts) - 1)] += 1
+
+
+    def result(self) -> Dict[str, Any]:
+        return {
+            "bins": [
+                {"lo": self._edge(_i), "hi": self._edge(_i + 1), "count": _c}
+                for _i, _c in enumerate(self.counts)
+            ],
+            "under": self.under,
+            "over": self.over,
+        }
+
+
+
+class LogHistogram(FixedHistogram):
+
+    def __init__(self, lo: float, hi: float, bins: int):
+        if lo <= 0:
+            raise ValueError(f"Non-positive log histogram bound: {lo}")
+        super().__init__(lo, hi, bins)
+
+
+    def _edge(self, index: int) -> float:
+        return self.lo * (self.hi / self.lo) ** (index / len(self.counts))
+
+
+    def _index(self, value: float) -> int:
+        if self.hi == self.lo:
+            return 0
+        return int(math.log(value / self.lo) / math.log(self.hi / self.lo) * len(self.counts))
+
+
+
+# Space-saving top-k: at most k values are counted, a new value replaces the
+# smallest counter and inherits its count as the overestimation error.
+class TopKHistogram:
+
+    def __init__(self, k: int):
+        self.k = k
+        self.total = 0
+        self._counts: Dict[Hashable, List[int]] = {}
+        self._heap: List[tuple] = []
+
+
+    def _min(self) -> Hashable:
+        while True:
+            _count, _n, _value = self._heap[0]
+            if self._counts[_value][0] == _count:
+                return _value
+            heapq.heapreplace(self._heap, (self._counts[_value][0], _n, _value))
+
+
+    def add(self, value: Any) -> None:
+        if not isinstance(value, Hashable):
+            value = json.dumps(value, default=str)
+        self.total += 1
+        if value in self._counts:
+            self._counts[value][0] += 1
+            return
+        if len(self._counts) < self.k:
+            self._counts[value] = [1, 0]
+            heapq.heappush(self._heap, (1, self.total, value))
+            return
+        _evict = self._min()
+        _count = self._counts.pop(_evict)[0]
+        self._counts[value] = [_count + 1, _count]
+        heapq.heapreplace(self._heap, (_count + 1, self.total, value))
+
+
+    def result(self) -> Dict[str, Any]:
+        return {
+            "bins": [
+                {"value": _value, "count": _count, "error": _error}
+                for _value, (_count, _error) in sorted(
+                    self._counts.items(),
+                    key=lambda _item: _item[1][0],
+                    reverse=True,
+                )
+            ],
+            "total": self.total,
+        }
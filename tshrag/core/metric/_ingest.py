@@ -0,0 +1,268 @@
+# -*- coding: UTF-8 -*-
+
+
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from collections import deque
+from concurrent.futures import Future
+from threading import Condition, Thread
+import time
+
+
+
+# Rows a drop_oldest queue discarded to make room: the futures of their
+# puts fail with it, dropped rows are never reported as committed.
+class DroppedError(RuntimeError):
+    pass
+
+
+
+# The rows of one put: its future resolves once every row is committed,
+# dropped or failed, with the first error of its failed rows.
+class _Ticket:
+
+    def __init__(self, rows: int):
+        self.future = Future()
+        self.pending = rows
+        self.error = None
+
+
+    def done(self, count: int, error: Optional[Exception] = None) -> bool:
+        self.pending -= count
+        if self.error is None:
+            self.error = error
+        return self.pending <= 0
+
+
+    def resolve(self):
+        if self.error is None:
+            self.future.set_result(None)
+        else:
+            self.future.set_exception(self.error)
+
+
+
+class IngestQueue:
+
+    POLICIES = {"block", "drop_oldest"}
+
+    def __init__(
+        self,
+        write       : Callable[[List[Any]], None],
+        batch       : int,
+        delay       : float,
+        capacity    : int,
+        name        : str                   = None,
+        policy      : str                   = "block",
+        split       : bool                  = True,
+    ):
+        if not policy in IngestQueue.POLICIES:
+            raise ValueError(f"Unknown ingest policy: {policy}")
+        self._write = write
+        self._batch = max(1, int(batch))
+        self._delay = max(0.0, float(delay))
+        self._capacity = max(self._batch, int(capacity))
+        self._name = name
+        self._policy = policy
+        self._split = split
+        self._rows = deque()
+        self._cond = Condition()
+        self._submitted = 0
+        self._committed = 0
+        self._commits = 0
+        self._failed = 0
+        self._dropped = 0
+        self._blocked = 0
+        self._blocked_seconds = 0.0
+        self._throttled = 0
+        self._reserved = 0
+        self._latency = deque(maxlen=1000)
+        self._closed = False
+        self._thread = None
+
+
+    # Returns a future of the put's rows, failing with the first error of
+    # any of them; rows that fail do not fail the other rows of a batch.
+    def put(
+        self,
+        rows        : List[Any],
+        timeout     : Optional[float]       = None,
+    ) -> Future:
+        rows = list(rows)
+        _deadline = None if timeout is None else time.monotonic() + timeout
+        _trim = 0
+        _done = []
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Ingest queue is closed")
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name=self._name, daemon=True)
+                self._thread.start()
+            # With drop_oldest a full queue makes room by discarding its
+            # oldest rows instead of blocking the producer.
+            if self._policy == "drop_oldest" and len(self._rows) + len(rows) > self._capacity:
+                _drop = len(self._rows) + len(rows) - self._capacity
+                self._dropped += _drop
+                _error = DroppedError(f"Ingest queue is full, {_drop} rows dropped")
+                for _ in range(min(_drop, len(self._rows))):
+                    _, _ticket = self._rows.popleft()
+                    if _ticket.done(1, _error):
+                        _done.append(_ticket)
+                _trim = max(0, len(rows) - self._capacity)
+                self._submitted += _trim
+                rows = rows[_trim:]
+            # Producers wait while the queue is full, a single oversized put
+            # is admitted once the queue has drained completely.
+            if self._rows and len(self._rows) + len(rows) > self._capacity:
+                self._blocked += 1
+                _t0 = time.monotonic()
+                try:
+                    while self._rows and len(self._rows) + len(rows) > self._capacity:
+                        _remaining = None if _deadline is None else _deadline - time.monotonic()
+                        if not _remaining is None and _remaining <= 0:
+                            raise TimeoutError("Ingest queue is full")
+                        self._cond.wait(_remaining)
+                finally:
+                    self._blocked_seconds += time.monotonic() - _t0
+            _ticket = _Ticket(len(rows))
+            if _trim:
+                _ticket.error = _error
+            self._rows.extend((_row, _ticket) for _row in rows)
+            self._submitted += len(rows)
+            self._cond.notify_all()
+        if not rows:
+            _done.append(_ticket)
+        for _ticket in _done:
+            _ticket.resolve()
+        return _ticket.future
+
+
+    # Credits let producers hold back before the queue is full instead of
+    # blocking in put. A grant reserves its room, so grants never add up to
+    # more than the free room, until it is released as its rows are put or
+    # as its producer goes away. Forced grants return the room of rows
+    # that failed after their reservation was released.
+    def grant(
+        self,
+        count       : int,
+        force       : bool                  = False,
+    ) -> int:
+        with self._cond:
+            if force:
+                _grant = max(0, count)
+            else:
+                _grant = max(0, min(count, self._capacity - len(self._rows) - self._reserved))
+            if _grant < count:
+                self._throttled += 1
+            self._reserved += _grant
+            return _grant
+
+
+    def release(
+        self,
+        count       : int,
+    ) -> None:
+        with self._cond:
+            self._reserved = max(0, self._reserved - count)
+
+
+    def _take(self) -> Optional[List[Tuple[Any, _Ticket]]]:
+        with self._cond:
+            while not self._rows and not self._closed:
+                self._cond.wait()
+            if not self._rows:
+                return None
+            _deadline = time.monotonic() + self._delay
+            while len(self._rows) < self._batch and not self._closed:
+                _remaining = _deadline - time.monotonic()
+                if _remaining <= 0:
+                    break
+                self._cond.wait(_remaining)
+            return [self._rows.popleft() for _ in range(min(self._batch, len(self._rows)))]
+
+
+    # A failed batch is written again row by row, so that only the rows
+    # that fail on their own are lost. Writers that are not transactional
+    # and may have written part of a batch before failing turn this off
+    # with split=False; they can return the error of each row instead.
+    def _commit(self, rows: List[Any]) -> List[Optional[Exception]]:
+        try:
+            _errors = self._write(rows)
+        except Exception as e:
+            if len(rows) == 1 or not self._split:
+                return [e] * len(rows)
+        else:
+            return _errors if isinstance(_errors, list) else [None] * len(rows)
+        _errors = []
+        for _row in rows:
+            try:
+                self._write([_row])
+                _errors.append(None)
+            except Exception as e:
+                _errors.append(e)
+        return _errors
+
+
+    def _run(self):
+        while (items := self._take()) is not None:
+            _t0 = time.perf_counter()
+            _errors = self._commit([_row for _row, _ in items])
+            _latency = time.perf_counter() - _t0
+            _failed = sum(1 for _error in _errors if not _error is None)
+            _done = []
+            with self._cond:
+                self._committed += len(items) - _failed
+                self._failed += _failed
+                self._commits += 1
+                self._latency.append(_latency)
+                for (_, _ticket), _error in zip(items, _errors):
+                    if _ticket.done(1, _error):
+                        _done.append(_ticket)
+                self._cond.notify_all()
+            for _ticket in _done:
+                _ticket.resolve()
+
+
+    def flush(
+        self,
+        timeout     : Optional[float]       = None,
+    ) -> bool:
+        with self._cond:
+            _target = self._submitted
+            return self._cond.wait_for(
+                lambda: self._committed + self._failed + self._dropped >= _target,
+                timeout,
+            )
+
+
+    def close(
+        self,
+        timeout     : Optional[float]       = None,
+    ) -> bool:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            _thread = self._thread
+        if not _thread is None:
+            _thread.join(timeout)
+        return _thread is None or not _thread.is_alive()
+
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            _latency = sorted(self._latency)
+            return {
+                "depth"         : len(self._rows),
+                "capacity"      : self._capacity,
+                "submitted"     : self._submitted,
+                "committed"     : self._committed,
+                "failed"        : self._failed,
+                "dropped"       : self._dropped,
+                "commits"       : self._commits,
+                "blocked"       : self._blocked,
+                "blocked_seconds": self._blocked_seconds,
+                "throttled"     : self._throttled,
+                "reserved"      : self._reserved,
+                "latency_avg"   : sum(_latency) / len(_latency) if _latency else None,
+                "latency_p99"   : _latency[int(0.99 * (len(_latency) - 1))] if _latency else None,
+                "latency_max"   : _latency[-1] if _latency else None,
+            }
@@ -0,0 +1,94 @@
+# -*- coding: UTF-8 -*-
+
+
+from typing import Callable, Dict, Generator, Optional
+from pathlib import Path
+from contextlib import contextmanager
+from queue import LifoQueue, Empty
+from threading import Lock, RLock, BoundedSemaphore
+import re
+import sqlite3
+
+
+
+_PRAGMA_VALUE = re.compile(r"^-?\w+$")
+
+
+
+class ConnectionPool:
+
+    def __init__(
+        self,
+        filename    : Path,
+        readers     : int,
+        pragmas     : Dict[str, str],
+        setup       : Optional[Callable[[sqlite3.Connection], None]] = None,
+    ):
+        for _k, _v in pragmas.items():
+            if not _PRAGMA_VALUE.match(str(_v)):
+                raise ValueError(f"Invalid PRAGMA {_k} value: {_v}")
+        self._filename = Path(filename)
+        self._pragmas = dict(pragmas)
+        self._setup = setup
+        self._writer = None
+        self._writer_lock = RLock()
+        self._readers = BoundedSemaphore(max(1, int(readers)))
+        self._idle = LifoQueue()
+        self._lock = Lock()
+        self._generation = 0
+        self._closed = False
+
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._closed:
+            raise RuntimeError(f"Connection pool of {self._filename} is closed")
+        conn = sqlite3.connect(self._filename, check_same_thread=False)
+        for _k, _v in self._pragmas.items():
+            conn.execute(f"PRAGMA {_k} = {_v}")
+        if not self._setup is None:
+            self._setup(conn)
+        return conn
+
+
+    @contextmanager
+    def writer(self) -> Generator[sqlite3.Connection, None, None]:
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = self._connect()
+            yield self._writer
+
+
+    @contextmanager
+    def reader(self) -> Generator[sqlite3.Connection, None, None]:
+        with self._readers:
+            with self._lock:
+                _generation = self._generation
+                try:
+                    conn = self._idle.get_nowait()
+                except Empty:
+                    conn = self._connect()
+            try:
+                yield conn
+            finally:
+                with self._lock:
+                    if _generation == self._generation:
+                        self._idle.put(conn)
+                    else:
+                        conn.close()
+
+
+    # Closing is final: connections taken afterwards raise instead of
+    # opening the database again behind its owner's back.
+    def close(self) -> None:
+        self._closed = True
+        with self._writer_lock:
+            if not self._writer is None:
+                self._writer.close()
+                self._writer = None
+        with self._lock:
+            self._generation += 1
+            while True:
+                try:
+                    self._idle.get_nowait().close()
+                except Empty:
+                    break
@@ -0,0 +1,188 @@
+# -*- coding: UTF-8 -*-
+
+
+from typing import Optional, Union
+from typing import Tuple, List, Any
+from pathlib import Path
+import mmap
+import struct
+
+from portalocker import Lock as FileLock
+from portalocker import LockFlags
+
+
+
+# Memory-mapped single-producer ring of fixed-size metric records, all
+# integers little-endian:
+#   header  := magic:8s record:u32 capacity:u32 head:u64 tail:u64 dropped:u64
+#   record  := time:i64 duration:i64 vtype:u8 pad:7 value:8 key:56s seq:u64
+# The producer owns head and dropped, the consumer owns tail. A slot is
+# only read once its seq stamp, written after the rest of the record,
+# matches the slot's index, so a half-written record is never drained.
+
+VTYPE_NONE = 0
+VTYPE_BOOL = 1
+VTYPE_INT = 2
+VTYPE_FLOAT = 3
+
+_HEADER = struct.Struct("<8sII")
+_HEADER_SIZE = 64
+_HEAD = 16
+_TAIL = 24
+_DROPPED = 32
+_U64 = struct.Struct("<Q")
+_INT_BODY = struct.Struct("<qqB7xq56s")
+_FLOAT_BODY = struct.Struct("<qqB7xd56s")
+_RECORD_SIZE = _INT_BODY.size + _U64.size
+
+KEY_SIZE = 56
+
+_INT_MIN = -2 ** 63
+_INT_MAX = 2 ** 63 - 1
+
+
+def fits_record(value: Any) -> bool:
+    if value is None or isinstance(value, (bool, float)):
+        return True
+    return isinstance(value, int) and _INT_MIN <= value <= _INT_MAX
+
+
+
+class MetricRing:
+
+    MAGIC = b"TSHRING1"
+    CAPACITY = 65_536
+    DELAY = "50ms"
+
+    def __init__(
+        self,
+        filename    : Union[str, Path],
+    ):
+        self.filename = Path(filename)
+        self._file = self.filename.open("r+b")
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0)
+            _magic, _record, self._capacity = _HEADER.unpack_from(self._mmap)
+            if _magic != MetricRing.MAGIC or _record != _RECORD_SIZE:
+                raise RuntimeError(f"Not a metric ring: {self.filename}")
+        except:
+            self._file.close()
+            raise
+        self._claim = None
+        self._head = _U64.unpack_from(self._mmap, _HEAD)[0]
+        self._tail = _U64.unpack_from(self._mmap, _TAIL)[0]
+
+
+    @classmethod
+    def create(
+        cls,
+        filename    : Union[str, Path],
+        capacity    : int                   = CAPACITY,
+    ) -> "MetricRing":
+        _capacity = int(capacity)
+        if _capacity <= 0:
+            raise ValueError(f"Invalid ring capacity: {capacity}")
+        with Path(filename).open("wb") as fp:
+            fp.write(_HEADER.pack(cls.MAGIC, _RECORD_SIZE, _capacity))
+            fp.truncate(_HEADER_SIZE + _capacity * _RECORD_SIZE)
+        return cls(filename)
+
+
+    def __str__(self) -> str:
+        return f"MetricRing({self.filename})"
+
+
+    @property
+    def capacity(self) -> int:
+        return self._capacity
+
+
+    @property
+    def dropped(self) -> int:
+        return _U64.unpack_from(self._mmap, _DROPPED)[0]
+
+
+    def depth(self) -> int:
+        return _U64.unpack_from(self._mmap, _HEAD)[0] - _U64.unpack_from(self._mmap, _TAIL)[0]
+
+
+    # A ring takes one producer process at a time; the claim is a lock on a
+    # sidecar file, taken once and held until close.
+    def claim(self) -> None:
+        if not self._claim is None:
+            return
+        _claim = FileLock(
+            f"{self.filename}.lock",
+            timeout = 0,
+            fail_when_locked = True,
+            flags = LockFlags.EXCLUSIVE | LockFlags.NON_BLOCKING,
+        )
+        _claim.acquire()
+        self._claim = _claim
+        self._head = _U64.unpack_from(self._mmap, _HEAD)[0]
+
+
+    def put(
+        self,
+        key         : bytes,
+        time        : int,
+        duration    : int,
+        value       : Any,
+    ) -> bool:
+        if len(key) > KEY_SIZE:
+            raise ValueError(f"Metric key longer than {KEY_SIZE} bytes: {key}")
+        if not fits_record(value):
+            raise ValueError(f"Value does not fit a ring record: {value!r}")
+        if value is None:
+            _body, _vtype, _value = _INT_BODY, VTYPE_NONE, 0
+        elif isinstance(value, bool):
+            _body, _vtype, _value = _INT_BODY, VTYPE_BOOL, int(value)
+        elif isinstance(value, int):
+            _body, _vtype, _value = _INT_BODY, VTYPE_INT, value
+        else:
+            _body, _vtype, _value = _FLOAT_BODY, VTYPE_FLOAT, value
+        if self._head - _U64.unpack_from(self._mmap, _TAIL)[0] >= self._capacity:
+            _U64.pack_into(self._mmap, _DROPPED, _U64.unpack_from(self._mmap, _DROPPED)[0] + 1)
+            return False
+        _offset = _HEADER_SIZE + (self._head % self._capacity) * _RECORD_SIZE
+        try:
+            _body.pack_into(self._mmap, _offset, time, duration, _vtype, _value, key)
+        except struct.error as e:
+            raise ValueError(f"Record does not fit a ring: {value!r}") from e
+        self._head += 1
+        _U64.pack_into(self._mmap, _offset + _INT_BODY.size, self._head)
+        _U64.pack_into(self._mmap, _HEAD, self._head)
+        return True
+
+
+    def drain(
+        self,
+        limit       : Optional[int]         = None,
+    ) -> List[Tuple[bytes, int, int, Any]]:
+        _records = []
+        while limit is None or len(_records) < limit:
+            _offset = _HEADER_SIZE + (self._tail % self._capacity) * _RECORD_SIZE
+            if _U64.unpack_from(self._mmap, _offset + _INT_BODY.size)[0] != self._tail + 1:
+                break
+            _time, _duration, _vtype, _value, _key = _INT_BODY.unpack_from(self._mmap, _offset)
+            if _vtype == VTYPE_NONE:
+                _value = None
+            elif _vtype == VTYPE_BOOL:
+                _value = bool(_value)
+            elif _vtype == VTYPE_FLOAT:
+                _value = _FLOAT_BODY.unpack_from(self._mmap, _offset)[3]
+            _records.append((_key.rstrip(b"\x00"), _time, _duration, _value))
+            self._tail += 1
+        if _records:
+            _U64.pack_into(self._mmap, _TAIL, self._tail)
+        return _records
+
+
+    def close(self) -> None:
+        if self._mmap.closed:
+            return
+        self._mmap.close()
+        self._file.close()
+        if not self._claim is None:
+            self._claim.release()
+            self._claim = None
@@ -0,0 +1,156 @@
+# -*- coding: UTF-8 -*-
+
+
+from typing import Dict, Optional
+import math
+import sqlite3
+import struct
+import sys
+
+
+
+_HEADER = struct.Struct("<QII")
+
+
+# A DDSketch-style quantile sketch: values are counted in logarithmic
+# buckets so that every quantile is answered within RELATIVE_ACCURACY, and
+# sketches merge exactly by adding bucket counts.
+class QuantileSketch:
+
+    RELATIVE_ACCURACY = 0.01
+    MAX_BINS = 2048
+    MIN_VALUE = 1e-9
+
+    _GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+    _LOG_GAMMA = math.log(_GAMMA)
+
+    def __init__(self):
+        self.zero = 0
+        self.pos: Dict[int, int] = {}
+        self.neg: Dict[int, int] = {}
+
+
+    @property
+    def count(self) -> int:
+        return self.zero + sum(self.pos.values()) + sum(self.neg.values())
+
+
+    def _index(self, value: float) -> int:
+        return math.ceil(math.log(min(value, sys.float_info.max)) / QuantileSketch._LOG_GAMMA)
+
+
+    def _value(self, index: int) -> float:
+        return 2 * QuantileSketch._GAMMA ** index / (QuantileSketch._GAMMA + 1)
+
+
+    def _collapse(self, store: Dict[int, int]):
+        if len(store) <= QuantileSketch.MAX_BINS:
+            return
+        _indexes = sorted(store)
+        _lowest = _indexes[len(_indexes) - QuantileSketch.MAX_BINS]
+        for _i in _indexes[:len(_indexes) - QuantileSketch.MAX_BINS]:
+            store[_lowest] += store.pop(_i)
+
+
+    def add(self, value: float, count: int = 1) -> None:
+        if value > QuantileSketch.MIN_VALUE:
+            _i = self._index(value)
+            self.pos[_i] = self.pos.get(_i, 0) + count
+            self._collapse(self.pos)
+        elif value < -QuantileSketch.MIN_VALUE:
+            _i = self._index(-value)
+            self.neg[_i] = self.neg.get(_i, 0) + count
+            self._collapse(self.neg)
+        else:
+            self.zero += count
+
+
+    def merge(self, other: "QuantileSketch") -> "QuantileSketch":
+        self.zero += other.zero
+        for _store, _other in ((self.pos, other.pos), (self.neg, other.neg)):
+            for _i, _c in _other.items():
+                _store[_i] = _store.get(_i, 0) + _c
+            self._collapse(_store)
+        return self
+
+
+    def quantile(self, q: float) -> Optional[float]:
+        _count = self.count
+        if not _count:
+            return None
+        _rank = q * (_count - 1)
+        _seen = 0
+        for _i in sorted(self.neg, reverse=True):
+            _seen += self.neg[_i]
+            if _seen > _rank:
+                return -self._value(_i)
+        _seen += self.zero
+        if _seen > _rank:
+            return 0.0
+        for _i in sorted(self.pos):
+            _seen += self.pos[_i]
+            if _seen > _rank:
+                return self._value(_i)
+        return self._value(max(self.pos))
+
+
+    def encode(self) -> bytes:
+        _pos = sorted(self.pos.items())
+        _neg = sorted(self.neg.items())
+        return _HEADER.pack(self.zero, len(_pos), len(_neg)) + struct.pack(
+            f"<{len(_pos)}i{len(_pos)}Q{len(_neg)}i{len(_neg)}Q",
+            *(_i for _i, _ in _pos), *(_c for _, _c in _pos),
+            *(_i for _i, _ in _neg), *(_c for _, _c in _neg),
+        )
+
+
+    @classmethod
+    def decode(cls, data: bytes) -> "QuantileSketch":
+        sketch = cls()
+        sketch.zero, _npos, _nneg = _HEADER.unpack_from(data)
+        _values = struct.unpack_from(f"<{_npos}i{_npos}Q{_nneg}i{_nneg}Q", data, _HEADER.size)
+        sketch.pos = dict(zip(_values[:_npos], _values[_npos:2 * _npos]))
+        _values = _values[2 * _npos:]
+        sketch.neg = dict(zip(_values[:_nneg], _values[_nneg:]))
+        return sketch
+
+
+
+def _sketch_merge(a: Optional[bytes], b: Optional[bytes]) -> Optional[bytes]:
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return QuantileSketch.decode(a).merge(QuantileSketch.decode(b)).encode()
+
+
+class _SketchAggregate:
+
+    def __init__(self):
+        self._sketch = QuantileSketch()
+
+    def step(self, value: Optional[float]):
+        if not value is None:
+            self._sketch.add(value)
+
+    def finalize(self) -> Optional[bytes]:
+        return self._sketch.encode() if self._sketch.count else None
+
+
+class _SketchUnionAggregate:
+
+    def __init__(self):
+        self._sketch = QuantileSketch()
+
+    def step(self, data: Optional[bytes]):
+        if not data is None:
+            self._sketch.merge(QuantileSketch.decode(data))
+
+    def finalize(self) -> Optional[bytes]:
+        return self._sketch.encode() if self._sketch.count else None
+
+
+def register_sketch(conn: sqlite3.Connection) -> None:
+    conn.create_function("sketch_merge", 2, _sketch_merge, deterministic=True)
+    conn.create_aggregate("sketch", 1, _SketchAggregate)
+    conn.create_aggregate("sketch_union", 1, _SketchUnionAggregate)
@@ -1,28 +1,521 @@
 # -*- coding: UTF-8 -*-
 
-from typing import List, Set, Union
+from typing import Any, Callable, Dict, Generator, Iterable, List, Optional, Set, Tuple, Union
 from pathlib import Path
+from threading import Lock
+from concurrent.futures import Future
+import base64
+import json
+import math
 import sqlite3
+from itertools import product
 
-from ..time import Time
+from portalocker import Lock as FileLock
+from portalocker import LockFlags
+
+from ..time import Time, parse_duration
 from ..identifier import TestId, DutId
 from .metric import MetricKey, MetricInfo, MetricEntry
+from ._pool import ConnectionPool
+from ._sketch import QuantileSketch, register_sketch
+from ._hist import FixedHistogram, LogHistogram, TopKHistogram
+from ._ingest import IngestQueue
+
 
 
+_INT_MIN = -2 ** 63
+_INT_MAX = 2 ** 63 - 1
 
-def _dut2strset(dut: Union[DutId, Set[DutId]]) -> Set[str]:
+
+def _dut2set(dut: Union[DutId, Set[DutId]]) -> Set[str]:
     if dut is None:
         dut = set()
-    if isinstance(dut, DutId):
+    if isinstance(dut, str):
         dut = {dut}
-    return {f"#{_d}#" for _d in dut}
+    return {str(_d) for _d in dut}
+
+
+def _insert_dut(conn: sqlite3.Connection, entry_dut: List[Tuple[int, Set[str]]]) -> Dict[str, int]:
+    _names = {_d for _, _dut in entry_dut for _d in _dut}
+    if not _names:
+        return {}
+    conn.executemany(
+        "INSERT OR IGNORE INTO dut (name) VALUES (?)",
+        [(_d,) for _d in _names]
+    )
+    _ids = dict(conn.execute("SELECT name, id FROM dut"))
+    conn.executemany(
+        "INSERT OR IGNORE INTO metric_entry_dut (dut, entry) VALUES (?, ?)",
+        [(_ids[_d], _entry) for _entry, _dut in entry_dut for _d in _dut]
+    )
+    return _ids
+
+
+def _key2cond(key: str) -> Tuple[List[str], List[Any]]:
+    _key = str(key)
+    _prefix = _key
+    for _i, _c in enumerate(_key):
+        if _c in "*?[":
+            _prefix = _key[:_i]
+            break
+    if _prefix == _key:
+        conditions, params = ["key = ?"], [_key]
+    elif not _prefix:
+        conditions, params = ["key GLOB ?"], [_key]
+    else:
+        _upper = _prefix[:-1] + chr(ord(_prefix[-1]) + 1)
+        conditions, params = ["key >= ?", "key < ?", "key GLOB ?"], [_prefix, _upper, _key]
+    # Patterns are resolved against the key dictionary once per statement,
+    # entries and rollups are then matched on integer key ids.
+    return [f"key IN (SELECT id FROM metric_info WHERE {' AND '.join(conditions)})"], params
+
+
+def _time2int(time: Optional[Time], unbounded: Time) -> Optional[int]:
+    if time is None or time == unbounded:
+        return None
+    return int(time)
+
+
+def _entry2conds(
+    key             : str,
+    test            : TestId                = None,
+    dut             : Union[DutId, Set[DutId]] = None,
+    start_time      : Time                  = None,
+    end_time        : Time                  = None,
+) -> List[Tuple[str, List[str], List[Any]]]:
+    conditions, params = _key2cond(key)
+
+    if not test is None:
+        conditions.append("test = ?")
+        params.append(str(test))
+
+    for _d in _dut2set(dut):
+        conditions.append("id IN (SELECT entry FROM metric_entry_dut WHERE dut = (SELECT id FROM dut WHERE name = ?))")
+        params.append(_d)
+
+    if not (_end := _time2int(end_time, Time.max)) is None:
+        conditions.append("time <= ?")
+        params.append(_end)
+
+    if (_start := _time2int(start_time, Time.min)) is None:
+        return [("metric_entry", conditions, params)]
+
+    # Entries starting inside the window are found through the time
+    # indexes, entries still running at start_time through the span R*Tree,
+    # whose float32 bounds are only a candidate filter.
+    return [
+        (
+            "metric_entry",
+            conditions + ["time >= ?"],
+            params + [_start],
+        ),
+        (
+            "metric_entry_span CROSS JOIN metric_entry USING (id)",
+            ["start < ?", "stop >= ?"] + conditions + ["time < ?", "end_time >= ?"],
+            [_start] * 2 + params + [_start] * 2,
+        ),
+    ]
+
+
+def _value2row(
+    key             : MetricKey,
+    time            : int,
+    duration        : int,
+    value           : Any,
+    test            : TestId                = None,
+    dut             : Union[DutId, Set[DutId]] = None,
+) -> Tuple[str, str, int, int, str, Any, Optional[float], Set[str]]:
+    if duration < 0:
+        raise ValueError(f"Negative duration: {duration}")
+    return (
+        str(key),
+        str(TestId("") if test is None else test),
+        int(time),
+        int(duration),
+        *_encode_value(value),
+        _dut2set(dut),
+    )
+
+
+def _entry2row(
+    key             : MetricKey,
+    entry           : MetricEntry,
+    test            : TestId                = None,
+    dut             : Union[DutId, Set[DutId]] = None,
+) -> Tuple[str, str, int, int, str, Any, Optional[float], Set[str]]:
+    return _value2row(key, int(entry.time), entry.duration, entry.value, test, dut)
+
+
+def _encode_cursor(time: int, id: int) -> str:
+    return base64.urlsafe_b64encode(f"{time}:{id}".encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> Tuple[int, int]:
+    try:
+        _raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        _time, _id = _raw.split(":")
+        return int(_time), int(_id)
+    except ValueError:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+
+def _encode_value(value: Any) -> Tuple[str, Any, float]:
+    if value is None:
+        return "none", None, None
+    if isinstance(value, bool):
+        return "bool", int(value), float(value)
+    if isinstance(value, int):
+        if _INT_MIN <= value <= _INT_MAX:
+            return "int", value, float(value)
+        # Beyond SQLite's 64-bit integers, kept exact as JSON.
+        try:
+            return "json", json.dumps(value), float(value)
+        except OverflowError:
+            return "json", json.dumps(value), None
+    if isinstance(value, float):
+        return "float", value, None if value != value else value
+    if isinstance(value, (bytes, bytearray)):
+        return "bytes", bytes(value), None
+    if isinstance(value, str):
+        try:
+            _num = float(value)
+            return "str", value, None if _num != _num else _num
+        except ValueError:
+            return "str", value, None
+    return "json", json.dumps(value, default=str), None
+
+
+def _decode_value(vtype: str, value: Any) -> Any:
+    if vtype == "bool":
+        return bool(value)
+    if vtype == "json":
+        return json.loads(value)
+    return value
+
+
+def _parse_quantile(aggregate: str) -> Optional[float]:
+    if not aggregate.startswith("p"):
+        return None
+    try:
+        _q = float(aggregate[1:]) / 100
+    except ValueError:
+        return None
+    return _q if 0 <= _q <= 1 else None
+
+
+def _exact_quantile(nums: List[float], q: float) -> Optional[float]:
+    if not nums:
+        return None
+    return sorted(nums)[int(q * (len(nums) - 1))]
+
+
+# Partial aggregates are [count, numeric count, sum, min, max] so that raw
+# rows and rollup rows can be merged before the aggregate is finalized;
+# quantile queries append a QuantileSketch.
+def _merge_partial(partials: Dict[Any, list], bucket: Any, partial: Tuple):
+    if not bucket in partials:
+        partials[bucket] = list(partial)
+        return
+    _p = partials[bucket]
+    if len(partial) > 5 and not partial[5] is None:
+        _p[5] = partial[5] if _p[5] is None else _p[5].merge(partial[5])
+    _p[0] += partial[0]
+    _p[1] += partial[1]
+    _p[2] += partial[2]
+    if _p[3] is None or (not partial[3] is None and partial[3] < _p[3]):
+        _p[3] = partial[3]
+    if _p[4] is None or (not partial[4] is None and partial[4] > _p[4]):
+        _p[4] = partial[4]
+
+
+def _add_column(conn: sqlite3.Connection, table: str, column: str, decl: str):
+    _columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    if not column in _columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+
+def _migrate_v1(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS metric_info (
+            key TEXT PRIMARY KEY,
+            name TEXT,
+            description TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS metric_entry (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            test TEXT,
+            dut TEXT,
+            key TEXT,
+            time INTEGER,
+            duration INTEGER,
+            value BLOB
+        )
+    """)
+
+
+def _migrate_v2(conn: sqlite3.Connection):
+    conn.execute("CREATE INDEX IF NOT EXISTS metric_entry_key_time ON metric_entry (key, time)")
+    conn.execute("CREATE INDEX IF NOT EXISTS metric_entry_test_key_time ON metric_entry (test, key, time)")
+    conn.execute("CREATE INDEX IF NOT EXISTS metric_entry_time ON metric_entry (time)")
+
+
+def _migrate_v3(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS dut (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS metric_entry_dut (
+            dut INTEGER,
+            entry INTEGER,
+            PRIMARY KEY (dut, entry)
+        ) WITHOUT ROWID
+    """)
+    cursor = conn.execute("SELECT id, dut FROM metric_entry WHERE dut IS NOT NULL AND dut != ''")
+    while (rows := cursor.fetchmany(10_000)):
+        _insert_dut(conn, [
+            (_id, {_d.strip("#") for _d in _dut.split(",") if _d.strip("#")})
+            for _id, _dut in rows
+        ])
+
+
+def _migrate_v4(conn: sqlite3.Connection):
+    _add_column(conn, "metric_entry", "vtype", "TEXT")
+    _add_column(conn, "metric_entry", "num", "REAL")
+    conn.execute("""
+        UPDATE metric_entry SET
+            vtype = CASE typeof(value)
+                WHEN 'integer' THEN 'int'
+                WHEN 'real' THEN 'float'
+                WHEN 'text' THEN 'str'
+                WHEN 'blob' THEN 'bytes'
+                ELSE 'none'
+            END,
+            num = CASE
+                WHEN typeof(value) IN ('integer', 'real') THEN CAST(value AS REAL)
+                WHEN typeof(value) = 'text' AND CAST(value AS REAL) = value THEN CAST(value AS REAL)
+            END
+        WHERE vtype IS NULL
+    """)
+
+
+def _migrate_v5(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS metric_rollup (
+            level INTEGER,
+            test TEXT,
+            key TEXT,
+            dut INTEGER,
+            bucket INTEGER,
+            count INTEGER,
+            ncount INTEGER,
+            sum REAL,
+            min REAL,
+            max REAL,
+            PRIMARY KEY (level, test, key, dut, bucket)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS metric_rollup_level (
+            level INTEGER PRIMARY KEY
+        )
+    """)
+
+
+def _migrate_v6(conn: sqlite3.Connection):
+    _add_column(conn, "metric_entry", "end_time", "INTEGER GENERATED ALWAYS AS (time + duration) VIRTUAL")
+    conn.execute("""
+        CREATE VIRTUAL TABLE IF NOT EXISTS metric_entry_span USING rtree (
+            id,
+            start,
+            stop
+        )
+    """)
+    conn.execute("""
+        INSERT OR REPLACE INTO metric_entry_span (id, start, stop)
+        SELECT id, time, time + duration FROM metric_entry WHERE duration > 0
+    """)
+
+
+def _migrate_v7(conn: sqlite3.Connection):
+    conn.execute("""
+        CREATE TABLE metric_info_v7 (
+            id INTEGER PRIMARY KEY,
+            key TEXT UNIQUE,
+            name TEXT,
+            description TEXT
+        )
+    """)
+    conn.execute("""
+        INSERT INTO metric_info_v7 (key, name, description)
+        SELECT key, name, description FROM metric_info
+    """)
+    conn.execute("""
+        INSERT OR IGNORE INTO metric_info_v7 (key, name, description)
+        SELECT DISTINCT key, '', '' FROM metric_entry WHERE key IS NOT NULL
+    """)
+    conn.execute("DROP TABLE metric_info")
+    conn.execute("ALTER TABLE metric_info_v7 RENAME TO metric_info")
+
+    _seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'metric_entry'").fetchone()
+    conn.execute("""
+        CREATE TABLE metric_entry_v7 (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            test TEXT,
+            key INTEGER,
+            time INTEGER,
+            duration INTEGER,
+            vtype TEXT,
+            value BLOB,
+            num REAL,
+            end_time INTEGER GENERATED ALWAYS AS (time + duration) VIRTUAL
+        )
+    """)
+    conn.execute("""
+        INSERT INTO metric_entry_v7 (id, test, key, time, duration, vtype, value, num)
+        SELECT e.id, e.test, i.id, e.time, e.duration, e.vtype, e.value, e.num
+        FROM metric_entry e LEFT JOIN metric_info i ON i.key = e.key
+    """)
+    conn.execute("DROP TABLE metric_entry")
+    conn.execute("ALTER TABLE metric_entry_v7 RENAME TO metric_entry")
+    if not _seq is None:
+        conn.execute("DELETE FROM sqlite_sequence WHERE name = 'metric_entry'")
+        conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('metric_entry', ?)", _seq)
+    _migrate_v2(conn)
+
+    conn.execute("""
+        CREATE TABLE metric_rollup_v7 (
+            level INTEGER,
+            test TEXT,
+            key INTEGER,
+            dut INTEGER,
+            bucket INTEGER,
+            count INTEGER,
+            ncount INTEGER,
+            sum REAL,
+            min REAL,
+            max REAL,
+            PRIMARY KEY (level, test, key, dut, bucket)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        INSERT INTO metric_rollup_v7 (level, test, key, dut, bucket, count, ncount, sum, min, max)
+        SELECT r.level, r.test, i.id, r.dut, r.bucket, r.count, r.ncount, r.sum, r.min, r.max
+        FROM metric_rollup r JOIN metric_info i ON i.key = r.key
+    """)
+    conn.execute("DROP TABLE metric_rollup")
+    conn.execute("ALTER TABLE metric_rollup_v7 RENAME TO metric_rollup")
+
+
+def _migrate_v8(conn: sqlite3.Connection):
+    _add_column(conn, "metric_rollup", "sketch", "BLOB")
+    # Existing rollup rows have no sketches, their levels are served from
+    # raw entries again until rebuild_metric_rollup.
+    conn.execute("DELETE FROM metric_rollup_level")
+
+
+_MIGRATIONS: List[Callable[[sqlite3.Connection], None]] = [
+    _migrate_v1,
+    _migrate_v2,
+    _migrate_v3,
+    _migrate_v4,
+    _migrate_v5,
+    _migrate_v6,
+    _migrate_v7,
+    _migrate_v8,
+]
 
 
 
 class MetricDB:
 
-    def __init__(self, filename: Path):
+    READERS = 4
+    BATCH = 1000
+    EXACT = 10_000
+
+    INGEST_BATCH = 5_000
+    INGEST_DELAY = "50ms"
+    INGEST_CAPACITY = 100_000
+
+    ROLLUPS = "1m,1h"
+
+    AGGREGATES = {
+        "sum"   : (lambda p: p[2], True),
+        "avg"   : (lambda p: p[2] / p[1], True),
+        "min"   : (lambda p: p[3], True),
+        "max"   : (lambda p: p[4], True),
+        "count" : (lambda p: p[0], False),
+    }
+
+    HISTOGRAMS = {
+        "fixed" : FixedHistogram,
+        "log"   : LogHistogram,
+        "topk"  : TopKHistogram,
+    }
+
+    PRAGMA_PROFILES = {
+        "default": {
+            "synchronous"   : "NORMAL",
+            "cache_size"    : "-2000",
+            "mmap_size"     : "0",
+            "temp_store"    : "DEFAULT",
+        },
+        "durable": {
+            "synchronous"   : "FULL",
+            "cache_size"    : "-2000",
+            "mmap_size"     : "0",
+            "temp_store"    : "DEFAULT",
+        },
+        "throughput": {
+            "synchronous"   : "NORMAL",
+            "cache_size"    : "-65536",
+            "mmap_size"     : "268435456",
+            "temp_store"    : "MEMORY",
+        },
+    }
+
+    # An attached MetricDB writes to a database owned by another process,
+    # the daemon: it neither migrates nor prunes rollups, and maintains the
+    # rollup levels recorded in the database instead of its own config.
+    def __init__(self, filename: Path, config = None, attach: bool = False):
         self.filename = Path(filename)
+        self._attach = attach
+        if attach and not self.filename.is_file():
+            raise FileNotFoundError(f"Metric database not found: {self.filename}")
+        self._readers = MetricDB.READERS
+        self._batch = MetricDB.BATCH
+        self._exact = MetricDB.EXACT
+        self._ingest_batch = MetricDB.INGEST_BATCH
+        self._ingest_delay = MetricDB.INGEST_DELAY
+        self._ingest_capacity = MetricDB.INGEST_CAPACITY
+        self._profile = "default"
+        self._synchronous = ""
+        self._cache_size = ""
+        self._mmap_size = ""
+        self._temp_store = ""
+        self._rollups = MetricDB.ROLLUPS
+
+        if not config is None:
+            config.pick_to(MetricDB.__name__, self)
+        self._rollup_config = {parse_duration(_l) for _l in self._rollups.split(",") if _l.strip()}
+        self._rollup_levels = sorted(self._rollup_config, reverse=True)
+        self._rollup_built = set()
+        self._key_ids = {}
+        self._ingest = None
+        self._ingest_lock = Lock()
+        self._closed = False
+        # Entry writes of every process, daemon and jobs, take turns on
+        # this lock instead of spinning on SQLITE_BUSY.
+        self._write_lock = FileLock(
+            self.filename.with_name(f"{self.filename.name}.lock"),
+            flags = LockFlags.EXCLUSIVE,
+        )
+        self._pool = ConnectionPool(self.filename, self._readers, self._get_pragmas(), register_sketch)
         self._init_db()
 
 
@@ -30,35 +523,80 @@ class MetricDB:
         return self.filename.as_posix()
 
 
+    def _get_pragmas(self) -> Dict[str, str]:
+        if not self._profile in MetricDB.PRAGMA_PROFILES:
+            raise ValueError(f"Unknown PRAGMA profile: {self._profile}")
+        _pragmas = dict(MetricDB.PRAGMA_PROFILES[self._profile])
+        for _k in _pragmas:
+            if (_v := getattr(self, f"_{_k}")):
+                _pragmas[_k] = _v
+        return _pragmas
+
+
     def _init_db(self):
-        with sqlite3.connect(self.filename) as conn:
+        with self._pool.writer() as conn:
             conn.execute("PRAGMA journal_mode=WAL")
-            cursor = conn.cursor()
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS metric_info (
-                    key TEXT PRIMARY KEY,
-                    name TEXT,
-                    description TEXT
-                )
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS metric_entry (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    test TEXT,
-                    dut TEXT,
-                    key TEXT,
-                    time INTEGER,
-                    duration INTEGER,
-                    value BLOB
-                )
-            """)
+            _version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if self._attach:
+                if _version != len(_MIGRATIONS):
+                    raise RuntimeError(f"Metric database {self.filename} is at version {_version}, expected {len(_MIGRATIONS)}")
+                self._refresh_rollup(conn)
+                return
+            # Daemon, jobs and the CLI may open an unmigrated database at
+            # once: each step runs under the write lock and re-reads the
+            # version inside its transaction, so no step runs twice.
+            if _version < len(_MIGRATIONS):
+                with self._write_lock:
+                    while _version < len(_MIGRATIONS):
+                        with conn:
+                            conn.execute("BEGIN IMMEDIATE")
+                            _version = conn.execute("PRAGMA user_version").fetchone()[0]
+                            if _version < len(_MIGRATIONS):
+                                _MIGRATIONS[_version](conn)
+                                _version += 1
+                                conn.execute(f"PRAGMA user_version = {_version}")
+            self._init_rollup(conn)
+
+
+    def _init_rollup(self, conn: sqlite3.Connection):
+        # Levels added to an empty database are complete right away; for
+        # existing data they are only served after rebuild_metric_rollup.
+        if conn.execute("SELECT NOT EXISTS (SELECT 1 FROM metric_entry)").fetchone()[0]:
+            conn.executemany(
+                "INSERT OR IGNORE INTO metric_rollup_level (level) VALUES (?)",
+                [(_level,) for _level in self._rollup_config]
+            )
             conn.commit()
+        self._refresh_rollup(conn)
+
+
+    # Openers may be configured with different levels: every writer keeps
+    # the levels already built in the database up to date besides its own,
+    # and only rebuild_metric_rollup drops levels.
+    def _refresh_rollup(self, conn: sqlite3.Connection):
+        _built = {row[0] for row in conn.execute("SELECT level FROM metric_rollup_level")}
+        _levels = _built if self._attach else _built | self._rollup_config
+        self._rollup_levels = sorted(_levels, reverse=True)
+        self._rollup_built = _built
+
+
+    # Queued rows are committed before the pool closes; a closed database
+    # raises RuntimeError instead of opening itself again.
+    def close(self) -> None:
+        with self._ingest_lock:
+            self._closed = True
+            _ingest, self._ingest = self._ingest, None
+        try:
+            if not _ingest is None:
+                _ingest.close()
+        finally:
+            self._pool.close()
 
 
     def list_metric_info(
         self
     ) -> List[MetricInfo]:
-        with sqlite3.connect(self.filename) as conn:
+        with self._pool.reader() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT key, name, description FROM metric_info")
             return [MetricInfo(*row) for row in cursor.fetchall()]
@@ -68,7 +606,7 @@ class MetricDB:
         self,
         key         : MetricKey
     ) -> MetricInfo:
-        with sqlite3.connect(self.filename) as conn:
+        with self._pool.reader() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT name, description FROM metric_info WHERE key = ?",
@@ -85,12 +623,14 @@ class MetricDB:
         self,
         info        : MetricInfo
     ) -> None:
-        with sqlite3.connect(self.filename) as conn:
+        with self._pool.writer() as conn, conn:
             cursor = conn.cursor()
-            cursor.execute(
-                "INSERT OR REPLACE INTO metric_info VALUES (?, ?, ?)",
-                (str(info.key), info.name, info.description)
-            )
+            cursor.execute("""
+                INSERT INTO metric_info (key, name, description) VALUES (?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                    name = excluded.name,
+                    description = excluded.description
+            """, (str(info.key), info.name, info.description))
             conn.commit()
 
 
@@ -101,44 +641,419 @@ class MetricDB:
         dut         : Union[DutId, Set[DutId]] = None,
         start_time  : Time                  = None,
         end_time    : Time                  = None,
+        limit       : Optional[int]         = None,
+        after       : Optional[str]         = None,
     ) -> List[MetricEntry]:
-        if dut is None:
-            dut = set()
+        return list(self.iter_metric_entry(key, test, dut, start_time, end_time, limit, after))
 
-        conditions = []
-        params = []
 
-        conditions.append("key GLOB ?")
-        params.append(key)
-
-        if not test is None:
-            conditions.append("test = ?")
-            params.append(str(test))
-        
-        for _d in _dut2strset(dut):
-            conditions.append("dut LIKE ? ESCAPE '\\'")
-            params.append(f"%{_d.replace("_", "\\_")}%")
-        
-        if not start_time is None:
-            conditions.append("time + duration >= ?")
-            params.append(int(start_time))
-        
-        if not end_time is None:
-            conditions.append("time <= ?")
-            params.append(int(end_time))
-        
+    def query_metric_page(
+        self,
+        key         : str,
+        test        : TestId                = None,
+        dut         : Union[DutId, Set[DutId]] = None,
+        start_time  : Time                  = None,
+        end_time    : Time                  = None,
+        limit       : int                   = BATCH,
+        after       : Optional[str]         = None,
+    ) -> Tuple[List[MetricEntry], Optional[str]]:
+        _rows = list(self._iter_rows(key, test, dut, start_time, end_time, limit + 1, after))
+        _next = None
+        if len(_rows) > limit:
+            _rows = _rows[:limit]
+            _next = _encode_cursor(_rows[-1][1], _rows[-1][0])
+        return [
+            MetricEntry(_time, _duration, _decode_value(_vtype, _value))
+            for _, _time, _duration, _vtype, _value in _rows
+        ], _next
+
+
+    def iter_metric_entry(
+        self,
+        key         : str,
+        test        : TestId                = None,
+        dut         : Union[DutId, Set[DutId]] = None,
+        start_time  : Time                  = None,
+        end_time    : Time                  = None,
+        limit       : Optional[int]         = None,
+        after       : Optional[str]         = None,
+        batch       : int                   = None,
+    ) -> Generator[MetricEntry, None, None]:
+        _rows = self._iter_rows(key, test, dut, start_time, end_time, limit, after, batch)
+        return (
+            MetricEntry(_time, _duration, _decode_value(_vtype, _value))
+            for _, _time, _duration, _vtype, _value in _rows
+        )
+
+
+    def _iter_rows(
+        self,
+        key         : str,
+        test        : TestId                = None,
+        dut         : Union[DutId, Set[DutId]] = None,
+        start_time  : Time                  = None,
+        end_time    : Time                  = None,
+        limit       : Optional[int]         = None,
+        after       : Optional[str]         = None,
+        batch       : int                   = None,
+    ) -> Generator[Tuple[int, int, int, str, Any], None, None]:
+        if batch is None:
+            batch = self._batch
+        _after = None if after is None else _decode_cursor(after)
+        _selects = []
+        params = []
+        for _source, _conditions, _params in _entry2conds(key, test, dut, start_time, end_time):
+            if not _after is None:
+                _conditions = _conditions + ["(time, id) > (?, ?)"]
+                _params = _params + list(_after)
+            _selects.append(f"""
+                SELECT id, time, duration, vtype, value
+                FROM {_source}
+                WHERE {' AND '.join(_conditions)}
+            """)
+            params.extend(_params)
         query = f"""
-            SELECT time, duration, value 
-            FROM metric_entry 
-            WHERE {' AND '.join(conditions)}
-            ORDER BY time
+            {'UNION ALL'.join(_selects)}
+            ORDER BY time, id
         """
-        
-        with sqlite3.connect(self.filename) as conn:
-            conn.row_factory = sqlite3.Row
+        if not limit is None:
+            query += "LIMIT ?"
+            params.append(int(limit))
+        return self._fetch(query, params, batch)
+
+
+    def _fetch(
+        self,
+        query       : str,
+        params      : List[Any],
+        batch       : int,
+    ) -> Generator[Tuple, None, None]:
+        with self._pool.reader() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(query, params)
+                while (rows := cursor.fetchmany(batch)):
+                    yield from rows
+            finally:
+                cursor.close()
+
+
+    def _pick_rollup(
+        self,
+        interval    : Optional[int],
+        dut         : Set[str],
+    ) -> Optional[int]:
+        if len(dut) > 1:
+            return None
+        for _level in self._rollup_levels:
+            if not _level in self._rollup_built:
+                continue
+            if interval is None or interval % _level == 0:
+                return _level
+        return None
+
+
+    def _query_partials(
+        self,
+        interval    : Optional[int],
+        key         : str,
+        test        : TestId                = None,
+        dut         : Union[DutId, Set[DutId]] = None,
+        start_time  : Time                  = None,
+        end_time    : Time                  = None,
+        sketch      : bool                  = False,
+    ) -> Dict[int, list]:
+        _dut = _dut2set(dut)
+        _start = _time2int(start_time, Time.min)
+        _end = _time2int(end_time, Time.max)
+
+        # Whole rollup buckets inside [start, end] come from the rollup
+        # table and the partial buckets at either edge from raw entries.
+        _raw = [(None, None)]
+        _rollup = None
+        _level = self._pick_rollup(interval, _dut)
+        if not _level is None:
+            _lo = None if _start is None else -(-_start // _level) * _level
+            _hi = None if _end is None else (_end + 1) // _level * _level
+            if _lo is None or _hi is None or _lo < _hi:
+                _rollup = (_lo, _hi)
+                _raw = [
+                    _segment
+                    for _segment in [(None, _lo), (_hi, None)]
+                    if not _segment == (None, None)
+                ]
+
+        if interval is None:
+            _bucket, _bucket_params = "0", []
+        else:
+            _bucket, _bucket_params = "{0} - (({0} % ?) + ?) % ?", [interval] * 3
+
+        _queries = []
+        for (_lo, _hi), (_source, conditions, params) in product(
+            _raw,
+            _entry2conds(key, test, _dut, start_time, end_time),
+        ):
+            if not _lo is None:
+                conditions = conditions + ["time >= ?"]
+                params = params + [_lo]
+            if not _hi is None:
+                conditions = conditions + ["time < ?"]
+                params = params + [_hi]
+            _queries.append((f"""
+                SELECT {_bucket.format("time")} AS b, COUNT(*), COUNT(num), TOTAL(num), MIN(num), MAX(num)
+                    {", sketch(num)" if sketch else ""}
+                FROM {_source}
+                WHERE {' AND '.join(conditions)}
+                GROUP BY b
+            """, _bucket_params + params))
+
+        if not _rollup is None:
+            conditions, params = _key2cond(key)
+            conditions.append("level = ?")
+            params.append(_level)
+            if not test is None:
+                conditions.append("test = ?")
+                params.append(str(test))
+            if _dut:
+                conditions.append("dut = (SELECT id FROM dut WHERE name = ?)")
+                params.extend(_dut)
+            else:
+                conditions.append("dut = 0")
+            if not _rollup[0] is None:
+                conditions.append("bucket >= ?")
+                params.append(_rollup[0])
+            if not _rollup[1] is None:
+                conditions.append("bucket < ?")
+                params.append(_rollup[1])
+            _queries.append((f"""
+                SELECT {_bucket.format("bucket")} AS b, SUM(count), SUM(ncount), TOTAL(sum), MIN(min), MAX(max)
+                    {", sketch_union(sketch)" if sketch else ""}
+                FROM metric_rollup
+                WHERE {' AND '.join(conditions)}
+                GROUP BY b
+            """, _bucket_params + params))
+
+        partials = {}
+        with self._pool.reader() as conn:
+            cursor = conn.cursor()
+            for query, params in _queries:
+                cursor.execute(query, params)
+                for _b, *_partial in cursor.fetchall():
+                    if sketch and not _partial[5] is None:
+                        _partial[5] = QuantileSketch.decode(_partial[5])
+                    _merge_partial(partials, _b, _partial)
+        return partials
+
+
+    def _iter_nums(
+        self,
+        interval    : Optional[int],
+        key         : str,
+        test        : TestId                = None,
+        dut         : Union[DutId, Set[DutId]] = None,
+        start_time  : Time                  = None,
+        end_time    : Time                  = None,
+    ) -> Generator[Tuple[int, float], None, None]:
+        if interval is None:
+            _bucket, _bucket_params = "0", []
+        else:
+            _bucket, _bucket_params = "time - ((time % ?) + ?) % ?", [interval] * 3
+        _selects = []
+        params = []
+        for _source, _conditions, _params in _entry2conds(key, test, dut, start_time, end_time):
+            _selects.append(f"""
+                SELECT {_bucket} AS b, num
+                FROM {_source}
+                WHERE {' AND '.join(_conditions + ["num IS NOT NULL"])}
+            """)
+            params.extend(_bucket_params + _params)
+        return self._fetch("UNION ALL".join(_selects), params, self._batch)
+
+
+    def _query_nums(
+        self,
+        interval    : Optional[int],
+        key         : str,
+        test        : TestId                = None,
+        dut         : Union[DutId, Set[DutId]] = None,
+        start_time  : Time                  = None,
+        end_time    : Time                  = None,
+    ) -> Dict[int, List[float]]:
+        nums = {}
+        for _b, _num in self._iter_nums(interval, key, test, dut, start_time, end_time):
+            nums.setdefault(_b, []).append(_num)
+        return nums
+
+
+    # Histogram bounds over finite nums only, 9e999 reads as inf in SQLite
+    # and NaN is stored as NULL; positive restricts lo to log-scale values.
+    def _query_finite_bounds(
+        self,
+        positive    : bool,
+        key         : str,
+        test        : TestId                = None,
+        dut         : Union[DutId, Set[DutId]] = None,
+        start_time  : Time                  = None,
+        end_time    : Time                  = None,
+    ) -> Tuple[Optional[float], Optional[float]]:
+        _los = []
+        _his = []
+        with self._pool.reader() as conn:
             cursor = conn.cursor()
-            cursor.execute(query, params)
-            return [MetricEntry(*row) for row in cursor.fetchall()]
+            for _source, conditions, params in _entry2conds(key, test, dut, start_time, end_time):
+                cursor.execute(f"""
+                    SELECT MIN(CASE WHEN num > ? THEN num END), MAX(num)
+                    FROM {_source}
+                    WHERE {' AND '.join(conditions + ["num > -9e999", "num < 9e999"])}
+                """, [0 if positive else -math.inf] + params)
+                for _lo, _hi in cursor.fetchall():
+                    if not _lo is None:
+                        _los.append(_lo)
+                    if not _hi is None:
+                        _his.append(_hi)
+        return min(_los, default=None), max(_his, default=None)
+
+
+    def _get_aggregate(
+        self,
+        aggregate   : str,
+    ) -> Tuple[Callable[[list], Any], bool, Optional[float]]:
+        if aggregate in MetricDB.AGGREGATES:
+            return (*MetricDB.AGGREGATES[aggregate], None)
+        if (_q := _parse_quantile(aggregate)) is None:
+            raise ValueError(f"Unknown aggregate: {aggregate}")
+        return (lambda p: p[5].quantile(_q), True, _q)
+
+
+    def _query_aggregate(
+        self,
+        aggregate   : str,
+        interval    : Optional[int],
+        key         : str,
+        test        : TestId                = None,
+        dut         : Union[DutId, Set[DutId]] = None,
+        start_time  : Time                  = None,
+        end_time    : Time                  = None,
+    ) -> Dict[int, Any]:
+        _finalize, _numeric, _q = self._get_aggregate(aggregate)
+        _query = (interval, key, test, dut, start_time, end_time)
+        _partials = self._query_partials(*_query)
+        # Quantiles count first, from rollups where built: small ranges are
+        # answered exactly and sketches are only merged for large ones.
+        if not _q is None:
+            if sum(_p[1] for _p in _partials.values()) <= self._exact:
+                return {
+                    _bucket: _exact_quantile(_nums, _q)
+                    for _bucket, _nums in self._query_nums(*_query).items()
+                }
+            _partials = self._query_partials(*_query, sketch=True)
+        return {
+            _bucket: _finalize(_partial)
+            for _bucket, _partial in _partials.items()
+            if _partial[0] and (_partial[1] or not _numeric)
+        }
+
+
+    def query_metric_aggregate(
+        self,
+        aggregate   : str,
+        key         : str,
+        test        : TestId                = None,
+        dut         : Union[DutId, Set[DutId]] = None,
+        start_time  : Time                  = None,
+        end_time    : Time                  = None,
+    ) -> Any:
+        _result = self._query_aggregate(aggregate, None, key, test, dut, start_time, end_time)
+        if 0 in _result:
+            return _result[0]
+        _finalize, _numeric, _ = self._get_aggregate(aggregate)
+        return None if _numeric else _finalize([0, 0, 0.0, None, None])
+
+
+    def query_metric_bucket(
+        self,
+        aggregate   : str,
+        interval    : int,
+        key         : str,
+        test        : TestId                = None,
+        dut         : Union[DutId, Set[DutId]] = None,
+        start_time  : Time                  = None,
+        end_time    : Time                  = None,
+    ) -> List[MetricEntry]:
+        if interval <= 0:
+            raise ValueError(f"Non-positive interval: {interval}")
+        _result = self._query_aggregate(aggregate, interval, key, test, dut, start_time, end_time)
+        return [
+            MetricEntry(_bucket, interval, _value)
+            for _bucket, _value in sorted(_result.items())
+        ]
+
+
+    def query_metric_histogram(
+        self,
+        mode        : str,
+        bins        : int,
+        key         : str,
+        test        : TestId                = None,
+        dut         : Union[DutId, Set[DutId]] = None,
+        start_time  : Time                  = None,
+        end_time    : Time                  = None,
+        lo          : Optional[float]       = None,
+        hi          : Optional[float]       = None,
+    ) -> Dict[str, Any]:
+        if not mode in MetricDB.HISTOGRAMS:
+            raise ValueError(f"Unknown histogram mode: {mode}")
+        if bins <= 0:
+            raise ValueError(f"Non-positive bins: {bins}")
+        _query = (key, test, dut, start_time, end_time)
+
+        if mode == "topk":
+            hist = TopKHistogram(bins)
+            for _entry in self.iter_metric_entry(*_query):
+                hist.add(_entry.value)
+            return {"mode": mode, **hist.result()}
+
+        for _bound in (lo, hi):
+            if not _bound is None and not math.isfinite(_bound):
+                raise ValueError(f"Non-finite histogram bound: {_bound}")
+        if lo is None or hi is None:
+            _lo, _hi = self._query_finite_bounds(mode == "log", *_query)
+            lo = _lo if lo is None else lo
+            hi = _hi if hi is None else hi
+        if lo is None or hi is None or hi < lo:
+            return {"mode": mode, "bins": [], "under": 0, "over": 0}
+        hist = MetricDB.HISTOGRAMS[mode](lo, hi, bins)
+        for _, _num in self._iter_nums(None, *_query):
+            hist.add(_num)
+        return {"mode": mode, **hist.result()}
+
+
+    def rebuild_metric_rollup(self) -> None:
+        if self._attach:
+            raise RuntimeError("Rollups of an attached metric database are rebuilt by its owner")
+        with self._pool.writer() as conn, self._write_lock, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("DELETE FROM metric_rollup")
+            conn.execute("DELETE FROM metric_rollup_level")
+            for _level in self._rollup_config:
+                conn.execute("""
+                    INSERT INTO metric_rollup (level, test, key, dut, bucket, count, ncount, sum, min, max, sketch)
+                    SELECT ?, test, key, 0, time - ((time % ?) + ?) % ? AS b,
+                        COUNT(*), COUNT(num), TOTAL(num), MIN(num), MAX(num), sketch(num)
+                    FROM metric_entry
+                    GROUP BY test, key, b
+                """, [_level] * 4)
+                conn.execute("""
+                    INSERT INTO metric_rollup (level, test, key, dut, bucket, count, ncount, sum, min, max, sketch)
+                    SELECT ?, e.test, e.key, d.dut, e.time - ((e.time % ?) + ?) % ? AS b,
+                        COUNT(*), COUNT(e.num), TOTAL(e.num), MIN(e.num), MAX(e.num), sketch(e.num)
+                    FROM metric_entry_dut d JOIN metric_entry e ON e.id = d.entry
+                    GROUP BY e.test, e.key, d.dut, b
+                """, [_level] * 4)
+                conn.execute("INSERT INTO metric_rollup_level (level) VALUES (?)", (_level,))
+            conn.commit()
+        self._rollup_levels = sorted(self._rollup_config, reverse=True)
+        self._rollup_built = set(self._rollup_config)
 
 
     def add_metric_entry(
@@ -148,20 +1063,177 @@ class MetricDB:
         test        : TestId                = None,
         dut         : Union[DutId, Set[DutId]] = None,
     ) -> None:
-        if test is None:
-            test = TestId("")
-        if dut is None:
-            dut = set()
-        
-        with sqlite3.connect(self.filename) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT OR IGNORE INTO metric_info (key, name, description) VALUES (?, ?, ?)",
-                (str(key), "", "")
+        self.add_metric_entries([(key, entry, test, dut)])
+
+
+    def add_metric_entries(
+        self,
+        entries     : Iterable[Tuple[MetricKey, MetricEntry, TestId, Union[DutId, Set[DutId]]]],
+    ) -> None:
+        self._add_rows([_entry2row(*_entry) for _entry in entries])
+
+
+    def enqueue_metric_entries(
+        self,
+        entries     : Iterable[Tuple[MetricKey, MetricEntry, TestId, Union[DutId, Set[DutId]]]],
+        timeout     : Optional[float]       = None,
+    ) -> Future:
+        # Rows are encoded before queueing so that bad entries fail here
+        # and not in the writer thread's group commit.
+        _rows = [_entry2row(*_entry) for _entry in entries]
+        return self._enqueue(_rows, timeout)
+
+
+    def enqueue_metric_values(
+        self,
+        values      : Iterable[Tuple[MetricKey, int, int, Any, TestId, Union[DutId, Set[DutId]]]],
+        timeout     : Optional[float]       = None,
+    ) -> Future:
+        # Times and durations are integer microseconds, for ingest paths
+        # that never build Time or MetricEntry objects.
+        _rows = [_value2row(*_value) for _value in values]
+        return self._enqueue(_rows, timeout)
+
+
+    # The future resolves once the rows are committed, failing with the
+    # error of any row that could not be.
+    def _enqueue(self, rows: List[Tuple], timeout: Optional[float]) -> Future:
+        if rows:
+            return self._get_ingest().put(rows, timeout)
+        _future = Future()
+        _future.set_result(None)
+        return _future
+
+
+    def flush(
+        self,
+        timeout     : Optional[float]       = None,
+    ) -> bool:
+        with self._ingest_lock:
+            _ingest = self._ingest
+        return True if _ingest is None else _ingest.flush(timeout)
+
+
+    def query_ingest_stats(self) -> Dict[str, Any]:
+        return self._get_ingest().stats()
+
+
+    def grant_ingest_credit(
+        self,
+        count       : int,
+        force       : bool                  = False,
+    ) -> int:
+        return self._get_ingest().grant(count, force)
+
+
+    def release_ingest_credit(
+        self,
+        count       : int,
+    ) -> None:
+        self._get_ingest().release(count)
+
+
+    def _get_ingest(self) -> IngestQueue:
+        with self._ingest_lock:
+            if self._closed:
+                raise RuntimeError(f"Metric database {self.filename} is closed")
+            if self._ingest is None:
+                self._ingest = IngestQueue(
+                    self._add_rows,
+                    self._ingest_batch,
+                    parse_duration(self._ingest_delay) / Time.UNIT_RATE,
+                    self._ingest_capacity,
+                    name = f"ingest_{self.filename.parent.name}",
+                )
+            return self._ingest
+
+
+    def _add_rows(
+        self,
+        rows        : List[Tuple[str, str, int, int, str, Any, Optional[float], Set[str]]],
+    ) -> None:
+        if not rows:
+            return
+
+        with self._pool.writer() as conn, self._write_lock, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._refresh_rollup(conn)
+            _key_ids = self._insert_key(conn, {_row[0] for _row in rows})
+            # Entry ids are assigned here so that DUT associations can be
+            # batched too; the write lock is held since BEGIN IMMEDIATE.
+            _seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'metric_entry'").fetchone()
+            _seq = 0 if _seq is None else _seq[0]
+            _values = [
+                (_seq + _i, _test, _key_ids[_key], *_row)
+                for _i, (_key, _test, *_row, _) in enumerate(rows, 1)
+            ]
+            conn.executemany(
+                "INSERT INTO metric_entry (id, test, key, time, duration, vtype, value, num) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                _values
             )
-            cursor.execute(
-                "INSERT INTO metric_entry (test, dut, key, time, duration, value) VALUES (?, ?, ?, ?, ?, ?)",
-                (str(test), ",".join(_dut2strset(dut)), str(key), int(entry.time), int(entry.duration), entry.value)
+            conn.executemany(
+                "INSERT INTO metric_entry_span (id, start, stop) VALUES (?, ?, ?)",
+                [
+                    (_id, _time, _time + _duration)
+                    for _id, _, _, _time, _duration, *_ in _values
+                    if _duration > 0
+                ]
             )
+            _ids = _insert_dut(conn, [
+                (_seq + _i, _dut)
+                for _i, (*_, _dut) in enumerate(rows, 1)
+            ])
+            self._update_rollup(conn, [
+                (_test, _key, [0, *(_ids[_d] for _d in _dut)], _time, _num)
+                for (_, _test, _key, _time, _, _, _, _num), (*_, _dut) in zip(_values, rows)
+            ])
             conn.commit()
+        # Only committed ids are cached, a rolled back id may be reused.
+        self._key_ids.update(_key_ids)
+
+
+    def _insert_key(
+        self,
+        conn        : sqlite3.Connection,
+        keys        : Set[str],
+    ) -> Dict[str, int]:
+        _missing = [_key for _key in keys if not _key in self._key_ids]
+        conn.executemany(
+            "INSERT OR IGNORE INTO metric_info (key, name, description) VALUES (?, '', '')",
+            [(_key,) for _key in _missing]
+        )
+        _ids = {_key: self._key_ids[_key] for _key in keys if _key in self._key_ids}
+        for _key in _missing:
+            _ids[_key] = conn.execute("SELECT id FROM metric_info WHERE key = ?", (_key,)).fetchone()[0]
+        return _ids
 
+
+    def _update_rollup(
+        self,
+        conn        : sqlite3.Connection,
+        samples     : List[Tuple[str, int, List[int], int, Optional[float]]],
+    ) -> None:
+        partials = {}
+        sketches = {}
+        for _level in self._rollup_levels:
+            for _test, _key, _dut, _time, _num in samples:
+                _partial = (1, 0, 0.0, None, None) if _num is None else (1, 1, _num, _num, _num)
+                for _d in _dut:
+                    _bucket = (_level, _test, _key, _d, _time - _time % _level)
+                    _merge_partial(partials, _bucket, _partial)
+                    if not _num is None:
+                        sketches.setdefault(_bucket, QuantileSketch()).add(_num)
+        conn.executemany("""
+            INSERT INTO metric_rollup (level, test, key, dut, bucket, count, ncount, sum, min, max, sketch)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (level, test, key, dut, bucket) DO UPDATE SET
+                count = count + excluded.count,
+                ncount = ncount + excluded.ncount,
+                sum = sum + excluded.sum,
+                min = MIN(COALESCE(min, excluded.min), COALESCE(excluded.min, min)),
+                max = MAX(COALESCE(max, excluded.max), COALESCE(excluded.max, max)),
+                sketch = sketch_merge(sketch, excluded.sketch)
+        """, [
+            (*_k, *_p, sketches[_k].encode() if _k in sketches else None)
+            for _k, _p in partials.items()
+        ])
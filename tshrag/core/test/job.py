@@ -22,6 +22,7 @@ class Job(Run):
     env             : Dict[str, str]        = field(default_factory=dict)
     pid             : Optional[int]         = None
     retcode         : Optional[int]         = None
+    ring            : Dict[str, Any]        = field(default_factory=dict)
 
     def __post_init__(self):
         super().__post_init__()
@@ -33,5 +34,6 @@ class Job(Run):
         self.env = {str(k): str(v) for k, v in self.env.items()}
         self.pid = self.pid and int(self.pid)
         self.retcode = self.retcode and int(self.retcode)
+        self.ring = dict(self.ring)
 
 
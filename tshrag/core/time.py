@@ -1,5 +1,7 @@
 # -*- coding: UTF-8 -*-
 
+import re
+
 from datetime import datetime
 from datetime import timedelta
 from datetime import timezone
@@ -84,3 +86,20 @@ Time.min = Time("min")
 Time.max = Time("max")
 
 
+DURATION_UNITS = {
+    ""      : 1,
+    "us"    : 1,
+    "ms"    : Time.UNIT_RATE // 1_000,
+    "s"     : Time.UNIT_RATE,
+    "m"     : Time.UNIT_RATE * 60,
+    "h"     : Time.UNIT_RATE * 3_600,
+    "d"     : Time.UNIT_RATE * 86_400,
+}
+
+
+def parse_duration(duration: str) -> int:
+    _match = re.fullmatch(r"\s*(\d+(?:\.\d*)?)\s*([a-z]*)\s*", str(duration).lower())
+    if _match is None or not _match[2] in DURATION_UNITS:
+        raise ValueError(f"Invalid duration: {duration}")
+    return int(float(_match[1]) * DURATION_UNITS[_match[2]])
+
@@ -13,7 +13,8 @@ import os
 import shlex
 
 from pathlib import Path
-from threading import Thread
+from threading import Thread, Event, Condition
+from concurrent.futures import Future, CancelledError
 from subprocess import Popen
 
 import seqript.seqript
@@ -28,6 +29,8 @@ from ..core import MetricKey, MetricInfo, MetricEntry
 from ..core import MetricDB
 from ..core import Profile
 from ..core import RunStatus, Run, Job, Test
+from ..core import parse_duration
+from ..core.metric._ring import MetricRing
 
 from ..tshrag import Tshrag
 
@@ -45,13 +48,112 @@ from ..util.consts import ENV_TEST_ID
 from ..util.consts import ENV_TEST_MACHINE
 from ..util.consts import ENV_TEST_DEVICE
 from ..util.consts import ENV_TEST_DIR
+from ..util.consts import ENV_TEST_MDB
 from ..util.consts import ENV_JOB_ID
+from ..util.consts import ENV_JOB_RING
 from ..util.consts import ENV_JOB_MACHINE
 from ..util.consts import ENV_JOB_DEVICE
 from ..util.consts import ENV_JOB_DIR
 
 
 
+# Failures of a ring drain, counted in records: failed ones were drained
+# but never stored, skipped ones had a key that does not decode. Batches
+# are tracked until committed, wait() returns once every one has been.
+class _DrainStats:
+
+    def __init__(self):
+        self.failed = 0
+        self.skipped = 0
+        self.error = None
+        self._pending = 0
+        self._cond = Condition()
+
+
+    def fail(self, count: int, error: BaseException) -> None:
+        with self._cond:
+            self.failed += count
+            self.error = error
+
+
+    def track(self, count: int, future: Future) -> None:
+        with self._cond:
+            self._pending += 1
+        future.add_done_callback(lambda f: self._done(count, f))
+
+
+    def _done(self, count: int, future: Future) -> None:
+        _error = CancelledError() if future.cancelled() else future.exception()
+        with self._cond:
+            if not _error is None:
+                self.failed += count
+                self.error = _error
+            self._pending -= 1
+            self._cond.notify_all()
+
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pending == 0, timeout)
+
+
+    def asdict(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "failed"    : self.failed,
+                "skipped"   : self.skipped,
+                "error"     : None if self.error is None else repr(self.error),
+            }
+
+
+
+def _decode_key(key: bytes) -> Optional[MetricKey]:
+    _key = MetricKey(key.decode(ENCODING, errors="replace"))
+    return _key if _key else None
+
+
+# Drains a job's metric ring into the test's database until the job has
+# exited. When the database falls behind, the ingest queue blocks this
+# thread and the ring fills up, so the producer drops and never waits.
+# A failing batch is counted and the drain goes on with the next one.
+def _drain_ring(
+    tshrag          : Tshrag,
+    test_id         : TestId,
+    ring            : MetricRing,
+    stop            : Event,
+    stats           : _DrainStats,
+) -> None:
+    _keys: Dict[bytes, Optional[MetricKey]] = {}
+    _delay = parse_duration(MetricRing.DELAY) / Time.UNIT_RATE
+    while True:
+        _stopped = stop.wait(_delay)
+        _values = []
+        try:
+            with tshrag.use_mdb(test_id) as _mdb:
+                for _key, _time, _duration, _value in ring.drain():
+                    if not _key in _keys:
+                        _keys[_key] = _decode_key(_key)
+                    if _keys[_key] is None:
+                        stats.skipped += 1
+                        continue
+                    _values.append((_keys[_key], _time, _duration, _value, test_id, None))
+                if _values and not _mdb is None:
+                    stats.track(len(_values), _mdb.enqueue_metric_values(_values))
+        except Exception as e:
+            stats.fail(len(_values), e)
+        if _stopped:
+            return
+
+
+def _close_ring(ring: MetricRing) -> None:
+    ring.close()
+    for _path in [ring.filename, Path(f"{ring.filename}.lock")]:
+        try:
+            _path.unlink(missing_ok=True)
+        except OSError as e:
+            pass
+
+
 def _engine_cmd(
     tshrag          : Tshrag,
     test_id         : TestId,
@@ -70,13 +172,17 @@ def _engine_cmd(
             job_prefix = seqript.name,
         )
         job_id = job.id
+        try:
+            ring = tshrag.create_job_ring(test_id, job_id)
+        except OSError as e:
+            ring = None
         cwd = seqript.cwd.as_posix()
         env = seqript.env | {
             ENV_JOB_ID: job_id,
             ENV_JOB_MACHINE: job_machine,
             ENV_JOB_DEVICE: ";".join(job_device),
             ENV_JOB_DIR: cwd
-        }
+        } | ({ENV_JOB_RING: ring.filename.resolve().as_posix()} if ring else {})
         cmd = [
             expand_variable(c, env)
             for c in cmd
@@ -88,24 +194,47 @@ def _engine_cmd(
             job.cwd     = cwd
             job.env     = env
         
-        with tshrag.update_job(test_id, job_id) as job:
-            job.status = RunStatus.RUNNING
-            job.start_time = Time.now()
-            try:
-                proc = Popen(
-                    args=job.args,
-                    cwd=job.cwd,
-                    env=(os.environ | job.env),
-                )
-                job.pid = proc.pid
-            except Exception as e:
-                job.status = RunStatus.CRASHED
-                job.pid = None
-                job.retcode = None
-                return
+        stop = Event()
+        drain = None
+        drain_stats = _DrainStats()
+        try:
+            with tshrag.update_job(test_id, job_id) as job:
+                job.status = RunStatus.RUNNING
+                job.start_time = Time.now()
+                try:
+                    proc = Popen(
+                        args=job.args,
+                        cwd=job.cwd,
+                        env=(os.environ | job.env),
+                    )
+                    job.pid = proc.pid
+                except Exception as e:
+                    job.status = RunStatus.CRASHED
+                    job.pid = None
+                    job.retcode = None
+                    return
 
-        proc.wait()
+            if ring:
+                drain = Thread(
+                    target  = _drain_ring,
+                    args    = (tshrag, test_id, ring, stop, drain_stats),
+                    name    = f"{SYM_TSHRAG}_ring_{job_id}",
+                    daemon  = True,
+                )
+                drain.start()
+            proc.wait()
+        finally:
+            stop.set()
+            if drain:
+                drain.join()
+                # Report once the drained rows are committed or failed.
+                drain_stats.wait(TIMEOUT)
+            if ring:
+                _dropped = ring.dropped
+                _close_ring(ring)
         with tshrag.update_job(test_id, job_id) as job:
+            if ring:
+                job.ring = {"dropped": _dropped} | drain_stats.asdict()
             job.end_time = Time.now()
             job.retcode = proc.returncode
             if proc.returncode:
@@ -132,7 +261,7 @@ def execute(
                 ENV_TEST_ID: test_id,
                 ENV_TEST_MACHINE: ";".join(test.machine),
                 ENV_TEST_DEVICE: ";".join(test.device),
-            },
+            } | ({ENV_TEST_MDB: test.mdb.resolve().as_posix()} if test.mdb else {}),
             engines = Seqript._DEFAULT_ENGINES | {
                 "cmd"   : _engine_cmd(tshrag, test_id, machine, test.device),
                 "sleep" : seqript.engine.contrib.sleep,
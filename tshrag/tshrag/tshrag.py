@@ -12,9 +12,11 @@ import time
 import os
 
 from pathlib import Path
+from collections import OrderedDict
 from contextlib import contextmanager
 from dataclasses import asdict
-from threading import Thread
+from threading import Thread, Event
+from threading import Lock as ThreadLock
 
 from portalocker import Lock
 
@@ -24,6 +26,7 @@ from ..core import MetricKey, MetricInfo, MetricEntry
 from ..core import MetricDB
 from ..core import Profile
 from ..core import RunStatus, Run, Job, Test
+from ..core.metric._ring import MetricRing
 
 from ..util.config import Config
 
@@ -72,11 +75,18 @@ class Tshrag:
         self._encoding = encoding
         self._max_workers = max_workers
         self._test_main = test_main
+        self._config = config
+        self._ring_capacity = MetricRing.CAPACITY
+        self._mdb_cache = CONCURRENCY ** 2
 
         if not config is None:
             config.pick_to(Tshrag.__name__, self)
         self._root.mkdir(parents=True, exist_ok=True)
         self._workers = []
+        self._mdbs: OrderedDict[TestId, MetricDB] = OrderedDict()
+        self._mdb_pins: Dict[TestId, int] = {}
+        self._mdb_opening: Dict[TestId, Event] = {}
+        self._mdbs_lock = ThreadLock()
 
 
     def _get_lock(self) -> Path:
@@ -111,6 +121,9 @@ class Tshrag:
     def _get_job_file(self, test_id: TestId, job_id: JobId) -> Path:
         return self._get_test_job_root(test_id) / f"{job_id}.json"
 
+    def _get_job_ring(self, test_id: TestId, job_id: JobId) -> Path:
+        return self._get_test_job_root(test_id) / f"{job_id}.ring"
+
     @contextmanager
     def _lock(self):
         with Lock(self._get_lock(), timeout=self._timeout) as lock:
@@ -194,6 +207,111 @@ class Tshrag:
             return None
 
 
+    # Open metric databases are kept for the tests used last, each with its
+    # connection pool and writer thread. Users pin a database from
+    # acquire_mdb to release_mdb; once more than _mdb_cache are open, the
+    # least recently used unpinned ones are closed. A database is opened,
+    # and migrated, outside the lock so other tests are not held up.
+    def acquire_mdb(
+        self,
+        id          : TestId,
+    ) -> Optional[MetricDB]:
+        while True:
+            with self._mdbs_lock:
+                if id in self._mdbs:
+                    self._mdbs.move_to_end(id)
+                    self._mdb_pins[id] = self._mdb_pins.get(id, 0) + 1
+                    return self._mdbs[id]
+                _opening = self._mdb_opening.get(id)
+                if _opening is None:
+                    _opening = self._mdb_opening[id] = Event()
+                    break
+            _opening.wait()
+        _mdb = None
+        _evicted = []
+        try:
+            test = self.query_test(id)
+            if not test is None and not test.mdb is None:
+                _mdb = MetricDB(test.mdb, config=self._config)
+        finally:
+            with self._mdbs_lock:
+                del self._mdb_opening[id]
+                if not _mdb is None:
+                    self._mdbs[id] = _mdb
+                    self._mdb_pins[id] = 1
+                    _evicted = self._evict_mdb()
+            _opening.set()
+        for _evict in _evicted:
+            _evict.close()
+        return _mdb
+
+
+    def release_mdb(
+        self,
+        id          : TestId,
+    ) -> None:
+        with self._mdbs_lock:
+            _pins = self._mdb_pins.get(id, 0) - 1
+            if _pins > 0:
+                self._mdb_pins[id] = _pins
+            else:
+                self._mdb_pins.pop(id, None)
+            _evicted = self._evict_mdb()
+        for _evict in _evicted:
+            _evict.close()
+
+
+    def _evict_mdb(self) -> List[MetricDB]:
+        _evicted = []
+        for _id in list(self._mdbs):
+            if len(self._mdbs) <= max(1, int(self._mdb_cache)):
+                break
+            if not _id in self._mdb_pins:
+                _evicted.append(self._mdbs.pop(_id))
+        return _evicted
+
+
+    @contextmanager
+    def use_mdb(
+        self,
+        id          : TestId,
+    ) -> Generator[Optional[MetricDB], None, None]:
+        _mdb = self.acquire_mdb(id)
+        try:
+            yield _mdb
+        finally:
+            if not _mdb is None:
+                self.release_mdb(id)
+
+
+    # Unpinned: for short-lived callers, the database may be closed under
+    # a long-running one.
+    def query_mdb(
+        self,
+        id          : TestId,
+    ) -> Optional[MetricDB]:
+        with self.use_mdb(id) as _mdb:
+            return _mdb
+
+
+    def flush_mdb(
+        self,
+        id          : TestId,
+    ) -> None:
+        with self._mdbs_lock:
+            _mdb = self._mdbs.get(id)
+        if not _mdb is None:
+            _mdb.flush()
+
+
+    def close(self) -> None:
+        with self._mdbs_lock:
+            _mdbs = list(self._mdbs.values())
+            self._mdbs.clear()
+        for _mdb in _mdbs:
+            _mdb.close()
+
+
     def create_job(
         self,
         test_id     : TestId,
@@ -218,6 +336,14 @@ class Tshrag:
         return _job
 
 
+    def create_job_ring(
+        self,
+        test_id     : TestId,
+        job_id      : JobId,
+    ) -> MetricRing:
+        return MetricRing.create(self._get_job_ring(test_id, job_id), self._ring_capacity)
+
+
     def query_job(
         self,
         test_id     : TestId,
@@ -280,6 +406,7 @@ class Tshrag:
                     test.status = _status
                 else:
                     test.status = RunStatus.CRASHED
+            self.flush_mdb(id)
             return _ret
         
         _worker = Thread(
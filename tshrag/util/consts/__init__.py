@@ -23,15 +23,19 @@ from .path import PATH_TSHRAG
 from .path import PATH_DOT_TSHRAG
 from .path import PATH_LOG
 from .path import PATH_LOCK
+from .path import PATH_SOCKET
 from .path import PATH_CONFIG
 
 from .env import ENV_PREFIX
 from .env import ENV_HOST
+from .env import ENV_SOCKET
 from .env import ENV_TEST_ID
 from .env import ENV_TEST_MACHINE
 from .env import ENV_TEST_DEVICE
 from .env import ENV_TEST_DIR
+from .env import ENV_TEST_MDB
 from .env import ENV_JOB_ID
+from .env import ENV_JOB_RING
 from .env import ENV_JOB_MACHINE
 from .env import ENV_JOB_DEVICE
 from .env import ENV_JOB_DIR
@@ -57,14 +61,18 @@ __all__ = [
     "PATH_DOT_TSHRAG",
     "PATH_LOG",
     "PATH_LOCK",
+    "PATH_SOCKET",
     "PATH_CONFIG",
     "ENV_PREFIX",
     "ENV_HOST",
+    "ENV_SOCKET",
     "ENV_TEST_ID",
     "ENV_TEST_MACHINE",
     "ENV_TEST_DEVICE",
     "ENV_TEST_DIR",
+    "ENV_TEST_MDB",
     "ENV_JOB_ID",
+    "ENV_JOB_RING",
     "ENV_JOB_MACHINE",
     "ENV_JOB_DEVICE",
     "ENV_JOB_DIR",
@@ -36,4 +36,5 @@ PATH_DOT_TSHRAG     = f".{SYM_TSHRAG}"
 
 PATH_LOG            = f"{SYM_TSHRAG}.log"
 PATH_LOCK           = ".lock"
+PATH_SOCKET         = f"{SYM_TSHRAG}.sock"
 PATH_CONFIG         = "config"
@@ -0,0 +1,56 @@
+# -*- coding: UTF-8 -*-
+
+
+import socket
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import uvicorn
+from fastapi import FastAPI
+
+from tshrag import Tshrag
+from tshrag import MetricAPI, MetricWsAPI
+
+
+
+# Scratch directories of a run live under one temporary directory, removed
+# when the run exits however the tests are started.
+_root = tempfile.TemporaryDirectory(prefix="tshragt_")
+
+def tmpdir() -> Path:
+    return Path(tempfile.mkdtemp(dir=_root.name))
+
+
+# A live daemon on a free local port, and on a Unix socket if given, for
+# the clients that open their own connections. Like the daemon, a single
+# server serves every socket.
+@contextmanager
+def serve(tshrag: Tshrag, uds: str = None):
+    app = FastAPI()
+    app.include_router(MetricAPI(tshrag), prefix="/api/v1")
+    app.include_router(MetricWsAPI(tshrag), prefix="/wsapi/v1")
+    sockets = [socket.create_server(("127.0.0.1", 0))]
+    # asyncio skips TCP_NODELAY for sockets made with protocol 0, accepted
+    # connections inherit it from the listener instead.
+    sockets[0].setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if uds:
+        _unix = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        _unix.bind(uds)
+        _unix.listen()
+        sockets.append(_unix)
+    _port = sockets[0].getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, log_level="warning"))
+    thread = threading.Thread(target=server.run, args=(sockets,), daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    try:
+        yield f"127.0.0.1:{_port}"
+    finally:
+        server.should_exit = True
+        thread.join()
+        for _sock in sockets:
+            _sock.close()
@@ -0,0 +1,112 @@
+# -*- coding: UTF-8 -*-
+
+
+import os
+import json
+import asyncio
+import multiprocessing
+import tempfile
+import time
+
+import httpx
+
+from tshrag import Tshrag, Profile
+from tshrag import MetricEntry, Time
+from tshrag.api.client import TshragClient, AsyncTshragClient
+
+from _helpers import serve
+
+
+REQUESTS = 2_000
+CONCURRENCY = 8
+ENTRIES = 100_000
+
+
+
+def _entries(count: int):
+    return [MetricEntry(Time(_i), 0, _i) for _i in range(count)]
+
+
+# The previous client: a fresh httpx client, and so a fresh TCP connection,
+# for every entry.
+def _fresh(host: str, test_id: str, uds: str):
+    for _i in range(REQUESTS):
+        with httpx.Client(base_url=f"http://{host}/api/v1") as client:
+            client.post(
+                f"/metric/{test_id}/entry/bench.fresh",
+                content=json.dumps({"time": str(Time(_i)), "value": _i}),
+                headers={"Content-Type": "application/json"},
+            ).raise_for_status()
+    return REQUESTS
+
+
+def _pooled(host: str, test_id: str, uds: str):
+    with TshragClient(host, uds=uds) as client:
+        for _entry in _entries(REQUESTS):
+            client.add_metric_entry(test_id, "bench.pooled", _entry)
+    return REQUESTS
+
+
+def _async(host: str, test_id: str, uds: str):
+    async def _main():
+        async with AsyncTshragClient(host) as client:
+            _queue = list(_entries(REQUESTS))
+            async def _worker():
+                while _queue:
+                    await client.add_metric_entry(test_id, "bench.async", _queue.pop())
+            await asyncio.gather(*(_worker() for _ in range(CONCURRENCY)))
+    asyncio.run(_main())
+    return REQUESTS
+
+
+def _batch(host: str, test_id: str, uds: str):
+    with TshragClient(host) as client:
+        client.batch_add_metric_entry(test_id, "bench.batch", _entries(ENTRIES))
+    return ENTRIES
+
+
+def _stream(host: str, test_id: str, uds: str):
+    with TshragClient(host, format="binary", uds=uds) as client:
+        client.stream_metric_entry(test_id, "bench.stream", _entries(ENTRIES))
+    return ENTRIES
+
+
+CASES = [
+    ("fresh", "requests", _fresh, False),
+    ("pooled", "requests", _pooled, False),
+    ("pooled-uds", "requests", _pooled, True),
+    ("async", "requests", _async, False),
+    ("batch", "entries", _batch, False),
+    ("stream", "entries", _stream, False),
+    ("stream-uds", "entries", _stream, True),
+]
+
+
+# Clients run in a separate process so that they do not compete with the
+# server for the GIL.
+def _run(func, host: str, test_id: str, uds: str, result):
+    _t0 = time.perf_counter()
+    _count = func(host, test_id, uds)
+    result.value = _count / (time.perf_counter() - _t0)
+
+
+def bench():
+    with tempfile.TemporaryDirectory() as _root:
+        tshrag = Tshrag(_root)
+        try:
+            test = tshrag.create_test(Profile("bench", "", 0, {}, {}, {}))
+            uds = os.path.join(_root, "bench.sock")
+            with serve(tshrag, uds) as host:
+                for _name, _unit, _func, _uds in CASES:
+                    _result = multiprocessing.Value("d", 0)
+                    _process = multiprocessing.Process(target=_run, args=(_func, host, test.id, uds if _uds else None, _result))
+                    _process.start()
+                    _process.join()
+                    print(f"{_name:>10} | {_result.value:>10,.0f} {_unit}/s")
+        finally:
+            tshrag.close()
+
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,108 @@
+# -*- coding: UTF-8 -*-
+
+
+import sys
+import sqlite3
+import random
+import tempfile
+import time
+
+from contextlib import closing
+from pathlib import Path
+from tshrag import MetricDB
+
+
+SIZES = [1_000_000, 10_000_000, 50_000_000]
+KEYS = [f"{_g}.{_m}.{_s}" for _g in ("cpu", "mem", "net", "disk") for _m in range(16) for _s in range(4)]
+BATCH = 100_000
+REPEAT = 5
+
+LEGACY_QUERY = """
+    SELECT time, duration, value
+    FROM metric_entry
+    WHERE key GLOB ? AND test = ? AND time + duration >= ? AND time <= ?
+    ORDER BY time
+"""
+
+
+def _create_legacy(filename: Path, size: int):
+    with closing(sqlite3.connect(filename)) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("CREATE TABLE metric_info (key TEXT PRIMARY KEY, name TEXT, description TEXT)")
+        conn.execute("""
+            CREATE TABLE metric_entry (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                test TEXT, dut TEXT, key TEXT,
+                time INTEGER, duration INTEGER, value BLOB
+            )
+        """)
+        conn.executemany(
+            "INSERT INTO metric_info VALUES (?, '', '')",
+            [(_k,) for _k in KEYS]
+        )
+        for _start in range(0, size, BATCH):
+            conn.executemany(
+                "INSERT INTO metric_entry (test, dut, key, time, duration, value) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    ("bench", "#dut0#", KEYS[_i % len(KEYS)], _i * 1000, 0, random.random())
+                    for _i in range(_start, min(_start + BATCH, size))
+                )
+            )
+            conn.commit()
+
+
+def _used_bytes(filename: Path) -> int:
+    with closing(sqlite3.connect(filename)) as conn:
+        _pages = conn.execute("PRAGMA page_count").fetchone()[0]
+        _free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        _size = conn.execute("PRAGMA page_size").fetchone()[0]
+    return (_pages - _free) * _size
+
+
+def _timeit(func) -> float:
+    _elapsed = []
+    for _ in range(REPEAT):
+        _t0 = time.perf_counter()
+        func()
+        _elapsed.append(time.perf_counter() - _t0)
+    return min(_elapsed)
+
+
+def bench(size: int):
+    with tempfile.TemporaryDirectory() as _root:
+        _bench(Path(_root) / "metric.db", size)
+
+
+def _bench(filename: Path, size: int):
+    _create_legacy(filename, size)
+    _window = (size // 2 * 1000, size // 2 * 1000 + 60_000_000)
+    _cases = [
+        ("exact", "cpu.3.1"),
+        ("prefix", "net.7.*"),
+        ("glob", "*.7.1"),
+    ]
+    print(f"{size:>12,} | legacy   | {'size':<8} | {_used_bytes(filename) / 2 ** 20:>10.2f} MB")
+
+    with closing(sqlite3.connect(filename)) as conn:
+        for _name, _key in _cases:
+            _sec = _timeit(lambda: conn.execute(LEGACY_QUERY, (_key, "bench", *_window)).fetchall())
+            print(f"{size:>12,} | legacy   | {_name:<8} | {_sec * 1000:>10.2f} ms")
+
+    _t0 = time.perf_counter()
+    mdb = MetricDB(filename)
+    print(f"{size:>12,} | migrate  | {'':<8} | {(time.perf_counter() - _t0) * 1000:>10.2f} ms")
+    print(f"{size:>12,} | indexed  | {'size':<8} | {_used_bytes(filename) / 2 ** 20:>10.2f} MB")
+
+    try:
+        for _name, _key in _cases:
+            _sec = _timeit(lambda: mdb.query_metric_entry(_key, "bench", None, *_window))
+            print(f"{size:>12,} | indexed  | {_name:<8} | {_sec * 1000:>10.2f} ms")
+    finally:
+        mdb.close()
+
+
+
+if __name__ == "__main__":
+    for _size in [int(_arg) for _arg in sys.argv[1:]] or SIZES:
+        bench(_size)
@@ -0,0 +1,149 @@
+# -*- coding: UTF-8 -*-
+
+
+import sys
+import json
+import asyncio
+import multiprocessing
+import tempfile
+import time
+
+import httpx
+import websockets
+
+from tshrag import Tshrag, Profile
+from tshrag.api._frame import encode_frame
+
+from _helpers import serve
+
+
+EMITTERS = [0, 10, 50]
+DURATION = 5
+FRAME = 10
+
+PROTOCOLS = [
+    ("v1", "version=1", 1),
+    ("v2", "version=2", 1000),
+    ("v2-none", "version=2&ack=none", 1000),
+    ("v2-bin", "version=2&format=binary", 1000),
+]
+PROTOCOL_EMITTERS = 10
+PROTOCOL_ENTRIES = 20_000
+
+
+async def _emit(host: str, test_id: str, stop: float, counter: list):
+    async with websockets.connect(f"ws://{host}/wsapi/v1/metric/{test_id}/entry") as conn:
+        _i = 0
+        while time.monotonic() < stop:
+            await conn.send(json.dumps({
+                "key": "bench.ws",
+                "dut": ["dut0"],
+                "entries": [{"time": _i + _j, "value": _j} for _j in range(FRAME)],
+            }))
+            for _ in range(FRAME):
+                await conn.recv()
+            _i += FRAME
+            counter[0] += FRAME
+
+
+# Emitters run in a separate process so that the clients do not compete
+# with the server for the GIL.
+def _run_emitters(host: str, test_id: str, emitters: int, duration: float, count):
+    _stop = time.monotonic() + duration
+    _counter = [0]
+    async def _main():
+        await asyncio.gather(*(_emit(host, test_id, _stop, _counter) for _ in range(emitters)))
+    asyncio.run(_main())
+    count.value = _counter[0]
+
+
+def _probe(host: str, test_id: str, stop: float, latency: list):
+    with httpx.Client(base_url=f"http://{host}") as client:
+        while time.monotonic() < stop:
+            _t0 = time.perf_counter()
+            client.get(f"/api/v1/metric/{test_id}/count/bench.http").raise_for_status()
+            latency.append(time.perf_counter() - _t0)
+
+
+async def _send(host: str, test_id: str, query: str, frame: int):
+    async with websockets.connect(f"ws://{host}/wsapi/v1/metric/{test_id}/entry?{query}") as conn:
+        _reader = None
+        if "version=2" in query and not "ack=none" in query:
+            _last = PROTOCOL_ENTRIES // frame
+            async def _read():
+                while json.loads(await conn.recv())["ack"] < _last:
+                    pass
+            _reader = asyncio.create_task(_read())
+        for _seq, _start in enumerate(range(0, PROTOCOL_ENTRIES, frame), 1):
+            _entries = [{"time": _i, "value": _i} for _i in range(_start, _start + frame)]
+            if "version=1" in query:
+                await conn.send(json.dumps({"key": "bench.ws", "entries": _entries}))
+                for _ in _entries:
+                    await conn.recv()
+            elif "format=binary" in query:
+                await conn.send(encode_frame(_seq, [("bench.ws", [], [(_i, 0, _i) for _i in range(_start, _start + frame)])]))
+            else:
+                await conn.send(json.dumps({"seq": _seq, "updates": [{"key": "bench.ws", "entries": _entries}]}))
+        if not _reader is None:
+            await _reader
+
+
+def _run_senders(host: str, test_id: str, query: str, frame: int):
+    async def _main():
+        await asyncio.gather(*(_send(host, test_id, query, frame) for _ in range(PROTOCOL_EMITTERS)))
+    asyncio.run(_main())
+
+
+def bench_protocol(name: str, query: str, frame: int):
+    with tempfile.TemporaryDirectory() as _root:
+        tshrag = Tshrag(_root)
+        try:
+            test = tshrag.create_test(Profile("bench", "", 0, {}, {}, {}))
+            with serve(tshrag) as host:
+                _t0 = time.perf_counter()
+                _process = multiprocessing.Process(target=_run_senders, args=(host, test.id, query, frame))
+                _process.start()
+                _process.join()
+                # Fire-and-forget senders may finish before the daemon has read
+                # every frame, so wait for all entries to reach the ingest queue.
+                _mdb = tshrag.query_mdb(test.id)
+                while _mdb.query_ingest_stats()["submitted"] < PROTOCOL_EMITTERS * PROTOCOL_ENTRIES:
+                    time.sleep(0.01)
+                _mdb.flush()
+                _sec = time.perf_counter() - _t0
+                _count = tshrag.query_mdb(test.id).query_metric_aggregate("count", "bench.ws")
+        finally:
+            tshrag.close()
+    print(f"{name:>8} | {frame:>5} entries/frame | {_count / _sec:>10,.0f} entries/s | {_count:>8,} entries")
+
+
+def bench(emitters: int):
+    _count = multiprocessing.Value("q", 0)
+    _latency = []
+    with tempfile.TemporaryDirectory() as _root:
+        tshrag = Tshrag(_root)
+        try:
+            test = tshrag.create_test(Profile("bench", "", 0, {}, {}, {}))
+            with serve(tshrag) as host:
+                _process = multiprocessing.Process(target=_run_emitters, args=(host, test.id, emitters, DURATION, _count))
+                _process.start()
+                _probe(host, test.id, time.monotonic() + DURATION, _latency)
+                _process.join()
+        finally:
+            tshrag.close()
+
+    _latency.sort()
+    _p50 = _latency[len(_latency) // 2] * 1000
+    _p99 = _latency[int(0.99 * (len(_latency) - 1))] * 1000
+    print(
+        f"{emitters:>4} emitters | {_count.value / DURATION:>10,.0f} entries/s"
+        f" | http p50 {_p50:>8.2f} ms | p99 {_p99:>8.2f} ms | {len(_latency):>6} requests"
+    )
+
+
+
+if __name__ == "__main__":
+    for _emitters in [int(_arg) for _arg in sys.argv[1:]] or EMITTERS:
+        bench(_emitters)
+    for _protocol in PROTOCOLS:
+        bench_protocol(*_protocol)
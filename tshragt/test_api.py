@@ -0,0 +1,540 @@
+# -*- coding: UTF-8 -*-
+
+
+import asyncio
+import base64
+import json
+import os
+import socket
+import threading
+import time
+
+import httpx
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from tshrag import Tshrag, Profile
+from tshrag import MetricAPI, MetricWsAPI
+from tshrag import MetricEntry, MetricInfo, Time
+from tshrag.api._frame import encode_frame
+from tshrag.api.client import TshragClient, AsyncTshragClient
+from tshrag.api.emitter import MetricEmitter, RingEmitter
+from tshrag.core.metric._ring import MetricRing
+from tshrag.util.config import Config
+from tshrag.util.consts import ENV_TEST_ID, ENV_TEST_MDB
+from tshrag.api.metric import NDJSON_AFTER_HEADER, NDJSON_BATCH, NDJSON_MEDIA_TYPE
+
+from _helpers import serve, tmpdir
+
+
+def _app(config: Config = None):
+    tshrag = Tshrag(tmpdir(), config=config)
+    test = tshrag.create_test(Profile("api", "", 0, {}, {}, {}))
+    app = FastAPI()
+    app.include_router(MetricAPI(tshrag), prefix="/api/v1")
+    app.include_router(MetricWsAPI(tshrag), prefix="/wsapi/v1")
+    return tshrag, test.id, TestClient(app)
+
+
+def _frame(seq: int, values, key: str = "cpu.usage") -> str:
+    return json.dumps({"seq": seq, "updates": [{"key": key, "entries": [
+        {"time": str(Time(_v)), "value": _v} for _v in values
+    ]}]})
+
+
+def _values(tshrag: Tshrag, test_id: str, key: str = "cpu.usage"):
+    tshrag.flush_mdb(test_id)
+    return sorted(_e.value for _e in tshrag.query_mdb(test_id).iter_metric_entry(key, test_id))
+
+
+def test_bytes_value():
+    tshrag, test_id, client = _app()
+    mdb = tshrag.query_mdb(test_id)
+    mdb.add_metric_entry("raw.dump", MetricEntry(Time(1), 0, b"\xff\x00"), test_id)
+    tagged = {"$bytes": base64.b64encode(b"\xff\x00").decode()}
+    with client:
+        resp = client.get(f"/api/v1/metric/{test_id}/entry/raw.dump")
+        assert resp.status_code == 200 and resp.json()["entries"][0]["value"] == tagged
+        resp = client.get(f"/api/v1/metric/{test_id}/entry/raw.dump", params={"format": "ndjson"})
+        assert json.loads(resp.text)["value"] == tagged
+        resp = client.get(f"/api/v1/metric/{test_id}/hist/raw.dump")
+        assert resp.json()["statistic"]["bins"][0]["value"] == tagged
+    tshrag.close()
+
+
+def test_entry_invalid():
+    tshrag, test_id, client = _app()
+    with client:
+        # Bad entries are rejected before anything is queued.
+        url = f"/api/v1/metric/{test_id}/entry/cpu.usage"
+        assert client.post(url, json={"value": 1, "bogus": 1}).status_code == 400
+        assert client.post(url, json=[{"time": str(Time(1)), "value": 1}, {"bogus": 1}]).status_code == 400
+        assert client.post(url, json={"time": str(Time(2)), "value": 2}).status_code == 200
+    assert _values(tshrag, test_id) == [2]
+    tshrag.close()
+
+
+def test_entry_cursor():
+    tshrag, test_id, client = _app()
+    mdb = tshrag.query_mdb(test_id)
+    mdb.add_metric_entries(("cpu.usage", MetricEntry(Time(_i), 0, _i), test_id, None) for _i in range(25))
+    url = f"/api/v1/metric/{test_id}/entry/cpu.usage"
+    with client:
+        values, after, pages = [], None, 0
+        while True:
+            resp = client.get(url, params={"limit": 10} | ({"after": after} if after else {}))
+            assert resp.status_code == 200
+            values += [_e["value"] for _e in resp.json()["entries"]]
+            after, pages = resp.json()["after"], pages + 1
+            if after is None:
+                break
+        assert (values, pages) == (list(range(25)), 3)
+
+        resp = client.get(url, params={"limit": 25})
+        assert len(resp.json()["entries"]) == 25 and resp.json()["after"] is None
+        resp = client.get(url, params={"limit": 10, "start_time": str(Time(100))})
+        assert resp.json() == {"entries": [], "after": None}
+        assert client.get(url, params={"limit": 10, "after": "garbage"}).status_code == 400
+    tshrag.close()
+
+
+def test_entry_ndjson():
+    tshrag, test_id, client = _app()
+    mdb = tshrag.query_mdb(test_id)
+    count = NDJSON_BATCH * 2 + 500
+    mdb.add_metric_entries(("cpu.usage", MetricEntry(Time(_i), 0, _i), test_id, None) for _i in range(count))
+    url = f"/api/v1/metric/{test_id}/entry/cpu.usage"
+    with client:
+        resp = client.get(url, headers={"Accept": NDJSON_MEDIA_TYPE})
+        assert resp.headers["content-type"].startswith(NDJSON_MEDIA_TYPE)
+        assert resp.text.endswith("\n") and not NDJSON_AFTER_HEADER in resp.headers
+        assert [json.loads(_line)["value"] for _line in resp.text.splitlines()] == list(range(count))
+
+        values, after = [], None
+        while True:
+            resp = client.get(url, params={"format": "ndjson", "limit": 1000} | ({"after": after} if after else {}))
+            values += [json.loads(_line)["value"] for _line in resp.text.splitlines()]
+            after = resp.headers.get(NDJSON_AFTER_HEADER)
+            if after is None:
+                break
+        assert values == list(range(count))
+
+        resp = client.get(url, params={"format": "ndjson", "limit": 10, "start_time": str(Time(count))})
+        assert resp.status_code == 200 and resp.text == "" and not NDJSON_AFTER_HEADER in resp.headers
+    tshrag.close()
+
+
+def test_ws_v1():
+    tshrag, test_id, client = _app()
+    mdb = tshrag.query_mdb(test_id)
+    _add_rows = mdb._add_rows
+    def _reject(rows):
+        if any(_row[0] == "b.bad" for _row in rows):
+            raise ValueError("b.bad is rejected")
+        _add_rows(rows)
+    mdb._add_rows = _reject
+    with client, client.websocket_connect(f"/wsapi/v1/metric/{test_id}/entry") as ws:
+        ws.send_json({"key": "a.ok", "entries": [{"time": str(Time(_i)), "value": _i} for _i in range(2)]})
+        assert [ws.receive_text(), ws.receive_text()] == ["Metric a.ok entry added."] * 2
+        ws.send_json({"key": "b.bad", "entries": [{"time": str(Time(_i)), "value": _i} for _i in range(2)]})
+        assert [ws.receive_text(), ws.receive_text()] == ["Metric b.bad entry failed: b.bad is rejected"] * 2
+    assert _values(tshrag, test_id, "a.ok") == [0, 1]
+    tshrag.close()
+
+
+def test_ws_frame_type():
+    tshrag, test_id, client = _app()
+    with client, client.websocket_connect(f"/wsapi/v1/metric/{test_id}/entry?version=2&format=binary&ack_every=1") as ws:
+        ws.send_text(json.dumps({"seq": 1, "updates": []}))
+        assert ws.receive_json() == {"error": "Expected binary frames with format=binary", "seq": 1}
+        ws.send_bytes(encode_frame(2, [("cpu.usage", [], [(1, 0, 1.0)])]))
+        assert ws.receive_json() == {"ack": 2, "entries": 1}
+    tshrag.close()
+
+
+def test_mdb_cache():
+    tshrag = Tshrag(tmpdir())
+    tshrag._mdb_cache = 2
+    tests = [tshrag.create_test(Profile(f"cache{_i}", "", 0, {}, {}, {})).id for _i in range(4)]
+    mdbs = [tshrag.query_mdb(_id) for _id in tests[:2]]
+    mdbs[1].add_metric_entry("cpu.usage", MetricEntry(Time(1), 0, 1), tests[1])
+    assert tshrag.query_mdb(tests[0]) is mdbs[0]
+    tshrag.query_mdb(tests[2])
+    assert list(tshrag._mdbs) == [tests[0], tests[2]]
+    # Evicted databases are closed for good, a new one is opened instead.
+    try:
+        mdbs[1].add_metric_entry("cpu.usage", MetricEntry(Time(2), 0, 2), tests[1])
+        assert False
+    except RuntimeError:
+        pass
+    assert not tshrag.query_mdb(tests[1]) is mdbs[1]
+
+    # Pinned databases are never evicted, the cache shrinks back once
+    # they are released.
+    with tshrag.use_mdb(tests[0]) as pinned, tshrag.use_mdb(tests[3]):
+        tshrag.query_mdb(tests[2])
+        assert set(tshrag._mdbs) == {tests[0], tests[3]}
+        pinned.add_metric_entry("cpu.usage", MetricEntry(Time(1), 0, 1), tests[0])
+    tshrag.query_mdb(tests[1])
+    assert len(tshrag._mdbs) == 2 and tshrag._mdb_pins == {}
+    tshrag.close()
+
+
+def test_ws_ack():
+    tshrag, test_id, client = _app()
+    url = f"/wsapi/v1/metric/{test_id}/entry?version=2&ack_every=3&ack_delay=1h"
+    with client, client.websocket_connect(url) as ws:
+        for seq in [1, 2, 3]:
+            ws.send_text(_frame(seq, [seq]))
+        assert ws.receive_json() == {"ack": 3, "entries": 3}
+        ws.send_text(_frame(4, [4, 5, 6]))
+        assert ws.receive_json() == {"ack": 4, "entries": 6}
+    assert _values(tshrag, test_id) == [1, 2, 3, 4, 5, 6]
+    tshrag.close()
+
+
+def test_ws_error():
+    tshrag, test_id, client = _app()
+    url = f"/wsapi/v1/metric/{test_id}/entry?version=2&ack_every=1"
+    with client, client.websocket_connect(url) as ws:
+        ws.send_text(_frame(1, [1]))
+        assert ws.receive_json() == {"ack": 1, "entries": 1}
+        ws.send_text(json.dumps({"seq": 2, "updates": [{"key": "cpu.usage", "entries": [{"time": "never", "value": 2}]}]}))
+        assert ws.receive_json()["seq"] == 2
+        ws.send_text("{not json")
+        assert ws.receive_json()["seq"] is None
+        ws.send_text(_frame(3, [3]))
+        assert ws.receive_json() == {"ack": 3, "entries": 2}
+    assert _values(tshrag, test_id) == [1, 3]
+    tshrag.close()
+
+
+def test_ws_replay():
+    tshrag = Tshrag(tmpdir())
+    test_id = tshrag.create_test(Profile("replay", "", 0, {}, {}, {})).id
+
+    async def _main(host):
+        client = AsyncTshragClient(host, uds="", transport="network", retry_delay="10ms", config=None)
+        stream = client._stream(test_id)
+        await stream.send("cpu.usage", [], [MetricEntry(Time(_i), 0, _i) for _i in range(10)])
+        assert [_f[0] for _f in stream._unacked] == [1]
+        # The connection dies before the ack: frame 1 is sent again.
+        await stream._conn.close()
+        await stream.send("cpu.usage", [], [MetricEntry(Time(_i), 0, _i) for _i in range(10, 20)])
+        await stream.drain()
+        await stream.close()
+        await client.aclose()
+        return stream.stats
+
+    with serve(tshrag) as host:
+        stats = asyncio.run(_main(host))
+    assert (stats["frames"], stats["reconnects"]) == (2, 1)
+    values = _values(tshrag, test_id)
+    assert set(values) == set(range(20)) and len(values) in (20, 30)
+    tshrag.close()
+
+
+def test_ws_credit():
+    tshrag, test_id, client = _app()
+    url = f"/wsapi/v1/metric/{test_id}/entry?version=2&ack_every=1&credit=10"
+    with client, client.websocket_connect(url) as ws:
+        assert ws.receive_json() == {"credit": 10, "full": False}
+        ws.send_text(_frame(1, range(4)))
+        assert ws.receive_json() == {"ack": 1, "entries": 4}
+        # Past half of the window the credit is topped up to a full one.
+        ws.send_text(_frame(2, range(4, 6)))
+        messages = [ws.receive_json(), ws.receive_json()]
+        assert {"credit": 16, "full": False} in messages and {"ack": 2, "entries": 6} in messages
+        ws.send_text(_frame(3, range(6, 17)))
+        assert ws.receive_json()["seq"] == 3
+        ws.send_text(_frame(4, range(6, 14)))
+        messages = [ws.receive_json(), ws.receive_json()]
+        assert {"credit": 24, "full": False} in messages and {"ack": 4, "entries": 14} in messages
+    assert _values(tshrag, test_id) == list(range(14))
+    tshrag.close()
+
+
+def test_ws_credit_reserve():
+    config = Config()
+    config.read_string("[MetricDB]\n_ingest_batch = 10\n_ingest_capacity = 100\n")
+    tshrag, test_id, client = _app(config)
+    url = f"/wsapi/v1/metric/{test_id}/entry?version=2&credit=80"
+    mdb = tshrag.query_mdb(test_id)
+    with client:
+        with client.websocket_connect(url) as ws1:
+            assert ws1.receive_json() == {"credit": 80, "full": False}
+            with client.websocket_connect(url) as ws2:
+                assert ws2.receive_json() == {"credit": 20, "full": True}
+                assert mdb.query_ingest_stats()["reserved"] == 100
+            time.sleep(0.1)
+            assert mdb.query_ingest_stats()["reserved"] == 80
+        time.sleep(0.1)
+        assert mdb.query_ingest_stats()["reserved"] == 0
+    tshrag.close()
+
+
+def test_stream_credit():
+    tshrag = Tshrag(tmpdir())
+    test_id = tshrag.create_test(Profile("credit", "", 0, {}, {}, {})).id
+
+    async def _main(host, policy):
+        async with AsyncTshragClient(
+            host, uds="", transport="network", frame=10, credit=50, policy=policy, config=None,
+        ) as client:
+            return await client.stream_metric_entry(test_id, f"credit.{policy}", [
+                MetricEntry(Time(_i), 0, _i) for _i in range(2500)
+            ])
+
+    # Against a server with room, credits only pace the stream: nothing is
+    # dropped while a top-up is on its way.
+    with serve(tshrag) as host:
+        for policy in ["block", "drop"]:
+            stats = asyncio.run(_main(host, policy))
+            assert (stats["entries"], stats["dropped"]) == (2500, 0)
+            assert _values(tshrag, test_id, f"credit.{policy}") == list(range(2500))
+    tshrag.close()
+
+
+def test_stream_refund():
+    client = AsyncTshragClient("127.0.0.1:1", uds="", transport="network", credit=10, config=None)
+    stream = client._stream("t")
+    stream._sent, stream._counts = 10, {1: 4, 2: 6}
+    stream._unacked.extend([(1, 4, ""), (2, 6, "")])
+
+    async def _messages():
+        yield json.dumps({"error": "rejected", "seq": 1})
+        yield json.dumps({"ack": 2, "entries": 6})
+
+    asyncio.run(stream._read(_messages()))
+    assert (stream._sent, stream._counts, list(stream._unacked)) == (6, {}, [])
+    assert isinstance(stream._error, ValueError)
+    asyncio.run(client.aclose())
+
+
+def _live_test(name: str):
+    tshrag = Tshrag(tmpdir())
+    return tshrag, tshrag.create_test(Profile(name, "", 0, {}, {}, {})).id
+
+
+def test_client():
+    tshrag, test_id = _live_test("client")
+    entries = [MetricEntry(Time(_i), 0, _i) for _i in range(250)]
+    with serve(tshrag) as host:
+        with TshragClient(host, uds="", transport="network", frame=100, config=None) as client:
+            client.update_metric_info(test_id, MetricInfo("cpu.usage", "CPU usage", "percent"))
+            assert client.query_metric_info(test_id, "cpu.usage").name == "CPU usage"
+            client.batch_add_metric_entry(test_id, "cpu.usage", entries)
+            # One pooled client is shared by every thread.
+            threads = [
+                threading.Thread(target=lambda _t=_t: [
+                    client.add_metric_entry(test_id, "cpu.thread", MetricEntry(Time(_t * 20 + _i), 0, _i))
+                    for _i in range(20)
+                ])
+                for _t in range(8)
+            ]
+            for _thread in threads:
+                _thread.start()
+            for _thread in threads:
+                _thread.join()
+            assert [_e.value for _e in client.query_metric_entry(test_id, "cpu.usage")] == list(range(250))
+            assert client.query_metric_statistic(test_id, "count", "cpu.thread") == 160
+            assert client.stream_metric_entry(test_id, "cpu.stream", entries[:100])["entries"] == 100
+            # Later calls reuse the loop, the stream and its WebSocket.
+            conn = client._client._streams[test_id]._conn
+            assert client.stream_metric_entry(test_id, "cpu.stream", entries[100:])["entries"] == 250
+            assert client._client._streams[test_id]._conn is conn
+
+        async def _main():
+            async with AsyncTshragClient(host, uds="", transport="network", config=None) as client:
+                await asyncio.gather(*(
+                    client.add_metric_entry(test_id, "cpu.async", MetricEntry(Time(_i), 0, _i))
+                    for _i in range(50)
+                ))
+                await client.stream_metric_entry(test_id, "cpu.async", entries[50:])
+                return await client.query_metric_statistic(test_id, "count", "cpu.async")
+
+        assert asyncio.run(_main()) == 250
+    assert _values(tshrag, test_id, "cpu.stream") == list(range(250))
+    tshrag.close()
+
+
+def test_client_unreachable():
+    with TshragClient("127.0.0.1:1", uds="", transport="network", retries=0, config=None) as client:
+        try:
+            client.add_metric_entry("t", "cpu.usage", MetricEntry(Time(1), 0, 1))
+            assert False
+        except httpx.ConnectError:
+            pass
+
+
+def test_emitter():
+    tshrag, test_id = _live_test("emitter")
+    with serve(tshrag) as host:
+        emitter = MetricEmitter(test_id, host, config=None)
+        for _i in range(1000):
+            emitter.emit("cpu.usage", _i, Time(_i))
+        emitter.close()
+    stats = emitter.stats()
+    assert (stats["committed"], stats["failed"], stats["errors"]) == (1000, 0, 0)
+    assert _values(tshrag, test_id) == list(range(1000))
+    tshrag.close()
+
+
+def test_emitter_rejected():
+    tshrag, test_id = _live_test("rejected")
+    mdb = tshrag.query_mdb(test_id)
+    _add_rows = mdb._add_rows
+    def _reject(rows):
+        if any(_row[0] == "b.bad" for _row in rows):
+            raise ValueError("b.bad is rejected")
+        _add_rows(rows)
+    mdb._add_rows = _reject
+    with serve(tshrag) as host:
+        emitter = MetricEmitter(test_id, host, config=None)
+        for _i in range(5):
+            emitter.emit("a.ok", _i, Time(_i))
+            emitter.emit("b.bad", _i, Time(_i))
+        emitter.close()
+    # Updates of one batch are sent one by one: the rejected one fails on
+    # its own and the committed one is not sent again.
+    stats = emitter.stats()
+    assert (stats["committed"], stats["failed"], stats["errors"]) == (5, 5, 0)
+    assert _values(tshrag, test_id, "a.ok") == list(range(5))
+    assert _values(tshrag, test_id, "b.bad") == []
+    tshrag.close()
+
+
+def test_emitter_unreachable():
+    emitter = MetricEmitter("t", "127.0.0.1:1", config=None)
+    emitter._retry_delay = "10ms"
+    for _i in range(10):
+        emitter.emit("cpu.usage", _i)
+    # Neither emit nor close raise with the daemon gone, the rows are
+    # kept and retried until close gives up on them.
+    t0 = time.monotonic()
+    emitter.close(timeout=0.5)
+    assert time.monotonic() - t0 < 5
+    emitter.emit("cpu.usage", 10)
+    stats = emitter.stats()
+    assert (stats["committed"], stats["failed"], stats["lost"]) == (0, 10, 1)
+    assert stats["errors"] > 1 and not stats["last_error"] is None
+
+
+def test_ring_emitter_closed():
+    ring = MetricRing.create(tmpdir() / "job.ring", 16)
+    emitter = RingEmitter(ring.filename.as_posix(), "t", "127.0.0.1:1", config=None)
+    emitter.emit("cpu.usage", 1)
+    emitter.close()
+    # Like MetricEmitter, a closed RingEmitter counts entries as lost.
+    emitter.emit("cpu.usage", 2)
+    emitter.emit("cpu.usage", 3, dut={"d0"})
+    assert (emitter.stats()["submitted"], emitter.stats()["lost"]) == (1, 2)
+    assert ring.depth() == 1
+    ring.close()
+
+
+def test_client_uds():
+    tshrag, test_id = _live_test("uds")
+    root = tmpdir()
+    uds = os.path.join(root, "tshrag.sock")
+    stale = os.path.join(root, "stale.sock")
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.bind(stale)
+    with serve(tshrag, uds) as host:
+        with TshragClient(host, uds=uds, transport="network", config=None) as client:
+            assert client.uds == uds
+            client.add_metric_entry(test_id, "cpu.uds", MetricEntry(Time(1), 0, 1))
+            client.stream_metric_entry(test_id, "cpu.uds", [MetricEntry(Time(2), 0, 2)])
+            assert client.uds == uds
+        # A socket left behind by a crashed daemon refuses connections, the
+        # clients fall back to the host and stay there.
+        with TshragClient(host, uds=stale, transport="network", config=None) as client:
+            assert client.uds == stale
+            client.add_metric_entry(test_id, "cpu.stale", MetricEntry(Time(1), 0, 1))
+            assert client.uds is None
+            client.add_metric_entry(test_id, "cpu.stale", MetricEntry(Time(2), 0, 2))
+
+        async def _main():
+            async with AsyncTshragClient(host, uds=stale, transport="network", config=None) as client:
+                await client.stream_metric_entry(test_id, "cpu.stale", [MetricEntry(Time(3), 0, 3)])
+                assert client.uds is None
+                await client.add_metric_entry(test_id, "cpu.stale", MetricEntry(Time(4), 0, 4))
+
+        asyncio.run(_main())
+    assert _values(tshrag, test_id, "cpu.uds") == [1, 2]
+    assert _values(tshrag, test_id, "cpu.stale") == [1, 2, 3, 4]
+    tshrag.close()
+
+
+def test_client_missing_uds():
+    tshrag, test_id = _live_test("missing")
+    missing = os.path.join(tmpdir(), "tshrag.sock")
+    with serve(tshrag) as host:
+        # No socket at the path: the clients use the host from the start.
+        with TshragClient(host, uds=missing, transport="network", config=None) as client:
+            assert client.uds is None
+            client.add_metric_entry(test_id, "cpu.tcp", MetricEntry(Time(1), 0, 1))
+            client.stream_metric_entry(test_id, "cpu.tcp", [MetricEntry(Time(2), 0, 2)])
+    assert _values(tshrag, test_id, "cpu.tcp") == [1, 2]
+    tshrag.close()
+
+
+def test_client_local():
+    tshrag, test_id = _live_test("local")
+    with tshrag.use_mdb(test_id):
+        pass
+    env = {ENV_TEST_ID: test_id, ENV_TEST_MDB: tshrag.query_test(test_id).mdb.resolve().as_posix()}
+    _environ = {_k: os.environ.get(_k) for _k in env}
+    os.environ.update(env)
+    try:
+        with serve(tshrag) as host:
+            # A job of the test on the daemon's host writes into the attached
+            # database, the daemon reads the rows back.
+            with TshragClient(host, uds="", config=None) as client:
+                client.batch_add_metric_entry(test_id, "cpu.local", [MetricEntry(Time(1), 0, 1)])
+                assert client.stream_metric_entry(test_id, "cpu.local", [MetricEntry(Time(2), 0, 2)])["local"]
+                assert not client._local[test_id] is None
+
+            async def _main():
+                async with AsyncTshragClient(host, uds="", config=None) as client:
+                    assert (await client.stream_metric_entry(test_id, "cpu.local", [MetricEntry(Time(3), 0, 3)]))["local"]
+                    await client.add_metric_entry(test_id, "cpu.local", MetricEntry(Time(4), 0, 4))
+
+            asyncio.run(_main())
+            with TshragClient(host, uds="", transport="network", config=None) as client:
+                assert [_e.value for _e in client.query_metric_entry(test_id, "cpu.local")] == [1, 2, 3, 4]
+                assert client._local == {}
+    finally:
+        for _k, _v in _environ.items():
+            if _v is None:
+                os.environ.pop(_k, None)
+            else:
+                os.environ[_k] = _v
+    tshrag.close()
+
+
+
+if __name__ == "__main__":
+    test_bytes_value()
+    test_entry_invalid()
+    test_entry_cursor()
+    test_entry_ndjson()
+    test_ws_v1()
+    test_ws_frame_type()
+    test_ws_ack()
+    test_ws_error()
+    test_ws_replay()
+    test_ws_credit()
+    test_ws_credit_reserve()
+    test_stream_credit()
+    test_stream_refund()
+    test_client()
+    test_client_unreachable()
+    test_emitter()
+    test_emitter_rejected()
+    test_emitter_unreachable()
+    test_ring_emitter_closed()
+    test_client_uds()
+    test_client_missing_uds()
+    test_client_local()
+    test_mdb_cache()
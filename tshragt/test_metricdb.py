@@ -0,0 +1,628 @@
+# -*- coding: UTF-8 -*-
+
+
+import math
+import random
+import sqlite3
+import threading
+import time
+
+from contextlib import contextmanager
+from concurrent.futures import Future
+from tshrag import Time
+from tshrag import MetricKey, MetricInfo, MetricEntry
+from tshrag import MetricDB
+from tshrag.core.metric._ingest import IngestQueue, DroppedError
+from tshrag.core.metric._ring import MetricRing
+from tshrag.test._execute import _drain_ring, _DrainStats
+from tshrag.util.config import Config
+from tshrag.api._frame import encode_frame, decode_frame
+
+from _helpers import tmpdir
+
+
+def _mdb() -> MetricDB:
+    return MetricDB(tmpdir() / "metric.db")
+
+
+def test_query_key():
+    mdb = _mdb()
+    for key in ["cpu.usage", "cpu.temp", "cpv.usage", "mem.usage"]:
+        mdb.add_metric_entry(MetricKey(key), MetricEntry(Time(1), 0, key), "t")
+
+    def _values(key):
+        return sorted(e.value for e in mdb.query_metric_entry(key, test="t"))
+
+    assert _values("cpu.usage") == ["cpu.usage"]
+    assert _values("cpu.*") == ["cpu.temp", "cpu.usage"]
+    assert _values("cp?.usage") == ["cpu.usage", "cpv.usage"]
+    assert _values("*.usage") == ["cpu.usage", "cpv.usage", "mem.usage"]
+    assert _values("*") == ["cpu.temp", "cpu.usage", "cpv.usage", "mem.usage"]
+    assert _values("disk.*") == []
+
+
+def test_query_dut():
+    mdb = _mdb()
+    mdb.add_metric_entry("cpu.usage", MetricEntry(Time(1), 0, "a"), "t", {"dut_0"})
+    mdb.add_metric_entry("cpu.usage", MetricEntry(Time(2), 0, "ab"), "t", {"dut_0", "dut_1"})
+    mdb.add_metric_entry("cpu.usage", MetricEntry(Time(3), 0, "b"), "t", "dut_1")
+    mdb.add_metric_entry("cpu.usage", MetricEntry(Time(4), 0, "x"), "t", {"dutx0"})
+
+    def _values(dut):
+        return [e.value for e in mdb.query_metric_entry("cpu.usage", test="t", dut=dut)]
+
+    assert _values(None) == ["a", "ab", "b", "x"]
+    assert _values({"dut_0"}) == ["a", "ab"]
+    assert _values({"dut_1"}) == ["ab", "b"]
+    assert _values({"dut_0", "dut_1"}) == ["ab"]
+    assert _values({"dut_2"}) == []
+
+
+def test_add_entries():
+    mdb = _mdb()
+    mdb.add_metric_entry("cpu.usage", MetricEntry(Time(1), 0, 0), "t", {"dut_0"})
+    mdb.add_metric_entries(
+        (key, MetricEntry(Time(i + 2), 0, i), "t", {"dut_0", f"dut_{i % 2 + 1}"})
+        for i in range(100)
+        for key in ["cpu.usage", "mem.usage"]
+    )
+    mdb.add_metric_entries([])
+
+    assert [i.key for i in mdb.list_metric_info()] == ["cpu.usage", "mem.usage"]
+    assert len(mdb.query_metric_entry("*", test="t")) == 201
+    assert len(mdb.query_metric_entry("cpu.usage", test="t", dut={"dut_0"})) == 101
+    assert [e.value for e in mdb.query_metric_entry("mem.usage", dut={"dut_2"})] == list(range(1, 100, 2))
+
+
+def test_aggregate():
+    mdb = _mdb()
+    mdb.add_metric_entries(
+        ("cpu.usage", MetricEntry(Time(i + 1), 0, value), "t", None)
+        for i, value in enumerate([1, 2.5, "3.5", "abc", None])
+    )
+    assert mdb.query_metric_aggregate("sum", "cpu.usage") == 7.0
+    assert mdb.query_metric_aggregate("avg", "cpu.usage") == 7.0 / 3
+    assert mdb.query_metric_aggregate("min", "cpu.usage") == 1.0
+    assert mdb.query_metric_aggregate("max", "cpu.usage") == 3.5
+    assert mdb.query_metric_aggregate("count", "cpu.usage") == 5
+    assert mdb.query_metric_aggregate("sum", "mem.usage") is None
+    assert mdb.query_metric_aggregate("count", "mem.usage") == 0
+
+
+def test_typed_value():
+    mdb = _mdb()
+    values = [None, True, 1, 2.5, "3", "x", b"raw", [1, 2], {"a": 1}]
+    mdb.add_metric_entries(
+        ("cpu.usage", MetricEntry(Time(i + 1), 0, value), "t", None)
+        for i, value in enumerate(values)
+    )
+    entries = mdb.query_metric_entry("cpu.usage")
+    assert [e.value for e in entries] == values
+    assert [type(e.value) for e in entries] == [type(v) for v in values]
+    assert mdb.query_metric_aggregate("sum", "cpu.usage") == 7.5
+
+
+def test_iter_entry():
+    mdb = _mdb()
+    mdb.add_metric_entries(
+        ("cpu.usage", MetricEntry(Time(i + 1), 0, i), "t", None)
+        for i in range(10)
+    )
+    assert [e.value for e in mdb.iter_metric_entry("cpu.usage", batch=3)] == list(range(10))
+    for _ in range(MetricDB.READERS + 1):
+        entries = mdb.iter_metric_entry("cpu.usage", batch=3)
+        assert next(entries).value == 0
+        entries.close()
+
+
+def test_page():
+    mdb = _mdb()
+    mdb.add_metric_entries(
+        ("cpu.usage", MetricEntry(Time(i // 2 + 1), 0, i), "t", None)
+        for i in range(7)
+    )
+    values, after = [], None
+    while True:
+        entries, after = mdb.query_metric_page("cpu.usage", limit=3, after=after)
+        values.append([e.value for e in entries])
+        if after is None:
+            break
+    assert values == [[0, 1, 2], [3, 4, 5], [6]]
+    _, after = mdb.query_metric_page("cpu.usage", limit=4)
+    assert [e.value for e in mdb.query_metric_entry("cpu.usage", after=after)] == [4, 5, 6]
+    assert [e.value for e in mdb.query_metric_entry("cpu.usage", limit=2)] == [0, 1]
+
+
+def test_bucket():
+    mdb = _mdb()
+    mdb.add_metric_entries(
+        ("cpu.usage", MetricEntry(Time(t), 0, t), "t", None)
+        for t in [-15, -5, 0, 5, 9, 10, 25]
+    )
+    buckets = mdb.query_metric_bucket("count", 10, "cpu.usage")
+    assert [(int(b.time), b.duration, b.value) for b in buckets] == [
+        (-20, 10, 1), (-10, 10, 1), (0, 10, 3), (10, 10, 1), (20, 10, 1)
+    ]
+    buckets = mdb.query_metric_bucket("max", 10, "cpu.usage", start_time=Time(0), end_time=Time(19))
+    assert [(int(b.time), b.value) for b in buckets] == [(0, 9.0), (10, 10.0)]
+
+
+def test_quantile():
+    config = Config()
+    config.read_string("[MetricDB]\n_rollups = 100us\n_exact = 100\n")
+    mdb = MetricDB(tmpdir() / "metric.db", config=config)
+    random.seed(14)
+    nums = [random.lognormvariate(0, 2) * random.choice([1, 1, -1]) for _ in range(2000)]
+    mdb.add_metric_entries(
+        ("lat", MetricEntry(Time(_i), 0, _num), "t", f"d{_i % 2}")
+        for _i, _num in enumerate(nums)
+    )
+
+    def _check(aggregate, q, values, **query):
+        _exact = sorted(values)[int(q * (len(values) - 1))]
+        assert abs(mdb.query_metric_aggregate(aggregate, "lat", **query) - _exact) <= abs(_exact) * 0.0101
+
+    for _aggregate, _q in [("p0", 0), ("p50", 0.5), ("p95", 0.95), ("p99.9", 0.999), ("p100", 1)]:
+        _check(_aggregate, _q, nums)
+        _check(_aggregate, _q, nums[1::2], dut="d1")
+        _check(_aggregate, _q, nums[150:1750], start_time=Time(150), end_time=Time(1749))
+    assert mdb.query_metric_aggregate("p50", "lat", end_time=Time(50)) == sorted(nums[:51])[25]
+    assert mdb.query_metric_aggregate("p50", "none") is None
+
+    # Small ranges are counted and answered exactly, no sketch is built.
+    sketches = []
+    _query_partials = mdb._query_partials
+    mdb._query_partials = lambda *a, sketch=False: (sketches.append(sketch), _query_partials(*a, sketch=sketch))[1]
+    mdb.query_metric_aggregate("p50", "lat", end_time=Time(50))
+    assert sketches == [False]
+    mdb.query_metric_aggregate("p50", "lat")
+    assert sketches == [False, False, True]
+    del mdb._query_partials
+    assert len(mdb.query_metric_bucket("p99", 500, "lat")) == 4
+
+
+def test_histogram():
+    mdb = _mdb()
+    random.seed(15)
+    nums = [random.uniform(0, 100) for _ in range(1000)] + [-1, 1000]
+    words = random.choices(["a", "b", "c"], weights=[50, 30, 20], k=1000) + [str(_i) for _i in range(100)]
+    mdb.add_metric_entries(("num", MetricEntry(Time(_i), 0, _v), "t", None) for _i, _v in enumerate(nums))
+    mdb.add_metric_entries(("word", MetricEntry(Time(_i), 0, _v), "t", None) for _i, _v in enumerate(words))
+
+    hist = mdb.query_metric_histogram("fixed", 10, "num", lo=0, hi=100)
+    assert len(hist["bins"]) == 10 and (hist["under"], hist["over"]) == (1, 1)
+    assert [_b["count"] for _b in hist["bins"]] == [
+        sum(1 for _n in nums if _i * 10 <= _n < (_i + 1) * 10) for _i in range(10)
+    ]
+    hist = mdb.query_metric_histogram("fixed", 4, "num")
+    assert (hist["bins"][0]["lo"], hist["bins"][-1]["hi"]) == (-1, 1000)
+    assert sum(_b["count"] for _b in hist["bins"]) == len(nums)
+
+    hist = mdb.query_metric_histogram("log", 5, "num")
+    assert hist["under"] == 1 and hist["bins"][-1]["hi"] == 1000
+    assert sum(_b["count"] for _b in hist["bins"]) == len(nums) - 1
+
+    hist = mdb.query_metric_histogram("topk", 10, "word")
+    assert len(hist["bins"]) == 10
+    assert [_b["value"] for _b in hist["bins"][:3]] == ["a", "b", "c"]
+    assert hist["total"] == len(words)
+    assert all(_b["count"] - _b["error"] <= words.count(_b["value"]) <= _b["count"] for _b in hist["bins"])
+
+
+def test_histogram_nonfinite():
+    mdb = _mdb()
+    nums = [1.0, 10.0, 100.0, math.inf, -math.inf, math.nan]
+    mdb.add_metric_entries(("num", MetricEntry(Time(_i), 0, _v), "t", None) for _i, _v in enumerate(nums))
+    hist = mdb.query_metric_histogram("fixed", 3, "num")
+    assert (hist["bins"][0]["lo"], hist["bins"][-1]["hi"]) == (1.0, 100.0)
+    assert [_b["count"] for _b in hist["bins"]] == [2, 0, 1]
+    assert (hist["under"], hist["over"]) == (1, 1)
+    hist = mdb.query_metric_histogram("log", 2, "num")
+    assert (hist["bins"][0]["lo"], hist["bins"][-1]["hi"]) == (1.0, 100.0)
+    assert [_b["count"] for _b in hist["bins"]] == [1, 2]
+    assert (hist["under"], hist["over"]) == (1, 1)
+
+
+def test_rollup():
+    config = Config()
+    config.read_string("[MetricDB]\n_rollups = 10us, 100us\n")
+    rollup = MetricDB(tmpdir() / "metric.db", config=config)
+    config.read_string("[MetricDB]\n_rollups = \n")
+    raw = MetricDB(tmpdir() / "metric.db", config=config)
+    rows = [
+        (
+            random.choice(["cpu.usage", "cpu.temp"]),
+            MetricEntry(Time(random.randint(-500, 1500)), random.randint(0, 20), random.choice([1, 2.5, -3, "x", None])),
+            "t",
+            set(random.sample(["d0", "d1", "d2"], random.randint(0, 2))),
+        )
+        for _ in range(2000)
+    ]
+    for mdb in [rollup, raw]:
+        mdb.add_metric_entries(rows[:1000])
+        mdb.add_metric_entries(rows[1000:])
+
+    def _buckets(mdb, *args, **kwargs):
+        return [(int(b.time), b.value) for b in mdb.query_metric_bucket(*args, **kwargs)]
+
+    for _ in range(50):
+        start, end = sorted(Time(random.randint(-600, 1600)) for _ in range(2))
+        dut = set(random.sample(["d0", "d1", "d3"], random.randint(0, 1)))
+        for aggregate in ["count", "sum", "min", "max"]:
+            query = dict(key="cpu.*", dut=dut, start_time=start, end_time=end)
+            assert rollup.query_metric_aggregate(aggregate, **query) == raw.query_metric_aggregate(aggregate, **query)
+            assert _buckets(rollup, aggregate, 200, **query) == _buckets(raw, aggregate, 200, **query)
+
+    config.read_string("[MetricDB]\n_rollups = 10us\n")
+    reopened = MetricDB(raw.filename, config=config)
+    assert reopened._rollup_built == set()
+    reopened.rebuild_metric_rollup()
+    assert reopened._rollup_built == {10}
+    assert _buckets(reopened, "sum", 20, "cpu.temp", dut={"d1"}) == _buckets(raw, "sum", 20, "cpu.temp", dut={"d1"})
+
+
+def test_rollup_openers():
+    config = Config()
+    config.read_string("[MetricDB]\n_rollups = 10us, 100us\n")
+    daemon = MetricDB(tmpdir() / "metric.db", config=config)
+    daemon.add_metric_entries(("cpu.usage", MetricEntry(Time(_i), 0, _i), "t", None) for _i in range(100))
+    config.read_string("[MetricDB]\n_rollups = 1000us\n")
+    other = MetricDB(daemon.filename, config=config)
+    assert other._rollup_built == {10, 100}
+    other.add_metric_entries(("cpu.usage", MetricEntry(Time(_i), 0, _i), "t", None) for _i in range(100, 200))
+    assert daemon.query_metric_aggregate("sum", "cpu.usage") == sum(range(200))
+    assert daemon.query_metric_bucket("count", 100, "cpu.usage")[-1].value == 100
+    other.rebuild_metric_rollup()
+    assert other._rollup_built == {1000}
+    assert other.query_metric_aggregate("sum", "cpu.usage") == sum(range(200))
+
+
+def test_span():
+    mdb = _mdb()
+    random.seed(12)
+    _base = int(Time(2024, 1, 1))
+    _entries = [
+        (_base + random.randrange(0, 10_000), random.choice([0, 0, 1, 50, 5_000]))
+        for _ in range(500)
+    ]
+    mdb.add_metric_entries(
+        ("cpu.usage", MetricEntry(Time(_t), _d, _i), "t", None)
+        for _i, (_t, _d) in enumerate(_entries)
+    )
+
+    for _ in range(20):
+        _lo = _base + random.randrange(0, 10_000)
+        _hi = _lo + random.randrange(0, 2_000)
+        _expect = sorted(
+            _i for _i, (_t, _d) in enumerate(_entries)
+            if _t + _d >= _lo and _t <= _hi
+        )
+        assert sorted(e.value for e in mdb.query_metric_entry("cpu.usage", start_time=Time(_lo), end_time=Time(_hi))) == _expect
+        assert mdb.query_metric_aggregate("count", "cpu.usage", start_time=Time(_lo), end_time=Time(_hi)) == len(_expect)
+
+    assert len(mdb.query_metric_entry("cpu.usage", start_time=Time.min, end_time=Time.max)) == len(_entries)
+    _values = [e.value for e in mdb.iter_metric_entry("cpu.usage", start_time=Time(_base + 5_000))]
+    assert _values == sorted(_values, key=lambda _i: (_entries[_i][0], _i))
+
+
+def test_ingest():
+    config = Config()
+    config.read_string("[MetricDB]\n_ingest_batch = 100\n_ingest_delay = 10ms\n_ingest_capacity = 200\n")
+    mdb = MetricDB(tmpdir() / "metric.db", config=config)
+    for _i in range(10):
+        mdb.enqueue_metric_entries(
+            ("cpu.usage", MetricEntry(Time(_i * 100 + _j), 0, _j), "t", "d0")
+            for _j in range(100)
+        )
+    assert mdb.flush(timeout=10)
+    assert mdb.query_metric_aggregate("count", "cpu.usage", dut="d0") == 1000
+    stats = mdb.query_ingest_stats()
+    assert stats["depth"] == 0 and stats["committed"] == 1000 and stats["commits"] >= 10
+    assert mdb.grant_ingest_credit(150) == 150
+    assert mdb.grant_ingest_credit(500) == 50
+    assert mdb.query_ingest_stats()["throttled"] == 1
+    mdb.release_ingest_credit(150)
+    assert mdb.grant_ingest_credit(500) == 150
+    mdb.release_ingest_credit(200)
+    assert mdb.query_ingest_stats()["reserved"] == 0
+
+    try:
+        mdb.enqueue_metric_entries([("cpu.usage", None, "t", None)])
+        assert False
+    except AttributeError:
+        pass
+    mdb.enqueue_metric_entries([("cpu.usage", MetricEntry(Time(0), 0, 0), "t", None)])
+    mdb.close()
+    assert MetricDB(mdb.filename).query_metric_aggregate("count", "cpu.usage") == 1001
+
+
+def test_ingest_error():
+    mdb = _mdb()
+    good = mdb.enqueue_metric_entries([("cpu.usage", MetricEntry(Time(_i), 0, _i), "t", None) for _i in range(5)])
+    big = mdb.enqueue_metric_values([("cpu.usage", 5, 0, 2 ** 64, "t", None)])
+    bad = mdb.enqueue_metric_values([("cpu.usage", 2 ** 64, 0, 1, "t", None), ("cpu.usage", 6, 0, 6, "t", None)])
+    assert mdb.flush(timeout=10)
+    assert good.result() is None and big.result() is None
+    try:
+        bad.result()
+        assert False
+    except OverflowError:
+        pass
+    assert mdb.query_metric_aggregate("count", "cpu.usage", test="t") == 7
+    assert [e.value for e in mdb.query_metric_entry("cpu.usage", test="t")][-2:] == [2 ** 64, 6]
+    stats = mdb.query_ingest_stats()
+    assert (stats["committed"], stats["failed"]) == (7, 1)
+    mdb.close()
+
+
+def test_ingest_nosplit():
+    writes = []
+    def _write(rows):
+        writes.append(list(rows))
+        if "bad" in rows:
+            raise ValueError("bad row")
+    queue = IngestQueue(_write, 3, 1, 10, split=False)
+    future = queue.put(["ok", "bad", "ok"])
+    assert queue.flush(timeout=10)
+    assert writes == [["ok", "bad", "ok"]] and isinstance(future.exception(), ValueError)
+    queue.close()
+    queue = IngestQueue(lambda rows: [None if _r == "ok" else ValueError(_r) for _r in rows], 3, 1, 10, split=False)
+    good, bad = queue.put(["ok", "ok"]), queue.put(["bad"])
+    assert queue.flush(timeout=10)
+    assert good.result() is None and isinstance(bad.exception(), ValueError)
+    assert (queue.stats()["committed"], queue.stats()["failed"]) == (2, 1)
+    queue.close()
+
+
+def test_ingest_drop():
+    gate = threading.Event()
+    written = []
+    queue = IngestQueue(lambda rows: (gate.wait(), written.extend(rows)), 2, 0, 4, policy="drop_oldest")
+    first = queue.put(range(10))
+    while queue.stats()["depth"] > 2:
+        time.sleep(0.01)
+    last = queue.put([10, 11, 12])
+    gate.set()
+    assert queue.flush(timeout=10)
+    assert written == [6, 7, 9, 10, 11, 12]
+    assert queue.stats()["dropped"] == 7
+    # Dropped rows fail their puts, only fully committed puts succeed.
+    assert isinstance(first.exception(), DroppedError) and last.result() is None
+    assert isinstance(queue.put(range(6)).exception(timeout=10), DroppedError)
+    assert queue.close()
+
+
+def test_attach():
+    config = Config()
+    config.read_string("[MetricDB]\n_rollups = 1s\n")
+    mdb = MetricDB(tmpdir() / "metric.db", config=config)
+    try:
+        MetricDB(mdb.filename.with_name("missing.db"), attach=True)
+        assert False
+    except FileNotFoundError:
+        pass
+    job = MetricDB(mdb.filename, attach=True)
+    assert job._rollup_levels == [1_000_000]
+    job.add_metric_entries(("cpu.usage", MetricEntry(Time(_i * 100_000), 0, _i), "t", None) for _i in range(20))
+    mdb.add_metric_entry("cpu.usage", MetricEntry(Time(0), 0, 100), "t")
+    job.close()
+    assert mdb.query_metric_aggregate("count", "cpu.usage") == 21
+    assert mdb.query_metric_aggregate("max", "cpu.usage", start_time=Time(0), end_time=Time(2_000_000)) == 100
+    with sqlite3.connect(mdb.filename) as conn:
+        assert conn.execute("SELECT level, SUM(count) FROM metric_rollup GROUP BY level").fetchall() == [(1_000_000, 21)]
+
+
+def test_pool():
+    config = Config()
+    config.read_string("[MetricDB]\n_profile = throughput\n_synchronous = FULL\n_readers = 2\n")
+    mdb = MetricDB(tmpdir() / "metric.db", config=config)
+    assert mdb._readers == 2
+    with mdb._pool.reader() as conn:
+        assert conn.execute("PRAGMA synchronous").fetchone()[0] == 2
+        assert conn.execute("PRAGMA temp_store").fetchone()[0] == 2
+    mdb.add_metric_entry("cpu.usage", MetricEntry(Time(1), 0, 1), "t")
+    mdb.close()
+    for _call in [
+        lambda: mdb.add_metric_entry("cpu.usage", MetricEntry(Time(2), 0, 2), "t"),
+        lambda: mdb.enqueue_metric_values([("cpu.usage", 2, 0, 2, "t", None)]),
+        lambda: mdb.query_metric_entry("cpu.usage"),
+    ]:
+        try:
+            _call()
+            assert False
+        except RuntimeError:
+            pass
+    mdb.close()
+    mdb = MetricDB(mdb.filename, config=config)
+    assert [e.value for e in mdb.query_metric_entry("cpu.usage")] == [1]
+    mdb.close()
+
+
+def test_migrate():
+    filename = tmpdir() / "metric.db"
+    with sqlite3.connect(filename) as conn:
+        conn.execute("CREATE TABLE metric_info (key TEXT PRIMARY KEY, name TEXT, description TEXT)")
+        conn.execute("""
+            CREATE TABLE metric_entry (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                test TEXT, dut TEXT, key TEXT,
+                time INTEGER, duration INTEGER, value BLOB
+            )
+        """)
+        conn.execute(
+            "INSERT INTO metric_entry (test, dut, key, time, duration, value) VALUES (?, ?, ?, ?, ?, ?)",
+            ("t", "#d0#,#d1#", "cpu.usage", 1, 0, 42)
+        )
+        conn.commit()
+
+    mdb = MetricDB(filename)
+    with sqlite3.connect(filename) as conn:
+        _indexes = {
+            row[0]
+            for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+        }
+    assert "metric_entry_key_time" in _indexes
+    assert "metric_entry_test_key_time" in _indexes
+    assert [e.value for e in mdb.query_metric_entry("cpu.*", test="t")] == [42]
+    assert [e.value for e in mdb.query_metric_entry("cpu.*", test="t", dut={"d1"})] == [42]
+    assert [e.value for e in mdb.query_metric_entry("cpu.*", test="t", dut={"d2"})] == []
+    assert mdb.query_metric_aggregate("sum", "cpu.*", test="t") == 42.0
+
+    mdb.update_metric_info(MetricInfo("cpu.usage", "CPU usage", ""))
+    mdb.add_metric_entry("cpu.usage", MetricEntry(Time(2), 0, 43), "t")
+    with sqlite3.connect(filename) as conn:
+        assert conn.execute("SELECT DISTINCT typeof(key) FROM metric_entry").fetchall() == [("integer",)]
+    assert mdb.query_metric_info("cpu.usage").name == "CPU usage"
+    assert [e.value for e in mdb.query_metric_entry("cpu.usage", test="t")] == [42, 43]
+
+
+def test_migrate_openers():
+    filename = tmpdir() / "metric.db"
+    with sqlite3.connect(filename) as conn:
+        conn.execute("CREATE TABLE metric_info (key TEXT PRIMARY KEY, name TEXT, description TEXT)")
+        conn.execute("""
+            CREATE TABLE metric_entry (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                test TEXT, dut TEXT, key TEXT,
+                time INTEGER, duration INTEGER, value BLOB
+            )
+        """)
+        conn.execute(
+            "INSERT INTO metric_entry (test, dut, key, time, duration, value) VALUES (?, ?, ?, ?, ?, ?)",
+            ("t", "", "cpu.usage", 1, 0, 42)
+        )
+        conn.commit()
+
+    # Concurrent openers migrate each step once, keys are interned once.
+    barrier = threading.Barrier(4)
+    mdbs = []
+    def _open():
+        barrier.wait()
+        mdbs.append(MetricDB(filename))
+    threads = [threading.Thread(target=_open) for _ in range(4)]
+    for _t in threads:
+        _t.start()
+    for _t in threads:
+        _t.join()
+    assert len(mdbs) == 4
+    for mdb in mdbs:
+        assert [e.value for e in mdb.query_metric_entry("cpu.usage", test="t")] == [42]
+        mdb.close()
+
+
+def test_ingest_values():
+    mdb = _mdb()
+    values = [(1, 0, None), (2, 5, True), (3, 0, -7), (4, 0, 2.5), (5, 0, "s"), (6, 0, b"\x00"), (7, 0, {"a": [1]})]
+    data = encode_frame(3, [("cpu.usage", ["d1"], values)])
+    assert decode_frame(data) == (3, [("cpu.usage", ["d1"], values)])
+    for bad in [data[:-1], data + b"\x00"]:
+        try:
+            decode_frame(bad)
+            assert False
+        except ValueError:
+            pass
+
+    seq, updates = decode_frame(data)
+    mdb.enqueue_metric_values(
+        (MetricKey(key), time, duration, value, "t", set(dut))
+        for key, dut, entries in updates
+        for time, duration, value in entries
+    )
+    mdb.flush()
+    assert [(int(e.time), e.duration, e.value) for e in mdb.query_metric_entry("cpu.usage", test="t", dut={"d1"})] == values
+
+
+def test_ring():
+    ring = MetricRing.create(tmpdir() / "job.ring", 4)
+    ring.claim()
+    values = [None, True, -7, 2.5]
+    assert [ring.put(b"cpu.usage", t, 1, v) for t, v in enumerate(values)] == [True] * 4
+    assert ring.put(b"cpu.usage", 4, 0, 0) is False
+    assert (ring.depth(), ring.dropped) == (4, 1)
+    for bad in [(b"k" * 57, 0), (b"k", "s"), (b"k", 2 ** 63)]:
+        try:
+            ring.put(bad[0], 0, 0, bad[1])
+            assert False
+        except ValueError:
+            pass
+
+    reader = MetricRing(ring.filename)
+    try:
+        reader.claim()
+        assert False
+    except Exception:
+        pass
+    assert reader.drain(3) == [(b"cpu.usage", t, 1, v) for t, v in enumerate(values)][:3]
+    assert ring.put(b"mem.usage", 5, 0, 1.0)
+    assert reader.drain() == [(b"cpu.usage", 3, 1, 2.5), (b"mem.usage", 5, 0, 1.0)]
+    assert reader.drain() == []
+    ring.close()
+    reader.close()
+
+
+def test_drain_ring():
+    mdb = _mdb()
+    ring = MetricRing.create(tmpdir() / "job.ring", 16)
+    ring.claim()
+
+    class _Tshrag:
+        calls = 0
+        @contextmanager
+        def use_mdb(self, test_id):
+            self.calls += 1
+            if self.calls == 1:
+                raise RuntimeError("metric database closed")
+            yield mdb
+
+    stats = _DrainStats()
+    stop = threading.Event()
+    ring.put(b"cpu.usage", 1, 0, 1.0)
+    drain = threading.Thread(target=_drain_ring, args=(_Tshrag(), "t", ring, stop, stats))
+    drain.start()
+    while ring.depth():
+        time.sleep(0.01)
+    ring.put(b"\xff\xfe", 2, 0, 2.0)
+    ring.put(b"cpu.usage", 3, 0, 3.0)
+    ring.put(b"mem.\xffusage", 4, 0, 4.0)
+    stop.set()
+    drain.join()
+    assert stats.wait(timeout=10)
+    assert (stats.failed, stats.skipped) == (0, 1) and isinstance(stats.error, RuntimeError)
+    assert [(int(_e.time), _e.value) for _e in mdb.iter_metric_entry("*")] == [(1, 1.0), (3, 3.0), (4, 4.0)]
+
+    # Commit failures are counted before wait() returns.
+    future = Future()
+    stats.track(2, future)
+    assert not stats.wait(timeout=0)
+    future.set_exception(ValueError("rejected"))
+    assert stats.wait(timeout=0) and stats.asdict()["failed"] == 2
+    ring.close()
+
+
+
+if __name__ == "__main__":
+    test_query_key()
+    test_query_dut()
+    test_add_entries()
+    test_aggregate()
+    test_typed_value()
+    test_iter_entry()
+    test_page()
+    test_bucket()
+    test_quantile()
+    test_histogram()
+    test_histogram_nonfinite()
+    test_rollup()
+    test_rollup_openers()
+    test_span()
+    test_ingest()
+    test_ingest_error()
+    test_ingest_nosplit()
+    test_ingest_drop()
+    test_ingest_values()
+    test_attach()
+    test_pool()
+    test_migrate()
+    test_migrate_openers()
+    test_ring()
+    test_drain_ring()